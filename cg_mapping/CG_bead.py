@@ -1,4 +1,6 @@
 class CG_bead():
+    __slots__ = ('_beadindex', '_beadtype', '_resname', '_atom_indices')
+
     def __init__(self, beadindex=0, beadtype=None, resname=None, atom_indices=None):
         self._beadindex = beadindex
         self._beadtype = beadtype
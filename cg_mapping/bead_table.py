@@ -0,0 +1,164 @@
+import numpy as np
+
+from cg_mapping.CG_bead import CG_bead
+
+
+def _codes(values):
+    """ Unique names and compact integer codes into them """
+    names, codes = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+    return names, codes.astype(np.min_scalar_type(max(len(names) - 1, 0)))
+
+
+class BeadTable(object):
+    """ Structure-of-arrays table of CG beads
+
+    Parameters
+    ---------
+    indptr : np.ndarray (n_beads+1,)
+        Atom indices of bead i are indices[indptr[i]:indptr[i+1]]
+    indices : np.ndarray
+        Global atom indices, empty ranges for water beads
+    beadtype_codes : np.ndarray (n_beads,)
+        Index of each bead's type into beadtypes
+    beadtypes : np.ndarray
+        Unique bead type names
+    resname_codes : np.ndarray (n_beads,)
+        Index of each bead's residue name into resnames
+    resnames : np.ndarray
+        Unique residue names
+    beadindex : np.ndarray (n_beads,)
+        Index of each bead within its residue
+    bonds : np.ndarray (n_bonds, 2), optional
+        Bonded bead indices
+
+    Notes
+    -----
+    Stands in for the list of CG_bead() from create_CG_topology:
+    len(), iteration and table[i] behave like that list, building a
+    CG_bead on the fly. Bulk consumers should use the arrays directly.
+    Build with `BeadTable.from_arrays`
+
+    """
+
+    def __init__(self, indptr=None, indices=None, beadtype_codes=None,
+            beadtypes=None, resname_codes=None, resnames=None, beadindex=None,
+            bonds=None):
+        self._indptr = np.asarray(indptr)
+        self._indices = np.asarray(indices)
+        self._beadtype_codes = np.asarray(beadtype_codes)
+        self._beadtypes = np.asarray(beadtypes, dtype=str)
+        self._resname_codes = np.asarray(resname_codes)
+        self._resnames = np.asarray(resnames, dtype=str)
+        self._beadindex = np.asarray(beadindex)
+        if bonds is None:
+            bonds = np.zeros((0, 2), dtype=np.int64)
+        self._bonds = np.asarray(bonds).reshape(-1, 2)
+
+    @classmethod
+    def from_arrays(cls, beadtype=None, resname=None, beadindex=None,
+            indptr=None, indices=None, bonds=None):
+        """ Build a table from per-bead name arrays, encoding the names """
+        beadtypes, beadtype_codes = _codes(beadtype)
+        resnames, resname_codes = _codes(resname)
+        indices = np.asarray(indices)
+        n_atoms = indices.max() + 1 if len(indices) > 0 else 0
+        beadindex = np.asarray(beadindex)
+        max_beadindex = beadindex.max() if len(beadindex) > 0 else 0
+        indptr = np.asarray(indptr)
+        if bonds is None:
+            bonds = np.zeros((0, 2), dtype=np.int64)
+        bonds = np.asarray(bonds)
+        return cls(indptr=indptr.astype(np.min_scalar_type(indptr[-1])),
+                   indices=indices.astype(np.min_scalar_type(n_atoms)),
+                   beadtype_codes=beadtype_codes, beadtypes=beadtypes,
+                   resname_codes=resname_codes, resnames=resnames,
+                   beadindex=beadindex.astype(np.min_scalar_type(max_beadindex)),
+                   bonds=bonds.astype(np.min_scalar_type(len(beadindex))))
+
+    @property
+    def indptr(self):
+        return self._indptr
+
+    @property
+    def indices(self):
+        return self._indices
+
+    @property
+    def beadtype_codes(self):
+        return self._beadtype_codes
+
+    @property
+    def beadtypes(self):
+        return self._beadtypes
+
+    @property
+    def resname_codes(self):
+        return self._resname_codes
+
+    @property
+    def resnames(self):
+        return self._resnames
+
+    @property
+    def beadindex(self):
+        return self._beadindex
+
+    @property
+    def bonds(self):
+        return self._bonds
+
+    @property
+    def beadtype(self):
+        """ Bead type name of every bead """
+        return self._beadtypes[self._beadtype_codes]
+
+    @property
+    def resname(self):
+        """ Residue name of every bead """
+        return self._resnames[self._resname_codes]
+
+    @property
+    def is_water(self):
+        """ Boolean mask of the water beads """
+        return np.isin(self._resname_codes,
+                       np.flatnonzero(self._resnames == 'HOH'))
+
+    @property
+    def n_atoms_per_bead(self):
+        return np.diff(self._indptr)
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in (self._indptr, self._indices,
+            self._beadtype_codes, self._beadtypes, self._resname_codes,
+            self._resnames, self._beadindex, self._bonds))
+
+    def atom_indices(self, index):
+        """ Atom indices of one bead, None for beads without atoms """
+        start, end = int(self._indptr[index]), int(self._indptr[index+1])
+        if start == end:
+            return None
+        return self._indices[start:end]
+
+    def __len__(self):
+        return len(self._beadtype_codes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("bead index {} out of range".format(index))
+        return CG_bead(beadindex=int(self._beadindex[index]),
+                       beadtype=str(self._beadtypes[self._beadtype_codes[index]]),
+                       resname=str(self._resnames[self._resname_codes[index]]),
+                       atom_indices=self.atom_indices(index))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __str__(self):
+        return "<BeadTable with {} beads, {} bead types, {} mapped atoms>".format(
+            len(self), len(self._beadtypes), len(self._indices))
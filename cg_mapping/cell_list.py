@@ -0,0 +1,117 @@
+import itertools
+
+import numpy as np
+
+
+def wrap_coordinates(xyz, box_lengths):
+    """ Wrap coordinates into an orthorhombic box [0, L) """
+    return xyz - box_lengths * np.floor(xyz / box_lengths)
+
+def minimum_image(dx, box_lengths):
+    """ Minimum image convention for displacement vectors in an orthorhombic box """
+    return dx - box_lengths * np.round(dx / box_lengths)
+
+def orthorhombic_box(unitcell_vectors):
+    """ Box lengths from a (3, 3) unitcell vector matrix
+
+    Raises
+    ------
+    ValueError
+        If the box is triclinic
+
+    """
+    unitcell_vectors = np.asarray(unitcell_vectors)
+    box_lengths = np.diag(unitcell_vectors)
+    if not np.allclose(unitcell_vectors, np.diag(box_lengths), atol=1e-5):
+        raise ValueError("Cell lists are only implemented for orthorhombic boxes")
+    return box_lengths
+
+
+class CellList(object):
+    """ Periodic cell list (neighbor grid) over an orthorhombic box
+
+    Parameters
+    ---------
+    xyz : np.ndarray (n_particles, 3)
+        Coordinates binned into cells
+    box_lengths : np.ndarray (3,)
+    cell_size : float
+        Minimum cell edge length. Any two particles closer than this
+        are in the same or adjacent cells
+
+    Notes
+    -----
+    Particles are sorted by cell, so each cell is a contiguous
+    range (CSR-style start/count) of `members`.
+    Dimensions with fewer than three cells are searched completely,
+    so no cell is visited twice through the periodic wrap
+
+    """
+
+    def __init__(self, xyz=None, box_lengths=None, cell_size=None):
+        self._box_lengths = np.asarray(box_lengths, dtype=np.float64)
+        self._n_cells = np.maximum(1, np.floor(self._box_lengths /
+                                               cell_size)).astype(int)
+        self._cell_lengths = self._box_lengths / self._n_cells
+
+        flat = self._flatten(self.cell_of(xyz))
+        self._members = np.argsort(flat, kind='stable')
+        self._counts = np.bincount(flat, minlength=np.prod(self._n_cells))
+        self._start = np.cumsum(self._counts) - self._counts
+
+        per_dim = [(-1, 0, 1) if n >= 3 else tuple(range(n))
+                        for n in self._n_cells]
+        self._offsets = np.array(list(itertools.product(*per_dim)))
+
+    @property
+    def box_lengths(self):
+        return self._box_lengths
+
+    @property
+    def n_cells(self):
+        return self._n_cells
+
+    @property
+    def cell_lengths(self):
+        return self._cell_lengths
+
+    @property
+    def max_occupancy(self):
+        return self._counts.max()
+
+    def cell_of(self, xyz):
+        """ (i, j, k) cell of every coordinate """
+        cells = np.floor(wrap_coordinates(xyz, self._box_lengths) /
+                         self._cell_lengths).astype(int)
+        return np.minimum(cells, self._n_cells - 1)
+
+    def _flatten(self, cells):
+        return np.ravel_multi_index(cells.T, self._n_cells)
+
+    def neighbor_pairs(self, query_xyz):
+        """ Candidate neighbors of each query point, one cell offset at a time
+
+        Parameters
+        ---------
+        query_xyz : np.ndarray (n_query, 3)
+
+        Yields
+        ------
+        query_indices : np.ndarray
+        member_indices : np.ndarray
+            Indices into the binned coordinates, every particle in a cell
+            adjacent to the query's cell appears exactly once per query
+
+        """
+        query_cells = self.cell_of(query_xyz)
+        for offset in self._offsets:
+            flat = self._flatten((query_cells + offset) % self._n_cells)
+            counts = self._counts[flat]
+            total = counts.sum()
+            if total == 0:
+                continue
+            query_indices = np.repeat(np.arange(len(query_xyz)), counts)
+            first = np.repeat(np.cumsum(counts) - counts, counts)
+            positions = np.repeat(self._start[flat], counts) + \
+                    np.arange(total) - first
+            yield query_indices, self._members[positions]
@@ -0,0 +1,193 @@
+import numpy as np
+import mdtraj
+
+import cg_mapping.mapping_functions as mapping_functions
+
+
+class CGSystem(object):
+    """ Coordinates, box and topology of one CG configuration as arrays
+
+    Parameters
+    ---------
+    xyz : np.ndarray (n_beads, 3)
+        Bead coordinates (nm)
+    box_lengths : np.ndarray (3,)
+        Orthorhombic box lengths (nm)
+    names : np.ndarray (n_beads,)
+        Bead type of every bead
+    bonds : np.ndarray (n_bonds, 2), optional
+        Bonded bead indices
+    rigid_ids : np.ndarray (n_beads,), optional
+        Rigid body of every bead, -1 for beads in no rigid body
+    residues : np.ndarray (n_beads,), optional
+        CG residue index of every bead, nondecreasing
+    resnames : np.ndarray (n_residues,), optional
+        Residue names
+    masses : np.ndarray (n_beads,), optional
+        Bead masses (amu), defaults to 1
+
+    Notes
+    -----
+    Stands in for an mbuild Compound of the final frame. Scaling and
+    replicating work on whole arrays, so they cost the same as a few
+    copies of xyz however many beads there are.
+    Build with `CGSystem.from_trajectory`
+
+    """
+
+    def __init__(self, xyz=None, box_lengths=None, names=None, bonds=None,
+            rigid_ids=None, residues=None, resnames=None, masses=None):
+        self._xyz = np.asarray(xyz, dtype=np.float64).reshape(-1, 3)
+        self._box_lengths = np.asarray(box_lengths, dtype=np.float64)
+        self._names = np.asarray(names, dtype=str)
+        if bonds is None:
+            bonds = np.zeros((0, 2), dtype=np.int64)
+        self._bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+        if rigid_ids is None:
+            rigid_ids = np.full(len(self._xyz), -1, dtype=np.int64)
+        self._rigid_ids = np.asarray(rigid_ids, dtype=np.int64)
+        if residues is None:
+            residues = np.zeros(len(self._xyz), dtype=np.int64)
+        self._residues = np.asarray(residues, dtype=np.int64)
+        if resnames is None:
+            resnames = ['RES'] * (self._residues.max() + 1
+                    if len(self._residues) > 0 else 0)
+        self._resnames = np.asarray(resnames, dtype=str)
+        if masses is None:
+            masses = np.ones(len(self._xyz))
+        self._masses = np.asarray(masses, dtype=np.float64)
+
+    @classmethod
+    def from_trajectory(cls, traj, frame=-1, box_lengths=None, masses=None):
+        """ One frame of a CG trajectory, optionally rescaled to a new box
+
+        Parameters
+        ---------
+        traj : mdtraj Trajectory
+            CG trajectory with an orthorhombic box
+        frame : int
+        box_lengths : np.ndarray (3,), optional
+            e.g. compute_avg_box(traj). Coordinates are scaled by
+            box_lengths / the frame's box lengths
+        masses : np.ndarray (n_beads,), optional
+            e.g. from mapping_functions.bead_masses
+
+        Returns
+        -------
+        CGSystem
+
+        """
+        topology = traj.topology
+        xyz = traj.xyz[frame].astype(np.float64)
+        frame_box = traj.unitcell_lengths[frame].astype(np.float64)
+        if box_lengths is None:
+            box_lengths = frame_box
+        else:
+            box_lengths = np.asarray(box_lengths, dtype=np.float64)
+            xyz = xyz * (box_lengths / frame_box)
+        names = np.array([atom.name for atom in topology.atoms])
+        residues = np.array([atom.residue.index for atom in topology.atoms],
+                dtype=np.int64)
+        resnames = np.array([residue.name for residue in topology.residues])
+        bonds = np.array([(atom_i.index, atom_j.index)
+            for atom_i, atom_j in topology.bonds], dtype=np.int64)
+        return cls(xyz=xyz, box_lengths=box_lengths, names=names, bonds=bonds,
+                residues=residues, resnames=resnames, masses=masses)
+
+    @property
+    def xyz(self):
+        return self._xyz
+
+    @property
+    def box_lengths(self):
+        return self._box_lengths
+
+    @property
+    def names(self):
+        return self._names
+
+    @property
+    def bonds(self):
+        return self._bonds
+
+    @property
+    def rigid_ids(self):
+        return self._rigid_ids
+
+    @property
+    def residues(self):
+        return self._residues
+
+    @property
+    def resnames(self):
+        return self._resnames
+
+    @property
+    def masses(self):
+        return self._masses
+
+    @property
+    def n_beads(self):
+        return len(self._xyz)
+
+    @property
+    def n_residues(self):
+        return len(self._resnames)
+
+    def replicate(self, n_images=(2, 2, 2)):
+        """ Tile the system n_x by n_y by n_z times
+
+        Parameters
+        ---------
+        n_images : tuple (int, int, int)
+
+        Returns
+        -------
+        CGSystem
+            Copies are ordered x slowest, z fastest. Bead, residue and
+            rigid body indices of each copy are offset past the previous
+            copy, so bonds and rigid bodies stay within their copy
+
+        """
+        n_images = np.asarray(n_images, dtype=np.int64)
+        if n_images.shape != (3,) or np.any(n_images < 1):
+            raise ValueError("n_images must be three positive integers, "
+                    "got {}".format(n_images))
+        shifts = np.indices(n_images).reshape(3, -1).T * self._box_lengths
+        copies = np.arange(len(shifts), dtype=np.int64)
+
+        xyz = (self._xyz[np.newaxis] + shifts[:, np.newaxis]).reshape(-1, 3)
+        bonds = (self._bonds[np.newaxis] +
+                self.n_beads * copies[:, np.newaxis, np.newaxis]).reshape(-1, 2)
+        residues = (self._residues[np.newaxis] +
+                self.n_residues * copies[:, np.newaxis]).ravel()
+        n_bodies = self._rigid_ids.max() + 1 if self.n_beads > 0 else 0
+        rigid_ids = np.where(self._rigid_ids[np.newaxis] >= 0,
+                self._rigid_ids[np.newaxis] + n_bodies * copies[:, np.newaxis],
+                -1).ravel()
+        return CGSystem(xyz=xyz, box_lengths=self._box_lengths * n_images,
+                names=np.tile(self._names, len(copies)), bonds=bonds,
+                rigid_ids=rigid_ids, residues=residues,
+                resnames=np.tile(self._resnames, len(copies)),
+                masses=np.tile(self._masses, len(copies)))
+
+    def to_trajectory(self, name_prefix=''):
+        """ Single-frame mdtraj Trajectory of the system
+
+        Parameters
+        ---------
+        name_prefix : str
+            Prepended to every bead name, e.g. '_' for mbuild's
+            coarse-grained particle names
+
+        """
+        names = np.char.add(name_prefix, np.char.strip(self._names))
+        topology = mapping_functions._topology_from_arrays(names,
+                self._residues, self._resnames, self._bonds)
+        return mdtraj.Trajectory(self._xyz[np.newaxis], topology,
+                unitcell_lengths=self._box_lengths[np.newaxis],
+                unitcell_angles=np.full((1, 3), 90.0))
+
+    def __str__(self):
+        return "<CGSystem with {} beads, {} bonds, box {}>".format(
+            self.n_beads, len(self._bonds), self._box_lengths)
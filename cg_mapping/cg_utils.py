@@ -3,6 +3,9 @@ import sys
 import math
 import numpy as np
 import itertools
+import hashlib
+import warnings
+from multiprocessing import Pool, cpu_count
 import matplotlib
 matplotlib.use('Agg')
 import pdb
@@ -10,9 +13,233 @@ import networkx as nx
 from networkx import NetworkXNoPath
 
 import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit
-from collections import Counter
-from msibi.utils.find_exclusions import find_1_n_exclusions
+from scipy import sparse
+from scipy.optimize import curve_fit, OptimizeWarning
+from collections import Counter, OrderedDict
+
+import cg_mapping.histograms as histograms_io
+from cg_mapping.histograms import (HistogramAccumulator, RDFAccumulator,
+        span_range)
+from cg_mapping.cell_list import CellList, orthorhombic_box
+
+def plot_distribution(bins, probabilities, filename, xlabel="Distance (nm)",
+        ylabel="Frequency density"):
+    """ Render a computed histogram to file
+
+    Parameters
+    ----------
+    bins : np.ndarray (n_bins+1,)
+        Bin edges
+    probabilities : np.ndarray (n_bins,)
+    filename : str
+    """
+    fig, ax = plt.subplots(1,1)
+    ax.hist(bins[:-1], bins, weights=probabilities)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.grid()
+    fig.tight_layout()
+    fig.savefig(filename)
+    plt.close(fig)
+
+def plot_energies(x, predicted_energies, target_energies, filename, 
+        xlabel="Distance (nm)"):
+    """ Render fitted and Boltzmann-inverted energies to file
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Bin centers
+    predicted_energies : np.ndarray
+        Energies of the fitted harmonic potential
+    target_energies : np.ndarray
+        Energies from Boltzmann inversion
+    filename : str
+    """
+    fig ,ax = plt.subplots(1,1)
+    ax.plot(x, predicted_energies, c='darkgray', label="Predicted")
+    ax.plot(x, target_energies, c='black', label="Target", alpha=1, 
+            linestyle='--')
+    ax.legend()
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel("Energy (kJ/mol)")
+    ax.grid()
+    fig.tight_layout()
+    fig.savefig(filename)
+    plt.close(fig)
+
+def wrap_dihedrals(dihedrals):
+    """ Dihedrals wrapped into [-pi, pi), so +pi and -pi share a bin """
+    return np.mod(np.asarray(dihedrals) + np.pi, 2 * np.pi) - np.pi
+
+def _cell_list_rdf_counts(xyz, box_lengths, atoms_i, atoms_j, excluded, bins):
+    """ Pair-distance histogram of one frame from a periodic cell list
+
+    Parameters
+    ---------
+    xyz : np.ndarray (n_atoms, 3)
+    box_lengths : np.ndarray (3,)
+        Orthorhombic box
+    atoms_i : np.ndarray
+        Sorted atom indices of the first type
+    atoms_j : np.ndarray
+        Sorted atom indices of the second type
+    excluded : np.ndarray
+        Sorted keys i*n_atoms + j of excluded pairs
+    bins : np.ndarray (n_bins+1,)
+        Bin edges, the last one is the cutoff
+
+    Returns
+    -------
+    counts : np.ndarray (n_bins,)
+
+    Notes
+    -----
+    Only pairs in adjacent cells of size bins[-1] are visited,
+    so memory grows with the number of atoms, not pairs. Pairs are
+    counted once: i < j when both types are the same.
+    Distances use float32 minimum images like mdtraj.compute_distances
+    """
+    counts = np.zeros(len(bins) - 1, dtype=np.int64)
+    if len(atoms_i) == 0 or len(atoms_j) == 0:
+        return counts
+    same = np.array_equal(atoms_i, atoms_j)
+    n_atoms = len(xyz)
+    xyz = xyz.astype(np.float32)
+    box_lengths = np.asarray(box_lengths, dtype=np.float32)
+    inv_box = np.float32(1) / box_lengths
+    xyz_i, xyz_j = xyz[atoms_i], xyz[atoms_j]
+    cells = CellList(xyz_j, box_lengths, cell_size=bins[-1])
+    # Loose squared cutoff, np.histogram drops the pairs just beyond it
+    cutoff_squared = np.float32(bins[-1]**2 * (1 + 1e-5))
+    for query_indices, member_indices in cells.neighbor_pairs(xyz_i):
+        dx = xyz_j[member_indices] - xyz_i[query_indices]
+        dx -= box_lengths * np.round(dx * inv_box)
+        squared = np.einsum('ij,ij->i', dx, dx)
+        close = squared <= cutoff_squared
+        first = atoms_i[query_indices[close]]
+        second = atoms_j[member_indices[close]]
+        keep = first < second if same else first != second
+        if len(excluded) > 0:
+            keys = first.astype(np.int64) * n_atoms + second
+            positions = np.minimum(np.searchsorted(excluded, keys), 
+                    len(excluded) - 1)
+            keep &= excluded[positions] != keys
+        distances = np.sqrt(squared[close][keep])
+        counts += np.histogram(distances, bins=bins)[0]
+    return counts
+
+def _rdf_pair_count(atoms_i, atoms_j, excluded, n_atoms):
+    """ Number of i-j pairs an RDF runs over, after exclusions """
+    same = np.array_equal(atoms_i, atoms_j)
+    if same:
+        n_pairs = len(atoms_i) * (len(atoms_i) - 1) // 2
+    else:
+        n_pairs = len(atoms_i) * len(atoms_j)
+    first, second = excluded // n_atoms, excluded % n_atoms
+    removed = np.isin(first, atoms_i) & np.isin(second, atoms_j)
+    removed &= (first < second) if same else (first != second)
+    return n_pairs - int(np.count_nonzero(removed))
+
+# Per-process state of the RDF pool, set by _init_rdf_worker
+_rdf_worker = {}
+
+def _init_rdf_worker(topology, pair_sets, excluded, bins, method):
+    """ Send the topology, pair sets and exclusions once per worker """
+    _rdf_worker.update({'topology': topology, 'pair_sets': pair_sets,
+            'excluded': excluded, 'bins': bins, 'method': method})
+
+def _rdf_counts(block):
+    """ Pair-distance counts of every pair set over a block of frames
+
+    Parameters
+    ---------
+    block : tuple (np.ndarray (n_frames, n_atoms, 3), np.ndarray (n_frames, 3, 3))
+        Coordinates and unitcell vectors
+
+    Returns
+    -------
+    all_counts : list of np.ndarray (n_bins,)
+        One histogram per pair set, summed over the block
+
+    Notes
+    -----
+    With method 'cell_list' each pair set is (atoms_i, atoms_j), with
+    'pairs' an explicit (n_pairs, 2) array already stripped of exclusions
+    """
+    xyz, unitcell_vectors = block
+    bins = _rdf_worker['bins']
+    all_counts = []
+    if _rdf_worker['method'] == 'cell_list':
+        box_lengths = [orthorhombic_box(vectors) for vectors in unitcell_vectors]
+        for atoms_i, atoms_j in _rdf_worker['pair_sets']:
+            all_counts.append(np.sum([_cell_list_rdf_counts(frame_xyz, 
+                frame_box, atoms_i, atoms_j, _rdf_worker['excluded'], bins) 
+                for frame_xyz, frame_box in zip(xyz, box_lengths)],
+                axis=0))
+        return all_counts
+
+    traj = mdtraj.Trajectory(xyz, _rdf_worker['topology'])
+    traj.unitcell_vectors = unitcell_vectors
+    for pairs in _rdf_worker['pair_sets']:
+        if len(pairs) == 0:
+            all_counts.append(np.zeros(len(bins) - 1, dtype=np.int64))
+            continue
+        distances = mdtraj.compute_distances(traj, pairs)
+        all_counts.append(np.histogram(distances, bins=bins)[0])
+    return all_counts
+
+def _replica_distributions(replica):
+    """ Bond, angle and dihedral histograms of one streamed replica
+
+    Parameters
+    ---------
+    replica : tuple (str, str, int, dict)
+        trajfile, top, chunk and accumulate_distributions arguments
+
+    Returns
+    -------
+    bond_histograms, angle_histograms, dihedral_histograms : OrderedDict
+    """
+    trajfile, top, chunk, kwargs = replica
+    state = State(trajfile=trajfile, top=top, chunk=chunk)
+    return state.accumulate_distributions(**kwargs)
+
+def _replica_ranges(replica):
+    """ Per-type bond and angle (min, max) of one streamed replica
+
+    Parameters
+    ---------
+    replica : tuple (str, str, int)
+        trajfile, top and chunk
+    """
+    trajfile, top, chunk = replica
+    return State(trajfile=trajfile, top=top, chunk=chunk).distribution_ranges()
+
+def _extend_ranges(ranges, key, values):
+    """ Widen ranges[key] = (min, max) to cover the non-NaN values """
+    values = values[~np.isnan(values)]
+    if len(values) > 0:
+        minimum, maximum = ranges[key]
+        ranges[key] = (min(minimum, values.min()), max(maximum, values.max()))
+
+def _merge_ranges(all_ranges):
+    """ Combine a list of OrderedDicts of (min, max) key by key """
+    merged = OrderedDict()
+    for ranges in all_ranges:
+        for key, (minimum, maximum) in ranges.items():
+            merged[key] = (min(merged[key][0], minimum), 
+                    max(merged[key][1], maximum)) if key in merged \
+                    else (minimum, maximum)
+    return merged
+
+def _merge_histograms(all_histograms):
+    """ Sum a list of OrderedDicts of accumulators key by key """
+    merged = OrderedDict()
+    for histograms in all_histograms:
+        for key, histogram in histograms.items():
+            merged[key] = merged[key] + histogram if key in merged else histogram
+    return merged
 
 class State(object):
     """ Container to store basic thermodynamic information
@@ -24,18 +251,60 @@ class State(object):
     T : float
         Temperature
     traj : MDTraj Trajectory
+    trajfile : str, optional
+        Trajectory file streamed with mdtraj.iterload instead of
+        loading `traj`
+    top : str, optional
+        Topology file for trajfile
+    chunk : int
+        Frames per chunk when streaming trajfile
+
+    Notes
+    -----
+    With trajfile, distributions are accumulated chunk by chunk into
+    fixed-bin histograms (see accumulate_distributions), so memory does
+    not depend on trajectory length.
+    Computed distributions are kept on the State and can be written
+    with save_distributions; State.from_distributions refits them
+    without a trajectory. k_b and T only enter the fits
 
         """
 
-    def __init__(self, k_b=8.314e-3, T=305, traj=None):
+    def __init__(self, k_b=8.314e-3, T=305, traj=None, trajfile=None,
+            top=None, chunk=1000):
         self._k_b = k_b
         self._T = T
-        self._traj = traj
+        self._trajfile = trajfile
+        self._top = top
+        self._chunk = chunk
+        if traj is not None:
+            self.traj = traj
+        else:
+            self._traj = None
+            if top or trajfile:
+                self._set_topology(mdtraj.load_topology(top or trajfile))
+            else:
+                # Only refits from saved distributions
+                self._set_topology(None)
+
+    def _set_topology(self, topology):
+        self._topology = topology
         self._bondgraph = nx.Graph()
-        self._bondgraph.add_nodes_from([a.index for a in traj.topology.atoms])
-        bonds = [b for b in traj.topology.bonds]
-        bonds_by_index = [(b[0].index, b[1].index) for b in bonds]
-        self._bondgraph.add_edges_from(bonds_by_index)
+        if topology is not None:
+            self._bondgraph.add_nodes_from([a.index for a in topology.atoms])
+            bonds = [b for b in topology.bonds]
+            bonds_by_index = [(b[0].index, b[1].index) for b in bonds]
+            self._bondgraph.add_edges_from(bonds_by_index)
+        self._bond_index_cache = None
+        self._angle_index_cache = None
+        self._atom_names_cache = None
+        self._exclusion_cache = {}
+        self._bond_histograms = None
+        self._angle_histograms = None
+        self._dihedral_index_cache = None
+        self._dihedral_histograms = None
+        self._rdf_histograms = OrderedDict()
+        self._source_hash = None
 
     
     @property
@@ -50,10 +319,38 @@ class State(object):
     def traj(self):
         return self._traj
 
+    @property
+    def trajfile(self):
+        return self._trajfile
+
+    @property
+    def chunk(self):
+        return self._chunk
+
+    @property
+    def topology(self):
+        return self._topology
+
     @property
     def bondgraph(self):
         return self._bondgraph
 
+    @property
+    def bond_histograms(self):
+        return self._bond_histograms
+
+    @property
+    def angle_histograms(self):
+        return self._angle_histograms
+
+    @property
+    def dihedral_histograms(self):
+        return self._dihedral_histograms
+
+    @property
+    def rdf_histograms(self):
+        return self._rdf_histograms
+
     @k_b.setter
     def k_b(self, k_b):
         self._k_b = k_b
@@ -64,15 +361,17 @@ class State(object):
 
     @traj.setter
     def traj(self, traj):
-        self._T = traj
-        self._bondgraph = nx.Graph()
-        self._bondgraph.add_nodes_from([a.index for a in traj.topology.atoms])
-        bonds = [b for b in traj.topology.bonds]
-        bonds_by_index = [(b[0].index, b[1].index) for b in bonds]
-        self._bondgraph.add_edges_from(bonds_by_index)
+        self._traj = traj
+        self._set_topology(traj.topology)
 
 
     def __str__(self):
+        if self.traj is None and self.trajfile is None:
+            return("k_B = {} \nT = {}\ndistributions from {}".format(
+                self.k_b, self.T, self._source_hash))
+        if self.traj is None:
+            return("k_B = {} \nT = {}\ntraj = {} (streamed, chunk={})".format(
+                self.k_b, self.T, self.trajfile, self.chunk))
         return("k_B = {} \nT = {}\ntraj = {}".format(self.k_b, self.T, self.traj))
     
 
@@ -156,6 +455,23 @@ class State(object):
         """
         return force_constant*(x_val-x0)
     
+    def boltzmann_invert(self, probabilities):
+        """ Energies from a probability distribution, V = -k_b T ln(P)
+
+        Parameters
+        ----------
+        probabilities : np.ndarray
+            Probabilities at or below 1e-6 are clipped to 1e-6
+
+        Returns
+        -------
+        energies : np.ndarray
+            Shifted so the minimum energy is zero
+        """
+        probabilities = np.where(probabilities <= 1e-6, 1e-6, probabilities)
+        energies = -self._k_b * self._T * np.log(probabilities)
+        return energies - energies.min()
+
     def fit_to_gaussian(self, independent_vars, dependent_vars, energy_fit=False):
         """ Fit values to gaussian distribution
     
@@ -168,7 +484,8 @@ class State(object):
         Returns
         -------
         harmonic_parameters : dict()
-            force_constant, x0
+            force_constant, x0, and for probability fits r_squared and
+            fallback as returned by fit_gaussians
 
         Notes
         -----
@@ -176,16 +493,7 @@ class State(object):
     
         # Fit probabilities to gaussian probabilities
         if not energy_fit:
-            params, covar = curve_fit(self.gaussian, independent_vars, 
-                    dependent_vars)#, method='dogbox', bounds = [(0,0,-np.inf), 
-                        #(np.inf, np.inf, np.inf)])
-            x0 = params[0]
-            w = params[1]
-            A = params[2]
-
-            # Extract spring constant
-            force_constant = 4 * self._k_b * self._T/w**2
-            #bonded_parameters={'force_constant': force_constant, 'x0': x0}
+            return self.fit_gaussians([independent_vars], [dependent_vars])[0]
         # Fit gaussian energies
         else:
             params, covar = curve_fit(self.gaussian_to_energy, independent_vars,
@@ -197,7 +505,255 @@ class State(object):
     
         bonded_parameters={'force_constant': force_constant, 'x0': x0}
         return bonded_parameters
-    
+
+    def _gaussian_moments(self, x, probabilities):
+        """ x0, w, A of the gaussian with the mean, variance and area
+        of a binned distribution """
+        weights = np.clip(probabilities, 0, None)
+        dx = (x[-1] - x[0]) / (len(x) - 1) if len(x) > 1 else 1.0
+        total = weights.sum()
+        if total <= 0:
+            return np.array([np.mean(x), dx, 0.0])
+        x0 = np.sum(weights * x) / total
+        variance = np.sum(weights * (x - x0)**2) / total
+        # gaussian() has variance w**2/4
+        w = 2 * np.sqrt(variance) if variance > 0 else dx
+        return np.array([x0, w, total * dx])
+
+    def _r_squared(self, x, probabilities, params):
+        """ Coefficient of determination of gaussian(x, *params) """
+        residual = np.sum((probabilities - self.gaussian(x, *params))**2)
+        total = np.sum((probabilities - np.mean(probabilities))**2)
+        if total == 0:
+            return 1.0 if residual == 0 else 0.0
+        return 1 - residual / total
+
+    def fit_gaussians(self, independent_vars, dependent_vars):
+        """ Fit many distributions to gaussians
+
+        Parameters
+        ----------
+        independent_vars : list of np.ndarray
+            Bin centers of each distribution
+        dependent_vars : list of np.ndarray
+            Probabilities of each distribution
+
+        Returns
+        -------
+        all_parameters : list of dict
+            force_constant, x0, r_squared (of the gaussian against the
+            distribution) and fallback (True if the moment estimate
+            was kept)
+
+        Notes
+        -----
+        Each fit is seeded with the moment estimate x0 = mean, 
+        w = 2*standard deviation, A = area, so curve_fit starts next to
+        the optimum. If it fails, or does no better than the moments, 
+        the moment estimate is used instead: no retries, no windows
+        """
+        all_parameters = []
+        for x, probabilities in zip(independent_vars, dependent_vars):
+            x = np.asarray(x, dtype=float)
+            probabilities = np.asarray(probabilities, dtype=float)
+            params = self._gaussian_moments(x, probabilities)
+            r_squared = self._r_squared(x, probabilities, params)
+            fallback = True
+            if not np.any(probabilities > 0):
+                # Nothing to fit
+                all_parameters.append({'force_constant': 4 * self._k_b * 
+                    self._T/params[1]**2, 'x0': params[0], 'r_squared': 0.0,
+                    'fallback': fallback})
+                continue
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', OptimizeWarning)
+                    fitted, covar = curve_fit(self.gaussian, x, probabilities,
+                            p0=params, maxfev=1000)
+                if np.all(np.isfinite(fitted)) and fitted[1] != 0:
+                    fitted_r_squared = self._r_squared(x, probabilities, fitted)
+                    if fitted_r_squared >= r_squared:
+                        params, r_squared = fitted, fitted_r_squared
+                        fallback = False
+            except (RuntimeError, ValueError, TypeError):
+                pass
+            x0, w = params[0], abs(params[1])
+            # Extract spring constant
+            force_constant = 4 * self._k_b * self._T/w**2
+            all_parameters.append({'force_constant': force_constant, 'x0': x0,
+                'r_squared': r_squared, 'fallback': fallback})
+        return all_parameters
+
+    def _iter_chunks(self):
+        """ Frames of the trajectory, the loaded traj or chunks of trajfile """
+        if self.traj is not None:
+            yield self.traj
+        else:
+            for traj_chunk in mdtraj.iterload(self.trajfile, top=self._top,
+                    chunk=self.chunk):
+                yield traj_chunk
+
+    def _default_rdf_method(self, cutoff):
+        """ 'cell_list' if the first frame's box is orthorhombic and at
+        least three cutoffs long in every dimension, otherwise 'pairs'
+
+        Smaller boxes give fewer than three cells per dimension and the
+        cell list degenerates into an all-pairs search
+        """
+        if self.traj is not None:
+            unitcell_vectors = self.traj.unitcell_vectors
+        else:
+            unitcell_vectors = mdtraj.load_frame(self.trajfile, 0, 
+                    top=self._top).unitcell_vectors
+        if unitcell_vectors is None:
+            return 'pairs'
+        try:
+            box_lengths = orthorhombic_box(unitcell_vectors[0])
+        except ValueError:
+            return 'pairs'
+        if np.all(box_lengths >= 3 * cutoff):
+            return 'cell_list'
+        return 'pairs'
+
+    def _check_ranges(self, bond_range, angle_range):
+        """ Raise if bonds or angles need a streamed histogram range that
+        was not given, rather than reading the trajectory twice """
+        missing = [name for name, given, n in (
+            ('bond_range', bond_range, len(self._bond_index()[0])),
+            ('angle_range', angle_range, len(self._angle_index()[0])))
+            if given is None and n > 0]
+        if missing:
+            raise ValueError("Streaming needs {}, or data_ranges=True to find "
+                    "them with an extra pass over the trajectory".format(
+                        " and ".join(missing)))
+
+    def distribution_ranges(self):
+        """ Smallest and largest bond length and angle of every type
+
+        Returns
+        -------
+        bond_ranges : OrderedDict
+            (atomtype_i, atomtype_j) : (min, max) (nm)
+        angle_ranges : OrderedDict
+            (atomtype_i, atomtype_j, atomtype_k) : (min, max) (rad)
+
+        Notes
+        -----
+        One pass over the trajectory, chunk by chunk when streaming.
+        Types without values get (inf, -inf)
+        """
+        bonds, pair_codes, type_pairs = self._bond_index()
+        triplets, type_codes, type_triples = self._angle_index()
+        bond_ranges = OrderedDict((pair, (np.inf, -np.inf)) 
+                for pair in type_pairs)
+        angle_ranges = OrderedDict((triple, (np.inf, -np.inf)) 
+                for triple in type_triples)
+        for traj_chunk in self._iter_chunks():
+            if len(bonds) > 0:
+                distances = mdtraj.compute_distances(traj_chunk, bonds)
+                for code, pair in enumerate(type_pairs):
+                    _extend_ranges(bond_ranges, pair, 
+                            distances[:, pair_codes == code])
+            if len(triplets) > 0:
+                angles = mdtraj.compute_angles(traj_chunk, triplets)
+                for code, triple in enumerate(type_triples):
+                    _extend_ranges(angle_ranges, triple, 
+                            angles[:, type_codes == code])
+        return bond_ranges, angle_ranges
+
+    def accumulate_distributions(self, bond_range=None, angle_range=None,
+            n_bins=50, data_ranges=False):
+        """ Histogram every bond, angle and dihedral type in one pass over
+        the trajectory
+
+        Parameters
+        ---------
+        bond_range : tuple (float, float) or dict, optional
+            Histogram range of bond lengths (nm), the same for every
+            type, or a dict of type pair : range. Required when 
+            streaming unless data_ranges is set
+        angle_range : tuple (float, float) or dict, optional
+            Histogram range of angles (rad), as bond_range
+        n_bins : int
+        data_ranges : boolean
+            Bin each type over its own min to max when a range is not
+            given, found by a first pass. Always the case for an 
+            in-memory trajectory, which is not read again
+
+        Returns
+        -------
+        bond_histograms : OrderedDict
+            (atomtype_i, atomtype_j) : HistogramAccumulator
+        angle_histograms : OrderedDict
+            (atomtype_i, atomtype_j, atomtype_k) : HistogramAccumulator
+        dihedral_histograms : OrderedDict
+            (atomtype_i, atomtype_j, atomtype_k, atomtype_l) : 
+            HistogramAccumulator over [-pi, pi)
+
+        Notes
+        -----
+        Also stored on the State, where the compute_all_*_parameters
+        methods fit from them when streaming.
+        With data ranges every type is binned over its own min to max,
+        as the in-memory fits bin it, so streamed and in-memory 
+        parameters agree, but a streamed trajectory is read twice (see
+        distribution_ranges). Fixed ranges read it once, but values 
+        outside them are dropped and a range much wider than a 
+        distribution leaves its peak in a few bins, e.g. (0, 1) nm over 
+        50 bins gives 0.02 nm bins, wider than most bond length
+        distributions. Dihedrals always span the full period
+
+        """
+        bonds, pair_codes, type_pairs = self._bond_index()
+        triplets, type_codes, type_triples = self._angle_index()
+        quadruplets, quadruple_codes, type_quadruples = self._dihedral_index()
+        if self.traj is None and not data_ranges:
+            self._check_ranges(bond_range, angle_range)
+        if (bond_range is None and len(bonds) > 0) or \
+                (angle_range is None and len(triplets) > 0):
+            bond_ranges, angle_ranges = self.distribution_ranges()
+            if bond_range is None:
+                bond_range = OrderedDict((pair, span_range(*extent))
+                        for pair, extent in bond_ranges.items())
+            if angle_range is None:
+                angle_range = OrderedDict((triple, span_range(*extent))
+                        for triple, extent in angle_ranges.items())
+        bond_histograms = OrderedDict((pair, HistogramAccumulator(
+            bin_range=bond_range[pair] if isinstance(bond_range, dict) 
+            else bond_range, n_bins=n_bins)) for pair in type_pairs)
+        angle_histograms = OrderedDict((triple, HistogramAccumulator(
+            bin_range=angle_range[triple] if isinstance(angle_range, dict) 
+            else angle_range, n_bins=n_bins)) for triple in type_triples)
+        dihedral_histograms = OrderedDict((quadruple, 
+            HistogramAccumulator(bin_range=(-np.pi, np.pi), n_bins=n_bins)) 
+            for quadruple in type_quadruples)
+
+        n_frames = 0
+        for traj_chunk in self._iter_chunks():
+            n_frames += traj_chunk.n_frames
+            if len(bonds) > 0:
+                distances = mdtraj.compute_distances(traj_chunk, bonds)
+                for code, pair in enumerate(type_pairs):
+                    bond_histograms[pair].update(distances[:, pair_codes == code])
+            if len(triplets) > 0:
+                angles = mdtraj.compute_angles(traj_chunk, triplets)
+                for code, triple in enumerate(type_triples):
+                    angle_histograms[triple].update(angles[:, type_codes == code])
+            if len(quadruplets) > 0:
+                dihedrals = wrap_dihedrals(mdtraj.compute_dihedrals(traj_chunk, 
+                    quadruplets))
+                for code, quadruple in enumerate(type_quadruples):
+                    dihedral_histograms[quadruple].update(
+                            dihedrals[:, quadruple_codes == code])
+        print("Accumulated {} bond types, {} angle types and {} dihedral types "
+              "over {} frames".format(len(type_pairs), len(type_triples), 
+                  len(type_quadruples), n_frames))
+
+        self._bond_histograms = bond_histograms
+        self._angle_histograms = angle_histograms
+        self._dihedral_histograms = dihedral_histograms
+        return bond_histograms, angle_histograms, dihedral_histograms
+
     def compute_bond_parameters(self, atomtype_i, atomtype_j, plot=False):
         """
         Calculate bonded parameters from a trajectory
@@ -220,8 +776,15 @@ class State(object):
     
         """
     
-        topol = self.traj.topology
         target_pair = (atomtype_i, atomtype_j)
+        if self._bond_histograms is not None:
+            histogram = self._bond_histograms.get(tuple(sorted(target_pair)))
+            if histogram is None:
+                return None
+            return self._bond_parameters_from_histogram(histogram.density(),
+                    histogram.bins, atomtype_i, atomtype_j, plot=plot)
+
+        topol = self.topology
         bonded_pairs = []
         if len([(i,j) for i,j in topol.bonds]) == 0:
             sys.exit("No bonds detected, check your input files")
@@ -234,89 +797,167 @@ class State(object):
             #print("No {}-{} bonds detected".format(atomtype_i, atomtype_j))
             return None
 
+        if self.traj is None:
+            self.accumulate_distributions(data_ranges=True)
+            return self.compute_bond_parameters(atomtype_i, atomtype_j, 
+                    plot=plot)
+
         # Compute distance between bonded pairs
         bond_distances = np.asarray(mdtraj.compute_distances(self.traj, bonded_pairs))
+        return self._bond_parameters_from_distances(bond_distances, 
+                atomtype_i, atomtype_j, plot=plot)
+
+    def _bond_index(self):
+        """ Every bond in the topology, labelled by its pair of atom types
+
+        Returns
+        -------
+        bonds : np.ndarray (n_bonds, 2)
+            Atom indices of each bond
+        pair_codes : np.ndarray (n_bonds,)
+            Index into type_pairs of each bond
+        type_pairs : list of (str, str)
+            Alphabetically ordered atom-type pairs
+
+        Notes
+        -----
+        Built once from a single scan of the topology bonds and cached
+        """
+        if self._bond_index_cache is None:
+            bonds = np.array([(i.index, j.index) for (i, j) in 
+                              self.topology.bonds], dtype=int).reshape(-1, 2)
+            names = self._atom_names
+            labels = ["{}\x00{}".format(*sorted(pair)) for pair in names[bonds]]
+            unique_labels, pair_codes = np.unique(labels, return_inverse=True)
+            type_pairs = [tuple(label.split("\x00")) for label in unique_labels]
+            self._bond_index_cache = (bonds, pair_codes, type_pairs)
+        return self._bond_index_cache
+
+    def compute_all_bond_parameters(self, plot=False):
+        """
+        Calculate bonded parameters for every pair of bonded atomtypes
+
+        Returns
+        -------
+        all_bond_parameters : OrderedDict
+            (atomtype_i, atomtype_j) : bonded parameters, as returned by
+            compute_bond_parameters
+
+        Notes
+        -----
+        Bonds are classified by type pair in one pass over the topology,
+        all bond distances come from one mdtraj.compute_distances call,
+        then each type pair is histogrammed and fit.
+        When streaming a trajfile, fits the accumulated histograms instead.
+        The histograms are kept in bond_histograms, later calls only refit
+
+        """
+        if self._bond_histograms is None:
+            if self.topology is None:
+                raise ValueError("No bond distributions were loaded and "
+                        "there is no trajectory to compute them from")
+            bonds, pair_codes, type_pairs = self._bond_index()
+            if len(bonds) == 0:
+                sys.exit("No bonds detected, check your input files")
+            if self.traj is None:
+                self.accumulate_distributions(data_ranges=True)
+            else:
+                all_distances = mdtraj.compute_distances(self.traj, bonds)
+                # 51 bins, 50 probabilities
+                self._bond_histograms = OrderedDict((pair, 
+                    HistogramAccumulator.from_values(
+                        all_distances[:, pair_codes == code], n_bins=50))
+                    for code, pair in enumerate(type_pairs))
+
+        histograms = OrderedDict((pair, (histogram.density(), histogram.bins))
+                for pair, histogram in self._bond_histograms.items())
+        return self._bond_parameters_from_histograms(histograms, plot=plot)
+
+    def _bond_parameters_from_distances(self, bond_distances, atomtype_i, 
+            atomtype_j, plot=False):
+        """ Histogram bond distances, Boltzmann invert and fit 
+        
+        Parameters
+        ---------
+        bond_distances : np.ndarray
+            Distances of every bond of this type, every frame
+        atomtype_i : str
+        atomtype_j : str
+        plot : boolean
     
-        fig,ax =  plt.subplots(1,1)
+        Returns
+        -------
+        bonded_parameters : dict
+            force_constant, x0
+        """
         # 51 bins, 50 probabilities
-        all_probabilities, bins, patches = ax.hist(bond_distances.flatten(), 50, normed=True)
-        if plot:
-            ax.set_xlabel("Distance (nm)")
-            ax.set_ylabel("Frequency density")
-            ax.grid()
-            fig.tight_layout()
-            plt.savefig("{}-{}_bond_distribution.jpg".format(atomtype_i, atomtype_j))
-            plt.close()
-    
-    
-        # Need to compute energies from the probabilities
-        # For each probability, compute energy and assign it appropriately
-        all_energies = []
-        all_distances = []
-    
-        for index, probability in enumerate(all_probabilities):
-            first_bin = bins[index]
-            second_bin = bins[index+1]
-            bin_width = second_bin - first_bin
-            if probability - 1e-6 <=0:
-                probability = 1e-6
-            energy = -self._k_b * self._T * np.log(probability)
-            distance = np.mean((bins[index], bins[index+1]))
-            all_energies.append(energy)
-            all_distances.append(distance)
-        # Shift energies to positive numbers
-        min_shift = min(all_energies)
-        all_energies = [energy - min_shift for energy in all_energies]
-        min_index = np.argmin(all_energies)
-        converged = False
-        i = 2
-        while not converged:
-            try:
-                # Slice data to be center the fit around the minima
-                sliced_distances = all_distances[min_index-i: min_index+i]
-                sliced_energies = all_energies[min_index-i: min_index+i]
-                sliced_probabilities = all_probabilities[min_index-i: min_index+i]
-
-                #bonded_parameters = self.fit_to_gaussian(sliced_distances, sliced_energies)
-                bonded_parameters = self.fit_to_gaussian(sliced_distances, sliced_probabilities)
-                converged=True
-
-            except RuntimeError:
-                i +=1
-                if min_index + i >= 50 or min_index -i <= 0:
-                    #bonded_parameters = self.fit_to_gaussian(all_distances, all_energies)
-                    bonded_parameters = self.fit_to_gaussian(all_distances, all_probabilities)
-                    converged=True
-            
+        all_probabilities, bins = np.histogram(bond_distances.flatten(), 50, 
+                density=True)
+        return self._bond_parameters_from_histogram(all_probabilities, bins,
+                atomtype_i, atomtype_j, plot=plot)
 
-        predicted_energies = self.harmonic_energy(all_distances, **bonded_parameters)
-        if plot:
-            #fig, axarray = plt.subplots(2,1,sharex=True)
-            #axarray[0].plot(all_distances, predicted_energies, c='darkgray', label="Predicted")
-            #axarray[1].plot(all_distances, all_energies, c='black', label="Target")
-            #axarray[0].legend()
-            #axarray[1].legend()
-            #axarray[1].set_xlabel("Distance (nm)")
-            #axarray[0].set_ylabel("Energy (kJ/mol)")
-            #axarray[1].set_ylabel("Energy (kJ/mol)")
-            #plt.savefig("{}-{}_bond_energies.jpg".format(atomtype_i, atomtype_j))
-            #plt.close()
-            
-            fig ,ax = plt.subplots(1,1)
-            ax.plot(all_distances, predicted_energies, c='darkgray', 
-                    label="Predicted")
-            ax.plot(all_distances,all_energies, c='black', label="Target", 
-                    alpha=1, linestyle='--')
-            ax.legend()
-            ax.set_xlabel("Distance (nm)")
-            ax.set_ylabel("Energy (kJ/mol)")
-            ax.grid()
-            fig.tight_layout()
-            fig.savefig("{}-{}_bond_energies.jpg".format(atomtype_i, atomtype_j))
-            plt.close(fig)
+    def _bond_parameters_from_histogram(self, all_probabilities, bins,
+            atomtype_i, atomtype_j, plot=False):
+        """ Boltzmann invert a bond length distribution and fit 
 
+        Parameters
+        ---------
+        all_probabilities : np.ndarray (n_bins,)
+            Probability densities
+        bins : np.ndarray (n_bins+1,)
+            Bin edges
+        atomtype_i : str
+        atomtype_j : str
+        plot : boolean
+            Render the distribution and energies to jpgs
 
-        return bonded_parameters
+        Returns
+        -------
+        bonded_parameters : dict
+            force_constant, x0, r_squared, fallback
+        """
+        histograms = OrderedDict([((atomtype_i, atomtype_j), 
+            (all_probabilities, bins))])
+        return self._bond_parameters_from_histograms(histograms, 
+                plot=plot)[(atomtype_i, atomtype_j)]
+
+    def _bond_parameters_from_histograms(self, histograms, plot=False):
+        """ Fit every bond length distribution in one batch
+
+        Parameters
+        ---------
+        histograms : OrderedDict
+            (atomtype_i, atomtype_j) : (probability densities, bin edges)
+        plot : boolean
+            Render the distributions and energies to jpgs
+
+        Returns
+        -------
+        all_bond_parameters : OrderedDict
+            (atomtype_i, atomtype_j) : force_constant, x0, r_squared, fallback
+        """
+        all_distances = [0.5 * (bins[1:] + bins[:-1]) 
+                for (all_probabilities, bins) in histograms.values()]
+        all_parameters = self.fit_gaussians(all_distances, 
+                [all_probabilities for (all_probabilities, bins) in 
+                    histograms.values()])
+
+        all_bond_parameters = OrderedDict()
+        for ((atomtype_i, atomtype_j), (all_probabilities, bins)), distances, \
+                bonded_parameters in zip(histograms.items(), all_distances, 
+                        all_parameters):
+            if plot:
+                plot_distribution(bins, all_probabilities, 
+                        "{}-{}_bond_distribution.jpg".format(atomtype_i, atomtype_j),
+                        xlabel="Distance (nm)", ylabel="Frequency density")
+                predicted_energies = self.harmonic_energy(distances, 
+                        bonded_parameters['x0'], bonded_parameters['force_constant'])
+                plot_energies(distances, predicted_energies, 
+                        self.boltzmann_invert(all_probabilities),
+                        "{}-{}_bond_energies.jpg".format(atomtype_i, atomtype_j),
+                        xlabel="Distance (nm)")
+            all_bond_parameters[(atomtype_i, atomtype_j)] = bonded_parameters
+        return all_bond_parameters
     
     
     
@@ -345,164 +986,427 @@ class State(object):
     
         Notes
         -----
-        Considers both angles i-j-k and k-j-i
+        Considers both angles i-j-k and k-j-i.
+        Atom names must match the atomtypes exactly
     
         """
     
-        all_triplets = []
-        #participating_bonds = []
-        if len([(i,j) for i,j in self.traj.topology.bonds]) == 0:
+        if self._angle_histograms is not None:
+            histogram = self._angle_histograms.get((min(atomtype_i, atomtype_k),
+                atomtype_j, max(atomtype_i, atomtype_k)))
+            if histogram is None:
+                return None
+            return self._angle_parameters_from_histogram(histogram.density(),
+                    histogram.bins, atomtype_i, atomtype_j, atomtype_k, plot=plot)
+
+        if len([(i,j) for i,j in self.topology.bonds]) == 0:
             sys.exit("No bonds detected, check your input files")
-        # Find all the central atoms 
-        central_atoms = [a.index for a in self.traj.topology.atoms if 
-                atomtype_j in a.name]
-        # For each central atom, try to build an i-j-k triplet
-        # by finding neighbors
-        for atom_j in central_atoms:
-            for atom_i, atom_k in itertools.product(self.bondgraph.neighbors(atom_j),repeat=2):
-                if atomtype_i in self.traj.topology.atom(atom_i).name and \
-                        atomtype_k in self.traj.topology.atom(atom_k).name and \
-                        atom_i != atom_k:
-                            all_triplets.append([atom_i, atom_j, atom_k])
+        triplets, type_codes, type_triples = self._angle_index()
+        names = self._atom_names
+        # Both orientations of the end types
+        matches = (names[triplets[:, 1]] == atomtype_j) & (
+                ((names[triplets[:, 0]] == atomtype_i) & 
+                 (names[triplets[:, 2]] == atomtype_k)) |
+                ((names[triplets[:, 0]] == atomtype_k) & 
+                 (names[triplets[:, 2]] == atomtype_i)))
+        all_triplets = triplets[matches]
             
         if len(all_triplets) == 0:
             return None
-    
+
+        if self.traj is None:
+            self.accumulate_distributions(data_ranges=True)
+            return self.compute_angle_parameters(atomtype_i, atomtype_j, 
+                    atomtype_k, plot=plot)
     
         # Compute angle between triplets
         all_angles_rad = np.asarray(mdtraj.compute_angles(self.traj, all_triplets))
+        return self._angle_parameters_from_angles(all_angles_rad, atomtype_i,
+                atomtype_j, atomtype_k, plot=plot)
+
+    @property
+    def _atom_names(self):
+        if self._atom_names_cache is None:
+            self._atom_names_cache = np.array([a.name for a in 
+                                               self.topology.atoms])
+        return self._atom_names_cache
+
+    def _angle_index(self):
+        """ Every i-j-k angle in the bond graph, labelled by its atom types
+
+        Returns
+        -------
+        triplets : np.ndarray (n_angles, 3)
+            Atom indices i, j, k of each angle, j is the central atom
+        type_codes : np.ndarray (n_angles,)
+            Index into type_triples of each angle
+        type_triples : list of (str, str, str)
+            Atom-type triples, end types alphabetically ordered
+
+        Notes
+        -----
+        Built once from bondgraph and cached, each angle appears once
+        """
+        if self._angle_index_cache is None:
+            triplets = [(atom_i, atom_j, atom_k) 
+                    for atom_j in self.bondgraph.nodes
+                    for atom_i, atom_k in itertools.combinations(
+                        sorted(self.bondgraph.neighbors(atom_j)), 2)]
+            triplets = np.array(triplets, dtype=int).reshape(-1, 3)
+            names = self._atom_names
+            labels = ["{0}\x00{1}\x00{2}".format(min(i, k), j, max(i, k))
+                      for (i, j, k) in names[triplets]]
+            unique_labels, type_codes = np.unique(labels, return_inverse=True)
+            type_triples = [tuple(label.split("\x00")) for label in unique_labels]
+            self._angle_index_cache = (triplets, type_codes, type_triples)
+        return self._angle_index_cache
+
+    def compute_all_angle_parameters(self, plot=False):
+        """
+        Calculate angle parameters for every triple of angle atomtypes
+
+        Returns
+        -------
+        all_angle_parameters : OrderedDict
+            (atomtype_i, atomtype_j, atomtype_k) : bonded parameters, 
+            as returned by compute_angle_parameters
+
+        Notes
+        -----
+        All angles come from one mdtraj.compute_angles call over the
+        precomputed angle index, then are grouped by type triple.
+        When streaming a trajfile, fits the accumulated histograms instead.
+        The histograms are kept in angle_histograms, later calls only refit
+
+        """
+        if self._angle_histograms is None:
+            if self.topology is None:
+                raise ValueError("No angle distributions were loaded and "
+                        "there is no trajectory to compute them from")
+            if len([(i,j) for i,j in self.topology.bonds]) == 0:
+                sys.exit("No bonds detected, check your input files")
+            if self.traj is None:
+                self.accumulate_distributions(data_ranges=True)
+            else:
+                triplets, type_codes, type_triples = self._angle_index()
+                all_angles_rad = mdtraj.compute_angles(self.traj, triplets)
+                # 51 bins, 50 probabilities
+                self._angle_histograms = OrderedDict((triple, 
+                    HistogramAccumulator.from_values(
+                        all_angles_rad[:, type_codes == code], n_bins=50))
+                    for code, triple in enumerate(type_triples))
+
+        histograms = OrderedDict((triple, (histogram.density(), histogram.bins))
+                for triple, histogram in self._angle_histograms.items())
+        return self._angle_parameters_from_histograms(histograms, plot=plot)
+
+    def _angle_parameters_from_angles(self, all_angles_rad, atomtype_i, 
+            atomtype_j, atomtype_k, plot=False):
+        """ Histogram angles, Boltzmann invert and fit 
+        
+        Parameters
+        ---------
+        all_angles_rad : np.ndarray
+            Angles of this type, every frame
+        atomtype_i : str
+        atomtype_j : str
+        atomtype_k : str
+        plot : boolean
     
-    
-        fig,ax =  plt.subplots(1,1)
+        Returns
+        -------
+        bonded_parameters : dict
+            force_constant, x0
+        """
         # 51 bins, 50 probabilities
-        vals, bins, patches = ax.hist([value for value in all_angles_rad.flatten() if not math.isnan(value)], 50, normed=1)
-        ax.set_xlabel("Angle (rad)")
-        ax.set_ylabel("Probability")
-        if plot:
-            plt.savefig("{}-{}-{}_angle_distribution.jpg".format(atomtype_i, atomtype_j, 
-            atomtype_k))
-            plt.close()
-    
-    
-        # Need to compute energies from the probabilities
-        # For each probability, compute energy and assign it appropriately
-        all_energies = []
-        all_angles = []
-        all_probabilities = []
-    
-        for index, probability in enumerate(vals):
-            first_bin = bins[index]
-            second_bin = bins[index+1]
-            bin_width = second_bin - first_bin
-            if probability - 1e-6 <=0:
-                probability = 1e-6
-            angle = np.mean((bins[index], bins[index+1]))
-            scaled_probability = probability/np.sin(angle)
-            energy = -self._k_b * self._T * np.log(scaled_probability)
-            all_energies.append(energy)
-            all_angles.append(angle)
-            all_probabilities.append(scaled_probability)
-
-        if plot:
-            fig, ax = plt.subplots(1,1)
-            ax.plot(all_angles, all_probabilities, label="Scaled probabilities")
-            ax.set_xlabel("Angle (rad)")
-            ax.set_ylabel("Probability")
-            ax.legend()
-            plt.savefig("{}-{}-{}-scaled_probabilities.jpg".format(atomtype_i, atomtype_j, atomtype_k))
-            plt.close()
-
-        # Shift energies to positive numbers
-        min_shift = min(all_energies)
-        all_energies = [energy - min_shift for energy in all_energies]
-        min_index = np.argmin(all_energies)
-        
-        converged = False
-        i = 2
-        while not converged:
-            try:
-                #bonded_parameters = self.fit_to_gaussian(all_angles[min_index-i:min_index+i], all_energies[min_index-i:min_index+i])
-                if min_index + i >= 50 or min_index -i <=0:
-                        # Before fitting, may need to reflect energies about a particular angle
-                        mirror_angles = np.zeros_like(all_angles)
-                        mirror_energies = np.zeros_like(all_energies)
-                        mirror_probabilities = np.zeros_like(all_probabilities)
-                        for i, val in enumerate(all_angles):
-                            mirror_energies[i] = all_energies[-i-1]
-                            mirror_probabilities[i] = all_energies[-i-1]
-                            mirror_angles[i] = 2*all_angles[-1] - all_angles[-i-1]
-                    
-                        all_angles.extend(mirror_angles)
-                        all_energies.extend(mirror_energies)
-                        all_probabilities.extend(mirror_probabilities)
-                        bonded_parameters = self.fit_to_gaussian(all_angles, all_probabilities)
-                        converged=True
+        angles = all_angles_rad.flatten()
+        angles = angles[~np.isnan(angles)]
+        vals, bins = np.histogram(angles, 50, density=True)
+        return self._angle_parameters_from_histogram(vals, bins, atomtype_i,
+                atomtype_j, atomtype_k, plot=plot)
 
+    def _angle_parameters_from_histogram(self, vals, bins, atomtype_i, 
+            atomtype_j, atomtype_k, plot=False):
+        """ Boltzmann invert an angle distribution and fit 
 
-                else:
-                    bonded_parameters = self.fit_to_gaussian(all_angles[min_index-i:min_index+i], all_probabilities[min_index-i:min_index+i])
-                    if bonded_parameters['force_constant'] > 0.01:
-                        converged = True
-                    else:
-                        converged = False
-                        i += 1
-            except RuntimeError:
-                i+=1
-                converged = False
-
-                #try:
-                #    bonded_parameters = self.fit_to_gaussian(all_angles[min_index-i:min_index+i], all_energies[min_index-i:min_index+i], energy_fit=True)
-                #    if bonded_parameters['force_constant'] > 0.01:
-                #        converged = True
-                #    else: 
-                #        converged = False
-                #        i += 1
-                #except RuntimeError:
-                #    i += 1
-                #    if min_index + i >= 50 or min_index -i <=0:
-                #        # Before fitting, may need to reflect energies about a particular angle
-                #        mirror_angles = np.zeros_like(all_angles)
-                #        mirror_energies = np.zeros_like(all_energies)
-                #        mirror_probabilities = np.zeros_like(all_probabilities)
-                #        for i, val in enumerate(all_angles):
-                #            mirror_energies[i] = all_energies[-i-1]
-                #            mirror_probabilities[i] = all_energies[-i-1]
-                #            mirror_angles[i] = 2*all_angles[-1] - all_angles[-i-1]
-                #    
-                #        all_angles.extend(mirror_angles)
-                #        all_energies.extend(mirror_energies)
-                #        all_probabilities.extend(mirror_probabilities)
-
-                #        #bonded_parameters = self.fit_to_gaussian(all_angles, all_energies)
-                #        try:
-                #            bonded_parameters = self.fit_to_gaussian(all_angles, all_probabilities)
-                #            converged=True
-                #        except RuntimeError:
-                #            bonded_parameters = self.fit_to_gaussian(all_angles, all_energies, energy_fit=True)
-                #        converged = True
-
-        predicted_energies = self.harmonic_energy(all_angles, **bonded_parameters)
-        if plot:
-            fig, axarray = plt.subplots(2,1,sharex=True)
-            axarray[0].plot(all_angles, predicted_energies, c='darkgray', label="Predicted")
-            axarray[1].plot(all_angles, all_energies, c='black', label="Target")
-            axarray[0].legend()
-            axarray[1].legend()
-            axarray[1].set_xlabel("Angle (rad)")
-            axarray[0].set_ylabel("Energy (kJ/mol)")
-            axarray[1].set_ylabel("Energy (kJ/mol)")
-            plt.savefig("{}-{}-{}_angle_energies.jpg".format(atomtype_i, atomtype_j, atomtype_k))
-            plt.close()
-
-   
-        return bonded_parameters
+        Parameters
+        ---------
+        vals : np.ndarray (n_bins,)
+            Probability densities
+        bins : np.ndarray (n_bins+1,)
+            Bin edges (rad)
+        atomtype_i : str
+        atomtype_j : str
+        atomtype_k : str
+        plot : boolean
+            Render the distributions and energies to jpgs
+
+        Returns
+        -------
+        bonded_parameters : dict
+            force_constant, x0, r_squared, fallback
+        """
+        key = (atomtype_i, atomtype_j, atomtype_k)
+        return self._angle_parameters_from_histograms(
+                OrderedDict([(key, (vals, bins))]), plot=plot)[key]
+
+    def _angle_parameters_from_histograms(self, histograms, plot=False):
+        """ Fit every angle distribution in one batch
+
+        Parameters
+        ---------
+        histograms : OrderedDict
+            (atomtype_i, atomtype_j, atomtype_k) : (probability densities,
+            bin edges (rad))
+        plot : boolean
+            Render the distributions and energies to jpgs
+
+        Returns
+        -------
+        all_angle_parameters : OrderedDict
+            (atomtype_i, atomtype_j, atomtype_k) : force_constant, x0,
+            r_squared, fallback
+
+        Notes
+        -----
+        Probabilities are divided by the sin(angle) Jacobian. A
+        distribution peaking in its last two bins (e.g. near 180 degrees)
+        is reflected about its upper edge before fitting
+        """
+        all_angles = []
+        all_scaled = []
+        fit_angles = []
+        fit_probabilities = []
+        for (vals, bins) in histograms.values():
+            angles = 0.5 * (bins[1:] + bins[:-1])
+            scaled_probabilities = np.where(vals <= 1e-6, 1e-6, vals) / np.sin(angles)
+            all_angles.append(angles)
+            all_scaled.append(scaled_probabilities)
+            if np.argmax(scaled_probabilities) >= len(angles) - 2:
+                fit_angles.append(np.concatenate([angles, 
+                    2 * bins[-1] - angles[::-1]]))
+                fit_probabilities.append(np.concatenate([scaled_probabilities,
+                    scaled_probabilities[::-1]]))
+            else:
+                fit_angles.append(angles)
+                fit_probabilities.append(scaled_probabilities)
+        all_parameters = self.fit_gaussians(fit_angles, fit_probabilities)
+
+        all_angle_parameters = OrderedDict()
+        for ((atomtype_i, atomtype_j, atomtype_k), (vals, bins)), angles, \
+                scaled_probabilities, bonded_parameters in zip(
+                        histograms.items(), all_angles, all_scaled, 
+                        all_parameters):
+            if plot:
+                plot_distribution(bins, vals, 
+                        "{}-{}-{}_angle_distribution.jpg".format(atomtype_i, 
+                            atomtype_j, atomtype_k),
+                        xlabel="Angle (rad)", ylabel="Probability")
+                plot_distribution(bins, scaled_probabilities,
+                        "{}-{}-{}-scaled_probabilities.jpg".format(atomtype_i, 
+                            atomtype_j, atomtype_k),
+                        xlabel="Angle (rad)", ylabel="Probability")
+                predicted_energies = self.harmonic_energy(angles, 
+                        bonded_parameters['x0'], bonded_parameters['force_constant'])
+                plot_energies(angles, predicted_energies, 
+                        self.boltzmann_invert(scaled_probabilities),
+                        "{}-{}-{}_angle_energies.jpg".format(atomtype_i, atomtype_j, 
+                            atomtype_k),
+                        xlabel="Angle (rad)")
+            all_angle_parameters[(atomtype_i, atomtype_j, atomtype_k)] = \
+                    bonded_parameters
+        return all_angle_parameters
     
     
     
             
         
+    def _dihedral_index(self):
+        """ Every proper i-j-k-l dihedral in the bond graph, labelled by
+        its atom types
+
+        Returns
+        -------
+        quadruplets : np.ndarray (n_dihedrals, 4)
+            Atom indices i, j, k, l of each dihedral, j-k is the central bond
+        type_codes : np.ndarray (n_dihedrals,)
+            Index into type_quadruples of each dihedral
+        type_quadruples : list of (str, str, str, str)
+            Atom-type quadruples, read in whichever direction sorts first
+
+        Notes
+        -----
+        Built once from bondgraph and cached, each dihedral appears once.
+        A dihedral and its reverse are the same angle, so reading the
+        types backwards does not change the values
+        """
+        if self._dihedral_index_cache is None:
+            quadruplets = [(atom_i, atom_j, atom_k, atom_l)
+                    for atom_j, atom_k in self.bondgraph.edges
+                    for atom_i in self.bondgraph.neighbors(atom_j) 
+                    if atom_i != atom_k
+                    for atom_l in self.bondgraph.neighbors(atom_k)
+                    if atom_l != atom_j and atom_l != atom_i]
+            quadruplets = np.array(quadruplets, dtype=int).reshape(-1, 4)
+            names = self._atom_names
+            labels = ["\x00".join(min(tuple(types), tuple(types[::-1])))
+                      for types in names[quadruplets]]
+            unique_labels, type_codes = np.unique(labels, return_inverse=True)
+            type_quadruples = [tuple(label.split("\x00")) 
+                    for label in unique_labels]
+            self._dihedral_index_cache = (quadruplets, type_codes.reshape(-1),
+                    type_quadruples)
+        return self._dihedral_index_cache
+
+    def compute_dihedral_parameters(self, atomtype_i, atomtype_j, atomtype_k,
+            atomtype_l, n_terms=4, plot=False):
+        """
+        Calculate dihedral parameters from a trajectory
+
+        Parameters
+        ---------
+        atomtype_i : str
+        atomtype_j : str
+        atomtype_k : str
+        atomtype_l : str
+        n_terms : int
+            Number of cosine terms fit
+        plot : boolean
+
+        Returns
+        -------
+        dihedral_parameters : dict
+            As compute_all_dihedral_parameters, None if there are no
+            dihedrals of this type
+
+        Notes
+        -----
+        Considers both i-j-k-l and l-k-j-i
+        """
+        types = (atomtype_i, atomtype_j, atomtype_k, atomtype_l)
+        key = min(types, types[::-1])
+        return self.compute_all_dihedral_parameters(n_terms=n_terms, 
+                plot=plot, type_quadruples=[key]).get(key)
+
+    def compute_all_dihedral_parameters(self, n_terms=4, plot=False,
+            type_quadruples=None):
+        """
+        Calculate dihedral parameters for every quadruple of atomtypes
+
+        Parameters
+        ---------
+        n_terms : int
+            Number of cosine terms fit
+        plot : boolean
+        type_quadruples : list of (str, str, str, str), optional
+            Only fit these types
+
+        Returns
+        -------
+        all_dihedral_parameters : OrderedDict
+            (atomtype_i, atomtype_j, atomtype_k, atomtype_l) : dict of
+            force_constants, phases and multiplicities (np.ndarray 
+            (n_terms,)), constant, r_squared
+
+        Notes
+        -----
+        All dihedrals come from one mdtraj.compute_dihedrals call over
+        the precomputed dihedral index and are binned over [-pi, pi).
+        Each distribution is Boltzmann inverted and fit to
+        V(phi) = constant + sum_n force_constants[n-1] * cos(n*phi - phases[n-1]),
+        i.e. GROMACS proper dihedrals k(1 + cos(n*phi - phi_s)) up to a
+        constant. The histograms are kept in dihedral_histograms
+        """
+        if self._dihedral_histograms is None:
+            if self.topology is None:
+                # Loaded distributions without dihedrals, nothing to fit
+                return OrderedDict()
+            if self.traj is None:
+                self.accumulate_distributions(data_ranges=True)
+            else:
+                quadruplets, type_codes, all_quadruples = self._dihedral_index()
+                histograms = OrderedDict((quadruple, HistogramAccumulator(
+                    bin_range=(-np.pi, np.pi), n_bins=50)) 
+                    for quadruple in all_quadruples)
+                if len(quadruplets) > 0:
+                    dihedrals = wrap_dihedrals(mdtraj.compute_dihedrals(
+                        self.traj, quadruplets))
+                    for code, quadruple in enumerate(all_quadruples):
+                        histograms[quadruple].update(
+                                dihedrals[:, type_codes == code])
+                self._dihedral_histograms = histograms
+
+        if type_quadruples is None:
+            type_quadruples = list(self._dihedral_histograms)
+        histograms = OrderedDict((quadruple, 
+            (self._dihedral_histograms[quadruple].density(),
+             self._dihedral_histograms[quadruple].bins))
+            for quadruple in type_quadruples 
+            if quadruple in self._dihedral_histograms)
+        return self._dihedral_parameters_from_histograms(histograms, 
+                n_terms=n_terms, plot=plot)
+
+    def _dihedral_parameters_from_histograms(self, histograms, n_terms=4,
+            plot=False):
+        """ Boltzmann invert dihedral distributions and fit cosine series
+
+        Parameters
+        ---------
+        histograms : OrderedDict
+            (atomtype_i, atomtype_j, atomtype_k, atomtype_l) : 
+            (probability densities, bin edges (rad))
+        n_terms : int
+        plot : boolean
+            Render the distributions and energies to jpgs
+
+        Returns
+        -------
+        all_dihedral_parameters : OrderedDict
+
+        Notes
+        -----
+        The series is linear in its coefficients, so each fit is a
+        weighted linear least squares over the sampled bins, weighted by
+        sqrt(probability) so sparsely sampled bins count less
+        """
+        multiplicities = np.arange(1, n_terms + 1)
+        all_dihedral_parameters = OrderedDict()
+        for types, (probabilities, bins) in histograms.items():
+            dihedrals = 0.5 * (bins[1:] + bins[:-1])
+            energies = self.boltzmann_invert(probabilities)
+            sampled = probabilities > 0
+            design = np.column_stack([np.ones_like(dihedrals)] + 
+                    [np.cos(n * dihedrals) for n in multiplicities] +
+                    [np.sin(n * dihedrals) for n in multiplicities])
+            weights = np.sqrt(probabilities[sampled])
+            coefficients = np.linalg.lstsq(design[sampled] * weights[:, None],
+                    energies[sampled] * weights, rcond=None)[0]
+            cosines = coefficients[1:n_terms + 1]
+            sines = coefficients[n_terms + 1:]
+            predicted_energies = design.dot(coefficients)
+
+            residual = np.sum((energies[sampled] - predicted_energies[sampled])**2)
+            total = np.sum((energies[sampled] - energies[sampled].mean())**2)
+            r_squared = 1 - residual / total if total > 0 else 1.0
+
+            if plot:
+                name = "-".join(types)
+                plot_distribution(bins, probabilities,
+                        "{}_dihedral_distribution.jpg".format(name),
+                        xlabel="Dihedral (rad)", ylabel="Probability")
+                plot_energies(dihedrals[sampled], predicted_energies[sampled],
+                        energies[sampled], "{}_dihedral_energies.jpg".format(name),
+                        xlabel="Dihedral (rad)")
+            all_dihedral_parameters[types] = {
+                    'force_constants': np.hypot(cosines, sines),
+                    'phases': np.arctan2(sines, cosines),
+                    'multiplicities': multiplicities,
+                    'constant': coefficients[0],
+                    'r_squared': r_squared}
+        return all_dihedral_parameters
+
     def compute_rdf(self, atomtype_i, atomtype_j, output, 
-            bin_width=0.01, exclude_up_to=3, r_range=[0,2]):
+            bin_width=0.01, exclude_up_to=3, r_range=[0,2], method=None):
         """
         Compute RDF between pair of atoms, save to text
     
@@ -532,11 +1436,511 @@ class State(object):
         """
 
 
-        pairs = self.traj.topology.select_pairs("name '{0}'".format(atomtype_i),
-                                 "name '{0}'".format(atomtype_j))
-        if exclude_up_to is not None:
-            to_delete = find_1_n_exclusions(self.traj.topology, pairs, exclude_up_to)
-            pairs = np.delete(pairs, to_delete, axis=0)
-        (first, second) = mdtraj.compute_rdf(self.traj, pairs, r_range=r_range, bin_width=bin_width)
+        rdf = self.accumulate_rdf(atomtype_i, atomtype_j, bin_width=bin_width,
+                exclude_up_to=exclude_up_to, r_range=r_range, method=method)
+        (first, second) = rdf.rdf()
         np.savetxt('{}.txt'.format(output), np.column_stack([first,second]))
-    
+
+    def accumulate_rdf(self, atomtype_i, atomtype_j, bin_width=0.01,
+            exclude_up_to=3, r_range=[0,2], method=None):
+        """ Pair-distance histogram between two atomtypes over the trajectory
+
+        Parameters
+        ---------
+        atomtype_i : str
+        atomtype_j : str
+        bin_width : float
+        exclude_up_to : int
+        r_range : list (float, float)
+        method : str, optional
+            'cell_list' or 'pairs', see compute_all_rdfs
+
+        Returns
+        -------
+        rdf : RDFAccumulator
+            Same bins and normalization as mdtraj.compute_rdf
+
+        Notes
+        -----
+        Fed one chunk at a time when streaming a trajfile
+        """
+        return self.compute_all_rdfs([(atomtype_i, atomtype_j)], 
+                bin_width=bin_width, exclude_up_to=exclude_up_to, 
+                r_range=r_range, n_workers=1, method=method)[
+                        (atomtype_i, atomtype_j)]
+
+    def exclusion_matrix(self, exclude_up_to=3):
+        """ Atom pairs fewer than exclude_up_to bonds apart
+
+        Parameters
+        ---------
+        exclude_up_to : int
+            exclude_up_to=3 excludes 1-1, 1-2 and 1-3 pairs
+
+        Returns
+        -------
+        exclusions : scipy.sparse.csr_matrix (n_atoms, n_atoms), dtype=bool
+            Symmetric, the diagonal is set
+
+        Notes
+        -----
+        Same criterion as msibi find_1_n_exclusions. Built once per
+        exclude_up_to from powers of the bond adjacency matrix, 
+        (I + A)^(exclude_up_to-1), and cached
+        """
+        if exclude_up_to < 3:
+            raise ValueError('n must be at least 3')
+        if exclude_up_to not in self._exclusion_cache:
+            n_atoms = self.topology.n_atoms
+            bonds, _, _ = self._bond_index()
+            adjacency = sparse.coo_matrix((np.ones(len(bonds)), 
+                (bonds[:, 0], bonds[:, 1])), shape=(n_atoms, n_atoms))
+            step = (adjacency + adjacency.T + 
+                    sparse.identity(n_atoms, format='csr')).tocsr()
+            step.data[:] = 1
+            exclusions = sparse.identity(n_atoms, format='csr')
+            for _ in range(exclude_up_to - 1):
+                exclusions = exclusions.dot(step)
+                exclusions.data[:] = 1
+            exclusions = exclusions.astype(bool)
+            exclusions.sort_indices()
+            self._exclusion_cache[exclude_up_to] = exclusions
+        return self._exclusion_cache[exclude_up_to]
+
+    def _excluded_pair_keys(self, exclude_up_to):
+        """ Sorted keys i*n_atoms + j of every pair in exclusion_matrix """
+        exclusions = self.exclusion_matrix(exclude_up_to)
+        n_atoms = exclusions.shape[0]
+        rows = np.repeat(np.arange(n_atoms, dtype=np.int64), 
+                np.diff(exclusions.indptr))
+        return rows * n_atoms + exclusions.indices
+
+    def compute_all_rdfs(self, type_pairs, output=None, bin_width=0.01,
+            exclude_up_to=3, r_range=[0,2], n_workers=None, method=None):
+        """ Compute RDFs between many pairs of atomtypes in one pass
+
+        Parameters
+        ---------
+        type_pairs : list of (str, str)
+        output : str, optional
+            Each RDF is saved to '{atomtype_i}-{atomtype_j}-{output}.txt'
+            once all are computed
+        bin_width : float
+        exclude_up_to : int
+        r_range : list (float, float)
+        n_workers : int, optional
+            Size of the process pool, defaults to the number of cpus
+        method : str, optional
+            'cell_list' bins only pairs within r_range[1] found through a
+            periodic cell list, 'pairs' builds every pair explicitly
+            for mdtraj.compute_distances. Defaults to 'cell_list' for
+            orthorhombic boxes longer than 3*r_range[1], 'pairs' otherwise
+
+        Returns
+        -------
+        all_rdfs : OrderedDict
+            (atomtype_i, atomtype_j) : RDFAccumulator
+
+        Notes
+        -----
+        Pair lists are built once and every type pair shares the cached
+        exclusion_matrix. Each
+        chunk of frames is split between the workers, which histogram
+        every type pair, so the work scales with cores rather than
+        with the number of pairs. Both methods give the same RDFs as
+        mdtraj.compute_rdf over the non-excluded pairs
+        """
+        if n_workers is None:
+            n_workers = cpu_count()
+        type_pairs = [tuple(pair) for pair in type_pairs]
+        names = self._atom_names
+        n_atoms = self.topology.n_atoms
+        type_atoms = {name: np.flatnonzero(names == name) 
+                for pair in type_pairs for name in pair}
+
+        if exclude_up_to is not None:
+            excluded = self._excluded_pair_keys(exclude_up_to)
+        else:
+            excluded = np.zeros(0, dtype=np.int64)
+        if method is None:
+            method = self._default_rdf_method(r_range[1])
+
+        if method == 'cell_list':
+            pair_sets = [(type_atoms[atomtype_i], type_atoms[atomtype_j])
+                    for atomtype_i, atomtype_j in type_pairs]
+            n_pairs = [_rdf_pair_count(atoms_i, atoms_j, excluded, n_atoms)
+                    for atoms_i, atoms_j in pair_sets]
+        elif method == 'pairs':
+            pair_sets = []
+            for atomtype_i, atomtype_j in type_pairs:
+                pairs = self.topology.select_pairs(type_atoms[atomtype_i],
+                        type_atoms[atomtype_j])
+                if len(pairs) > 0:
+                    keys = pairs[:, 0].astype(np.int64) * n_atoms + pairs[:, 1]
+                    pairs = pairs[~np.isin(keys, excluded)]
+                pair_sets.append(pairs)
+            n_pairs = [len(pairs) for pairs in pair_sets]
+        else:
+            raise ValueError("Unknown RDF method '{}'".format(method))
+
+        n_bins = int((r_range[1] - r_range[0]) / bin_width)
+        all_rdfs = OrderedDict((pair, RDFAccumulator(bin_range=r_range, 
+            n_bins=n_bins, n_pairs=pair_count)) 
+            for pair, pair_count in zip(type_pairs, n_pairs))
+
+        bins = np.linspace(r_range[0], r_range[1], n_bins + 1)
+        initargs = (self.topology, pair_sets, excluded, bins, method)
+        if n_workers > 1:
+            pool = Pool(processes=n_workers, initializer=_init_rdf_worker,
+                    initargs=initargs)
+        else:
+            _init_rdf_worker(*initargs)
+        try:
+            for traj_chunk in self._iter_chunks():
+                blocks = [(traj_chunk.xyz[frames], 
+                           traj_chunk.unitcell_vectors[frames]) 
+                          for frames in np.array_split(
+                              np.arange(traj_chunk.n_frames), n_workers)
+                          if len(frames) > 0]
+                if n_workers > 1:
+                    block_counts = pool.map(_rdf_counts, blocks)
+                else:
+                    block_counts = [_rdf_counts(block) for block in blocks]
+                for index, (pair, pair_count) in enumerate(zip(type_pairs, n_pairs)):
+                    all_rdfs[pair].add_counts(
+                            np.sum([counts[index] for counts in block_counts], 
+                                axis=0),
+                            traj_chunk.unitcell_volumes, n_pairs=pair_count)
+        finally:
+            if n_workers > 1:
+                pool.close()
+                pool.join()
+
+        self._rdf_histograms.update(all_rdfs)
+        if output is not None:
+            self.write_rdfs(output, all_rdfs)
+        return all_rdfs
+
+    def write_rdfs(self, output, rdf_histograms=None):
+        """ Save RDFs to '{atomtype_i}-{atomtype_j}-{output}.txt'
+
+        Parameters
+        ---------
+        output : str
+        rdf_histograms : OrderedDict, optional
+            Defaults to every RDF computed or loaded so far
+        """
+        if rdf_histograms is None:
+            rdf_histograms = self._rdf_histograms
+        for (atomtype_i, atomtype_j), rdf in rdf_histograms.items():
+            (first, second) = rdf.rdf()
+            np.savetxt('{}-{}-{}.txt'.format(atomtype_i, atomtype_j, output),
+                    np.column_stack([first,second]))
+
+    def source_hash(self):
+        """ SHA1 of the trajectory the distributions come from
+
+        Hashes the trajectory and topology files when streaming, 
+        otherwise the coordinates, box and atom names of traj
+        """
+        if self._source_hash is None:
+            sha = hashlib.sha1()
+            if self.traj is not None:
+                sha.update(np.ascontiguousarray(self.traj.xyz).tobytes())
+                if self.traj.unitcell_vectors is not None:
+                    sha.update(np.ascontiguousarray(
+                        self.traj.unitcell_vectors).tobytes())
+                sha.update("\x00".join(self._atom_names).encode())
+            else:
+                for filename in (self.trajfile, self._top):
+                    if filename is None:
+                        continue
+                    with open(filename, 'rb') as f:
+                        for block in iter(lambda: f.read(1 << 20), b''):
+                            sha.update(block)
+            self._source_hash = sha.hexdigest()
+        return self._source_hash
+
+    def save_distributions(self, filename):
+        """ Write every computed bond, angle and RDF histogram to one .npz
+
+        Parameters
+        ---------
+        filename : str
+
+        Notes
+        -----
+        Stores bin edges, counts and sample counts of each bond, angle,
+        dihedral and RDF distribution,
+        plus the RDF normalization and source_hash. Reload with
+        State.from_distributions or load_distributions to refit
+        """
+        histograms_io.save_distributions(filename, 
+                bond_histograms=self._bond_histograms,
+                angle_histograms=self._angle_histograms,
+                rdf_histograms=self._rdf_histograms,
+                source_hash=self.source_hash(),
+                dihedral_histograms=self._dihedral_histograms)
+        print("Wrote distributions to {}".format(filename))
+
+    def load_distributions(self, filename):
+        """ Replace this State's distributions with those in filename """
+        bond_histograms, angle_histograms, rdf_histograms, source_hash, \
+                dihedral_histograms = histograms_io.load_distributions(filename)
+        # Saved but empty sections stay empty, only unsaved ones are None
+        self._bond_histograms = bond_histograms
+        self._angle_histograms = angle_histograms
+        self._dihedral_histograms = dihedral_histograms
+        self._rdf_histograms = rdf_histograms if rdf_histograms is not None \
+                else OrderedDict()
+        self._source_hash = source_hash
+
+    def rebin_distributions(self, n_bins):
+        """ Merge neighboring bins of the bond, angle and dihedral
+        histograms down to n_bins, e.g. to refit loaded distributions
+
+        Parameters
+        ---------
+        n_bins : int
+            Must divide the number of bins of every histogram
+        """
+        for attribute in ('_bond_histograms', '_angle_histograms',
+                '_dihedral_histograms'):
+            histograms = getattr(self, attribute)
+            if histograms is None:
+                continue
+            for key, histogram in histograms.items():
+                if histogram.n_bins % n_bins != 0:
+                    raise ValueError("{} has {} bins, which cannot be merged "
+                        "into {}".format("-".join(key), histogram.n_bins, 
+                            n_bins))
+            setattr(self, attribute, OrderedDict((key, 
+                histogram.rebin(histogram.n_bins // n_bins))
+                for key, histogram in histograms.items()))
+
+    @classmethod
+    def from_distributions(cls, filename, k_b=8.314e-3, T=305):
+        """ State without a trajectory, fitting saved distributions
+
+        Parameters
+        ---------
+        filename : str
+            Written by save_distributions
+        k_b : float
+        T : float
+
+        Returns
+        -------
+        State
+        """
+        state = cls(k_b=k_b, T=T)
+        state.load_distributions(filename)
+        return state
+
+
+class ReplicaState(State):
+    """ State over several independent replicas of the same system
+
+    Parameters
+    ---------
+    k_b : float
+        Boltzmann constant
+    T : float
+        Temperature
+    trajfiles : list of str
+        One trajectory file per replica, all sharing one topology
+    top : str, optional
+        Topology file for the trajfiles
+    chunk : int
+        Frames per chunk when streaming each replica
+
+    Notes
+    -----
+    Replicas are never concatenated: accumulate_distributions streams
+    each one in its own process and merges the histograms, so the
+    compute_*_parameters methods fit the pooled distributions exactly
+    as a State does. compute_replica_spread fits every replica on its
+    own to show how much the parameters vary between them.
+    RDFs stream the replicas one after the other
+
+    """
+
+    def __init__(self, k_b=8.314e-3, T=305, trajfiles=None, top=None,
+            chunk=1000):
+        if not trajfiles:
+            raise ValueError("ReplicaState needs at least one trajectory file")
+        self._trajfiles = list(trajfiles)
+        self._replica_histograms = None
+        super(ReplicaState, self).__init__(k_b=k_b, T=T, 
+                trajfile=self._trajfiles[0], top=top, chunk=chunk)
+
+    @property
+    def trajfiles(self):
+        return self._trajfiles
+
+    @property
+    def replica_histograms(self):
+        return self._replica_histograms
+
+    def _set_topology(self, topology):
+        super(ReplicaState, self)._set_topology(topology)
+        self._replica_histograms = None
+
+    def __str__(self):
+        return("k_B = {} \nT = {}\ntraj = {} replicas (streamed, chunk={})".format(
+            self.k_b, self.T, len(self.trajfiles), self.chunk))
+
+    def _iter_chunks(self):
+        """ Chunks of every replica in turn """
+        for trajfile in self.trajfiles:
+            for traj_chunk in mdtraj.iterload(trajfile, top=self._top,
+                    chunk=self.chunk):
+                yield traj_chunk
+
+    def accumulate_distributions(self, bond_range=None, angle_range=None,
+            n_bins=50, n_workers=None, data_ranges=False):
+        """ Histogram every replica in parallel and merge the histograms
+
+        Parameters
+        ---------
+        bond_range : tuple (float, float) or dict, optional
+        angle_range : tuple (float, float) or dict, optional
+            As for State.accumulate_distributions, required unless 
+            data_ranges is set
+        n_bins : int
+        n_workers : int, optional
+            Size of the process pool, defaults to the number of cpus,
+            never more than the number of replicas
+        data_ranges : boolean
+            Find missing ranges with a first parallel pass over every
+            replica, spanning all of them so the replica histograms
+            share their bins
+
+        Returns
+        -------
+        bond_histograms : OrderedDict
+        angle_histograms : OrderedDict
+        dihedral_histograms : OrderedDict
+            Summed over the replicas, as State.accumulate_distributions
+
+        Notes
+        -----
+        The per-replica histograms are kept in replica_histograms
+        """
+        if n_workers is None:
+            n_workers = cpu_count()
+        n_workers = max(1, min(n_workers, len(self.trajfiles)))
+        pool = Pool(processes=n_workers) if n_workers > 1 else None
+        map_replicas = pool.map if pool is not None else \
+                (lambda f, replicas: [f(replica) for replica in replicas])
+        if not data_ranges:
+            self._check_ranges(bond_range, angle_range)
+        try:
+            if data_ranges and (bond_range is None or angle_range is None):
+                all_ranges = map_replicas(_replica_ranges, [(trajfile, 
+                    self._top, self.chunk) for trajfile in self.trajfiles])
+                if bond_range is None:
+                    bond_range = OrderedDict((pair, span_range(*extent))
+                        for pair, extent in _merge_ranges(
+                            [bonds for bonds, _ in all_ranges]).items())
+                if angle_range is None:
+                    angle_range = OrderedDict((triple, span_range(*extent))
+                        for triple, extent in _merge_ranges(
+                            [angles for _, angles in all_ranges]).items())
+            kwargs = dict(bond_range=bond_range, angle_range=angle_range,
+                    n_bins=n_bins)
+            replica_histograms = map_replicas(_replica_distributions, 
+                    [(trajfile, self._top, self.chunk, kwargs) 
+                        for trajfile in self.trajfiles])
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        self._bond_histograms = _merge_histograms(
+                [bonds for bonds, _, _ in replica_histograms])
+        self._angle_histograms = _merge_histograms(
+                [angles for _, angles, _ in replica_histograms])
+        self._dihedral_histograms = _merge_histograms(
+                [dihedrals for _, _, dihedrals in replica_histograms])
+        self._replica_histograms = replica_histograms
+        print("Merged distributions of {} replicas".format(len(self.trajfiles)))
+        return (self._bond_histograms, self._angle_histograms, 
+                self._dihedral_histograms)
+
+    def compute_replica_spread(self, n_terms=4):
+        """ Fit each replica separately and collect the force constants
+
+        Parameters
+        ---------
+        n_terms : int
+            Number of cosine terms of the dihedral fits
+
+        Returns
+        -------
+        spread : dict
+            'bonds', 'angles' and 'dihedrals', each an OrderedDict of
+            type : dict with the per-replica 'force_constant' and 'x0'
+            arrays (n_replicas,) and their 'force_constant_mean' and 
+            'force_constant_std'. Dihedrals hold 'force_constants'
+            (n_replicas, n_terms) and their mean and std per term
+
+        Notes
+        -----
+        The std is the sample standard deviation between replicas,
+        zero for a single replica. A type missing from a replica's
+        histograms gets NaN for that replica
+        """
+        if self._replica_histograms is None:
+            self.accumulate_distributions(data_ranges=True)
+        ddof = 1 if len(self.trajfiles) > 1 else 0
+
+        spread = {}
+        for kind, index, fit in (
+                ('bonds', 0, self._bond_parameters_from_histograms),
+                ('angles', 1, self._angle_parameters_from_histograms)):
+            all_parameters = [fit(OrderedDict((key, (histogram.density(), 
+                histogram.bins)) for key, histogram in histograms[index].items()))
+                for histograms in self._replica_histograms]
+            merged = (self._bond_histograms, self._angle_histograms)[index]
+            spread[kind] = OrderedDict()
+            for key in merged:
+                force_constants = np.array([parameters[key]['force_constant']
+                    if key in parameters else np.nan 
+                    for parameters in all_parameters])
+                x0 = np.array([parameters[key]['x0'] 
+                    if key in parameters else np.nan 
+                    for parameters in all_parameters])
+                spread[kind][key] = {'force_constant': force_constants, 
+                        'x0': x0,
+                        'force_constant_mean': np.nanmean(force_constants),
+                        'force_constant_std': np.nanstd(force_constants, 
+                            ddof=ddof)}
+
+        all_parameters = [self._dihedral_parameters_from_histograms(
+            OrderedDict((key, (histogram.density(), histogram.bins)) 
+                for key, histogram in dihedrals.items()), n_terms=n_terms)
+            for _, _, dihedrals in self._replica_histograms]
+        spread['dihedrals'] = OrderedDict()
+        for key in self._dihedral_histograms:
+            force_constants = np.array([parameters[key]['force_constants']
+                if key in parameters else np.full(n_terms, np.nan)
+                for parameters in all_parameters])
+            spread['dihedrals'][key] = {'force_constants': force_constants,
+                    'force_constants_mean': np.nanmean(force_constants, axis=0),
+                    'force_constants_std': np.nanstd(force_constants, axis=0,
+                        ddof=ddof)}
+        return spread
+
+    def source_hash(self):
+        """ SHA1 of every replica's trajectory file and the topology """
+        if self._source_hash is None:
+            sha = hashlib.sha1()
+            for filename in self.trajfiles + [self._top]:
+                if filename is None:
+                    continue
+                with open(filename, 'rb') as f:
+                    for block in iter(lambda: f.read(1 << 20), b''):
+                        sha.update(block)
+            self._source_hash = sha.hexdigest()
+        return self._source_hash
@@ -0,0 +1,443 @@
+import os
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+from lxml import etree
+
+from cg_mapping.hoomd_io import angles_from_bonds, bonded_types
+
+
+class ForceField(object):
+    """ Bead types with their bond and angle parameters, from a force
+    field XML in the foyer/OpenMM layout
+
+    Parameters
+    ---------
+    atom_types : OrderedDict
+        type name : dict of class, def, mass, charge, sigma, epsilon
+    bond_parameters : dict
+        (type or class, type or class) : (k, r0)
+    angle_parameters : dict
+        (type or class, ...) : (k, theta0)
+
+    Notes
+    -----
+    Read with `ForceField.from_xml`. Units are those of the file, for
+    foyer files kJ/mol, nm and rad. Bead names resolve to the atom type
+    whose def is '[_name]', or that is named 'name' or '_name'
+
+    """
+
+    def __init__(self, atom_types=None, bond_parameters=None,
+            angle_parameters=None):
+        self._atom_types = atom_types or OrderedDict()
+        self._bond_parameters = bond_parameters or {}
+        self._angle_parameters = angle_parameters or {}
+        self._by_def = {entry['def']: name
+                for name, entry in self._atom_types.items() if entry['def']}
+
+    @classmethod
+    def from_xml(cls, filename):
+        """ Parse AtomTypes, NonbondedForce, HarmonicBondForce and
+        HarmonicAngleForce from a force field XML """
+        root = etree.parse(filename).getroot()
+        atom_types = OrderedDict()
+        for atom_type in root.findall('AtomTypes/Type'):
+            name = atom_type.get('name')
+            atom_types[name] = {'class': atom_type.get('class', name),
+                    'def': atom_type.get('def', ''),
+                    'mass': float(atom_type.get('mass', 1.0)),
+                    'charge': 0.0, 'sigma': 0.0, 'epsilon': 0.0}
+        for atom in root.findall('NonbondedForce/Atom'):
+            if atom.get('type') not in atom_types:
+                raise ValueError("NonbondedForce refers to unknown type "
+                        "'{}' in {}".format(atom.get('type'), filename))
+            atom_types[atom.get('type')].update({
+                'charge': float(atom.get('charge', 0.0)),
+                'sigma': float(atom.get('sigma', 0.0)),
+                'epsilon': float(atom.get('epsilon', 0.0))})
+        bond_parameters = {_bonded_key(bond, 2):
+                (float(bond.get('k')), float(bond.get('length')))
+                for bond in root.findall('HarmonicBondForce/Bond')}
+        angle_parameters = {_bonded_key(angle, 3):
+                (float(angle.get('k')), float(angle.get('angle')))
+                for angle in root.findall('HarmonicAngleForce/Angle')}
+        return cls(atom_types=atom_types, bond_parameters=bond_parameters,
+                angle_parameters=angle_parameters)
+
+    @property
+    def atom_types(self):
+        return self._atom_types
+
+    @property
+    def bond_parameters(self):
+        return self._bond_parameters
+
+    @property
+    def angle_parameters(self):
+        return self._angle_parameters
+
+    def atom_type(self, beadtype):
+        """ Force field type of a CG bead name """
+        beadtype = beadtype.strip()
+        for name in (self._by_def.get('[_{}]'.format(beadtype.lstrip('_'))),
+                beadtype, '_' + beadtype):
+            if name in self._atom_types:
+                return name
+        raise ValueError("No atom type for bead '{}'".format(beadtype))
+
+    def _lookup(self, parameters, atom_types, kind):
+        classes = tuple(self._atom_types[name]['class'] for name in atom_types)
+        for key in (atom_types, atom_types[::-1], classes, classes[::-1]):
+            if key in parameters:
+                return parameters[key]
+        raise ValueError("No {} parameters for {}".format(kind,
+            "-".join(atom_types)))
+
+    def bond(self, atom_types):
+        """ (k, r0) of a bond between two atom types """
+        return self._lookup(self._bond_parameters, tuple(atom_types), 'bond')
+
+    def angle(self, atom_types):
+        """ (k, theta0) of an angle between three atom types """
+        return self._lookup(self._angle_parameters, tuple(atom_types), 'angle')
+
+    def __str__(self):
+        return "<ForceField with {} atom types, {} bonds, {} angles>".format(
+            len(self._atom_types), len(self._bond_parameters),
+            len(self._angle_parameters))
+
+def _bonded_key(element, n_atoms):
+    """ Type names of a bonded entry, class names if types are not given """
+    if element.get('type1') is not None:
+        return tuple(element.get('type{}'.format(i))
+                for i in range(1, n_atoms + 1))
+    return tuple(element.get('class{}'.format(i))
+            for i in range(1, n_atoms + 1))
+
+
+# Per-bead, per-bond and per-angle arrays of a typed topology
+_BEAD_FIELDS = ('atom_types', 'masses', 'charges', 'sigmas', 'epsilons')
+_BOND_FIELDS = ('bond_k', 'bond_r0')
+_ANGLE_FIELDS = ('angle_k', 'angle_theta0')
+
+
+class TypedTopology(object):
+    """ Atom types and bonded parameters of every bead, bond and angle
+
+    Parameters
+    ---------
+    atom_types : np.ndarray (n_beads,)
+        Force field type of every bead
+    masses, charges, sigmas, epsilons : np.ndarray (n_beads,)
+    bonds : np.ndarray (n_bonds, 2)
+    bond_k, bond_r0 : np.ndarray (n_bonds,)
+    angles : np.ndarray (n_angles, 3)
+    angle_k, angle_theta0 : np.ndarray (n_angles,)
+
+    Notes
+    -----
+    Used both for one molecule (a template, local bead indices) and
+    for a whole system stamped from templates. Type-level coefficient
+    tables are derived from the per-element arrays on demand
+
+    """
+
+    def __init__(self, atom_types=None, masses=None, charges=None, sigmas=None,
+            epsilons=None, bonds=None, bond_k=None, bond_r0=None, angles=None,
+            angle_k=None, angle_theta0=None):
+        self._atom_types = np.asarray(atom_types, dtype=str)
+        self._masses = np.asarray(masses, dtype=np.float64)
+        self._charges = np.asarray(charges, dtype=np.float64)
+        self._sigmas = np.asarray(sigmas, dtype=np.float64)
+        self._epsilons = np.asarray(epsilons, dtype=np.float64)
+        self._bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+        self._bond_k = np.asarray(bond_k, dtype=np.float64)
+        self._bond_r0 = np.asarray(bond_r0, dtype=np.float64)
+        self._angles = np.asarray(angles, dtype=np.int64).reshape(-1, 3)
+        self._angle_k = np.asarray(angle_k, dtype=np.float64)
+        self._angle_theta0 = np.asarray(angle_theta0, dtype=np.float64)
+
+    @classmethod
+    def from_molecule(cls, names=None, bonds=None, forcefield=None):
+        """ Type and parameterize one molecule
+
+        Parameters
+        ---------
+        names : np.ndarray (n_beads,)
+            Bead names of the molecule
+        bonds : np.ndarray (n_bonds, 2)
+            Bonds in local bead indices
+        forcefield : ForceField
+
+        Returns
+        -------
+        TypedTopology
+            Angles are every pair of bonds sharing a bead
+        """
+        atom_types = np.array([forcefield.atom_type(name) for name in names],
+                dtype=str)
+        entries = [forcefield.atom_types[name] for name in atom_types]
+        bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+        angles = angles_from_bonds(len(atom_types), bonds)
+        bond_parameters = np.array([forcefield.bond(pair)
+            for pair in atom_types[bonds]]).reshape(-1, 2)
+        angle_parameters = np.array([forcefield.angle(triple)
+            for triple in atom_types[angles]]).reshape(-1, 2)
+        return cls(atom_types=atom_types,
+                masses=[entry['mass'] for entry in entries],
+                charges=[entry['charge'] for entry in entries],
+                sigmas=[entry['sigma'] for entry in entries],
+                epsilons=[entry['epsilon'] for entry in entries],
+                bonds=bonds, bond_k=bond_parameters[:, 0],
+                bond_r0=bond_parameters[:, 1], angles=angles,
+                angle_k=angle_parameters[:, 0],
+                angle_theta0=angle_parameters[:, 1])
+
+    @property
+    def atom_types(self):
+        return self._atom_types
+
+    @property
+    def masses(self):
+        return self._masses
+
+    @property
+    def charges(self):
+        return self._charges
+
+    @property
+    def sigmas(self):
+        return self._sigmas
+
+    @property
+    def epsilons(self):
+        return self._epsilons
+
+    @property
+    def bonds(self):
+        return self._bonds
+
+    @property
+    def bond_k(self):
+        return self._bond_k
+
+    @property
+    def bond_r0(self):
+        return self._bond_r0
+
+    @property
+    def angles(self):
+        return self._angles
+
+    @property
+    def angle_k(self):
+        return self._angle_k
+
+    @property
+    def angle_theta0(self):
+        return self._angle_theta0
+
+    @property
+    def n_beads(self):
+        return len(self._atom_types)
+
+    def pair_coeffs(self):
+        """ OrderedDict atom type : (epsilon, sigma) """
+        types, first = np.unique(self._atom_types, return_index=True)
+        return OrderedDict((str(name), (self._epsilons[index],
+            self._sigmas[index])) for name, index in zip(types, first))
+
+    def _coeffs(self, groups, k, x0):
+        types, typeid = bonded_types(self._atom_types, groups)
+        first = np.unique(typeid, return_index=True)[1]
+        return types, typeid, OrderedDict((types[code], (k[index], x0[index]))
+                for code, index in zip(typeid[first], first))
+
+    def bond_types(self):
+        """ Bond type names, typeid of every bond and OrderedDict
+        type : (k, r0) """
+        return self._coeffs(self._bonds, self._bond_k, self._bond_r0)
+
+    def angle_types(self):
+        """ Angle type names, typeid of every angle and OrderedDict
+        type : (k, theta0) """
+        return self._coeffs(self._angles, self._angle_k, self._angle_theta0)
+
+    def replicate(self, n_copies):
+        """ n_copies of the topology, bead indices offset per copy """
+        offsets = self.n_beads * np.arange(n_copies, dtype=np.int64)
+        arrays = {field: np.tile(getattr(self, field), n_copies)
+                for field in _BEAD_FIELDS + _BOND_FIELDS + _ANGLE_FIELDS}
+        arrays['bonds'] = (self._bonds[np.newaxis] +
+                offsets[:, np.newaxis, np.newaxis]).reshape(-1, 2)
+        arrays['angles'] = (self._angles[np.newaxis] +
+                offsets[:, np.newaxis, np.newaxis]).reshape(-1, 3)
+        return TypedTopology(**arrays)
+
+    def __str__(self):
+        return "<TypedTopology with {} beads, {} bonds, {} angles>".format(
+            self.n_beads, len(self._bonds), len(self._angles))
+
+
+def build_templates(system=None, forcefield=None):
+    """ One TypedTopology per residue name, typed from its first residue
+
+    Parameters
+    ---------
+    system : CGSystem
+    forcefield : ForceField
+
+    Returns
+    -------
+    templates : OrderedDict
+        residue name : TypedTopology in local bead indices
+    """
+    residue_start = np.searchsorted(system.residues,
+            np.arange(system.n_residues + 1))
+    templates = OrderedDict()
+    for resname in np.unique(system.resnames):
+        residue = np.flatnonzero(system.resnames == resname)[0]
+        start, end = residue_start[residue], residue_start[residue + 1]
+        local = system.bonds[(system.bonds[:, 0] >= start) &
+                (system.bonds[:, 0] < end)] - start
+        templates[str(resname)] = TypedTopology.from_molecule(
+                names=system.names[start:end], bonds=local,
+                forcefield=forcefield)
+    return templates
+
+def stamp_templates(templates=None, system=None):
+    """ Typed topology of a whole system from per-molecule templates
+
+    Parameters
+    ---------
+    templates : OrderedDict
+        residue name : TypedTopology, as from build_templates
+    system : CGSystem
+
+    Returns
+    -------
+    TypedTopology
+        Bead arrays in the system's bead order, bonds and angles grouped
+        by residue name
+
+    Notes
+    -----
+    Every residue of a name gets its template's arrays at its own bead
+    offset, so no typing or parameter lookup happens per molecule
+    """
+    residue_start = np.searchsorted(system.residues,
+            np.arange(system.n_residues + 1))
+    bead_arrays = {field: np.zeros(system.n_beads) for field in _BEAD_FIELDS}
+    bead_arrays['atom_types'] = np.full(system.n_beads, None, dtype=object)
+    typed = np.zeros(system.n_beads, dtype=bool)
+    group_arrays = {field: [] for field in
+            ('bonds', 'angles') + _BOND_FIELDS + _ANGLE_FIELDS}
+    for resname, template in templates.items():
+        residues = np.flatnonzero(system.resnames == resname)
+        if len(residues) == 0:
+            continue
+        starts = residue_start[residues]
+        if np.any(residue_start[residues + 1] - starts != template.n_beads):
+            raise ValueError("Residues named {} do not all have {} beads".format(
+                resname, template.n_beads))
+        beads = (starts[:, np.newaxis] + np.arange(template.n_beads)).ravel()
+        for field in _BEAD_FIELDS:
+            bead_arrays[field][beads] = np.tile(getattr(template, field),
+                    len(residues))
+        typed[beads] = True
+        for field, width in (('bonds', 2), ('angles', 3)):
+            group_arrays[field].append((starts[:, np.newaxis, np.newaxis] +
+                getattr(template, field)).reshape(-1, width))
+        for field in _BOND_FIELDS + _ANGLE_FIELDS:
+            group_arrays[field].append(np.tile(getattr(template, field),
+                len(residues)))
+    if not np.all(typed):
+        raise ValueError("No template for residues {}".format(
+            sorted(set(system.resnames[system.residues[~typed]]))))
+    arrays = {field: np.concatenate(values) if values else np.zeros(0)
+            for field, values in group_arrays.items()}
+    arrays.update(bead_arrays)
+    arrays['atom_types'] = arrays['atom_types'].astype(str)
+    return TypedTopology(**arrays)
+
+def template_hash(forcefield_file=None, mapfiles=None):
+    """ Hash of the force field file and the mapping files """
+    sha = hashlib.sha1()
+    with open(forcefield_file, 'rb') as f:
+        sha.update(f.read())
+    for resname in sorted(mapfiles or {}):
+        sha.update(resname.encode())
+        with open(mapfiles[resname], 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+def save_templates(filename=None, templates=None, key=''):
+    """ Write per-molecule templates to a single .npz """
+    arrays = {'key': np.array(key), 'resnames': np.array(list(templates),
+        dtype=str)}
+    for index, template in enumerate(templates.values()):
+        for field in ('bonds', 'angles') + _BEAD_FIELDS + _BOND_FIELDS + \
+                _ANGLE_FIELDS:
+            arrays['{}_{}'.format(index, field)] = getattr(template, field)
+    np.savez(filename, **arrays)
+
+def load_templates(filename=None):
+    """ Read templates written by save_templates
+
+    Returns
+    -------
+    templates : OrderedDict
+    key : str
+    """
+    with np.load(filename) as data:
+        templates = OrderedDict()
+        for index, resname in enumerate(data['resnames']):
+            templates[str(resname)] = TypedTopology(**{field:
+                data['{}_{}'.format(index, field)] for field in
+                ('bonds', 'angles') + _BEAD_FIELDS + _BOND_FIELDS +
+                _ANGLE_FIELDS})
+        key = str(data['key'])
+    return templates, key
+
+def load_or_build_templates(system=None, forcefield_file=None, mapfiles=None,
+        cache_dir='.'):
+    """ Load typed templates from the cache, typing them on a miss
+
+    Parameters
+    ---------
+    system : CGSystem
+        Any system built from the mapping files, only one residue of
+        each name is typed
+    forcefield_file : str
+    mapfiles : dict
+        maps residue names to mapping files
+    cache_dir : str
+        Directory holding cg_templates_<hash>.npz files
+
+    Returns
+    -------
+    templates : OrderedDict
+        residue name : TypedTopology
+
+    Notes
+    -----
+    The cache file is named after template_hash, so editing the force
+    field or a mapping file misses the cache and retypes
+    """
+    key = template_hash(forcefield_file=forcefield_file, mapfiles=mapfiles)
+    filename = os.path.join(cache_dir, 'cg_templates_{}.npz'.format(key))
+    if os.path.isfile(filename):
+        templates, cached_key = load_templates(filename)
+        if cached_key == key and set(templates) >= set(system.resnames):
+            print("Loaded typed templates from {}".format(filename))
+            return templates
+
+    templates = build_templates(system=system,
+            forcefield=ForceField.from_xml(forcefield_file))
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    save_templates(filename=filename, templates=templates, key=key)
+    print("Wrote typed templates to {}".format(filename))
+    return templates
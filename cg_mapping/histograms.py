@@ -0,0 +1,336 @@
+from collections import OrderedDict
+
+import numpy as np
+
+
+def span_range(minimum, maximum):
+    """ Histogram range spanning values from minimum to maximum
+
+    As np.histogram picks it: (0, 1) without values (minimum > maximum),
+    widened by 0.5 on either side if all values are equal
+    """
+    if minimum > maximum:
+        return (0.0, 1.0)
+    if minimum == maximum:
+        return (float(minimum) - 0.5, float(maximum) + 0.5)
+    return (float(minimum), float(maximum))
+
+
+class HistogramAccumulator(object):
+    """ Fixed-bin histogram that is fed values incrementally
+
+    Parameters
+    ---------
+    bin_range : tuple (float, float)
+        Lower and upper edges of the histogram, values outside are dropped
+    n_bins : int
+    counts : np.ndarray (n_bins,), optional
+        Starting counts
+    n_samples : int, optional
+        Number of (non-NaN) values fed so far, including out-of-range ones
+
+    Notes
+    -----
+    Only the counts are stored, so memory does not grow with the number
+    of samples. Accumulators with the same bins can be merged, e.g. after
+    filling them in separate processes. Used for bond and angle
+    distributions
+
+    """
+
+    def __init__(self, bin_range=(0, 1), n_bins=50, counts=None, n_samples=0):
+        self._bins = np.linspace(bin_range[0], bin_range[1], int(n_bins) + 1)
+        if counts is None:
+            counts = np.zeros(int(n_bins), dtype=np.int64)
+        self._counts = np.asarray(counts, dtype=np.int64)
+        self._n_samples = int(n_samples)
+
+    @classmethod
+    def from_values(cls, values, n_bins=50):
+        """ Histogram spanning the values, binned as np.histogram(values, n_bins) """
+        values = np.asarray(values).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            histogram = cls(bin_range=span_range(np.inf, -np.inf), n_bins=n_bins)
+        else:
+            histogram = cls(bin_range=span_range(values.min(), values.max()),
+                    n_bins=n_bins)
+        histogram.update(values)
+        return histogram
+
+    @property
+    def bins(self):
+        return self._bins
+
+    @property
+    def bin_range(self):
+        return (float(self._bins[0]), float(self._bins[-1]))
+
+    @property
+    def n_bins(self):
+        return len(self._counts)
+
+    @property
+    def counts(self):
+        return self._counts
+
+    @property
+    def n_samples(self):
+        return self._n_samples
+
+    @property
+    def bin_centers(self):
+        return 0.5 * (self._bins[1:] + self._bins[:-1])
+
+    def update(self, values):
+        """ Add values (any shape) to the histogram, ignoring NaNs """
+        values = np.asarray(values).ravel()
+        values = values[~np.isnan(values)]
+        self._counts += np.histogram(values, bins=self._bins)[0]
+        self._n_samples += len(values)
+
+    def density(self):
+        """ Probability density over the binned (in-range) values """
+        total = self._counts.sum()
+        if total == 0:
+            return np.zeros(self.n_bins)
+        return self._counts / (total * np.diff(self._bins))
+
+    def rebin(self, factor):
+        """ New accumulator with every `factor` neighboring bins merged """
+        if self.n_bins % factor != 0:
+            raise ValueError("{} bins cannot be merged in groups of {}".format(
+                self.n_bins, factor))
+        return type(self)(bin_range=self.bin_range, n_bins=self.n_bins // factor,
+                counts=self._counts.reshape(-1, factor).sum(axis=1),
+                n_samples=self._n_samples)
+
+    def _check_compatible(self, other):
+        if type(self) is not type(other) or \
+                not np.array_equal(self._bins, other._bins):
+            raise ValueError("Can only merge accumulators with identical bins")
+
+    def merge(self, other):
+        """ New accumulator holding the counts of both """
+        self._check_compatible(other)
+        return type(self)(bin_range=self.bin_range, n_bins=self.n_bins,
+                counts=self._counts + other._counts,
+                n_samples=self._n_samples + other._n_samples)
+
+    def __add__(self, other):
+        return self.merge(other)
+
+    def __str__(self):
+        return "<{} with {} bins over {}, {} samples>".format(
+            type(self).__name__, self.n_bins, self.bin_range, self._n_samples)
+
+
+class RDFAccumulator(HistogramAccumulator):
+    """ Pair-distance histogram that normalizes to a radial distribution
+
+    Parameters
+    ---------
+    bin_range : tuple (float, float)
+        r_range of the RDF
+    n_bins : int
+    counts : np.ndarray (n_bins,), optional
+    n_samples : int, optional
+    n_pairs : int, optional
+        Number of pairs per frame, must be the same for every update
+    inverse_volume_sum : float, optional
+        Sum over frames of 1 / unitcell volume
+
+    Notes
+    -----
+    Normalized as mdtraj.compute_rdf, so accumulating a trajectory in
+    chunks gives the same g(r) as computing it in one go
+
+    """
+
+    def __init__(self, bin_range=(0, 2), n_bins=200, counts=None, n_samples=0,
+            n_pairs=None, inverse_volume_sum=0.0):
+        super(RDFAccumulator, self).__init__(bin_range=bin_range,
+                n_bins=n_bins, counts=counts, n_samples=n_samples)
+        self._n_pairs = n_pairs
+        self._inverse_volume_sum = float(inverse_volume_sum)
+
+    @property
+    def n_pairs(self):
+        return self._n_pairs
+
+    @property
+    def inverse_volume_sum(self):
+        return self._inverse_volume_sum
+
+    def update(self, distances, unitcell_volumes=None, n_pairs=None):
+        """ Add one chunk of pair distances
+
+        Parameters
+        ---------
+        distances : np.ndarray (n_frames, n_pairs)
+        unitcell_volumes : np.ndarray (n_frames,)
+        n_pairs : int, optional
+            Defaults to distances.shape[1]
+        """
+        if n_pairs is None:
+            n_pairs = np.shape(distances)[1]
+        if self._n_pairs is None:
+            self._n_pairs = n_pairs
+        elif self._n_pairs != n_pairs:
+            raise ValueError("Number of pairs changed between updates")
+        super(RDFAccumulator, self).update(distances)
+        self._inverse_volume_sum += np.sum(1.0 / np.asarray(unitcell_volumes))
+
+    def add_counts(self, counts, unitcell_volumes=None, n_pairs=None):
+        """ Add precomputed histogram counts of one chunk
+
+        Parameters
+        ---------
+        counts : np.ndarray (n_bins,)
+            Pair counts in each bin, summed over the chunk's frames
+        unitcell_volumes : np.ndarray (n_frames,)
+        n_pairs : int
+            Number of pairs per frame
+        """
+        if self._n_pairs is None:
+            self._n_pairs = n_pairs
+        elif self._n_pairs != n_pairs:
+            raise ValueError("Number of pairs changed between updates")
+        self._counts += np.asarray(counts, dtype=np.int64)
+        self._n_samples += int(np.sum(counts))
+        self._inverse_volume_sum += np.sum(1.0 / np.asarray(unitcell_volumes))
+
+    def rdf(self):
+        """ Radial distribution function
+
+        Returns
+        -------
+        r : np.ndarray (n_bins,)
+            Bin centers
+        g_r : np.ndarray (n_bins,)
+        """
+        edges = self._bins
+        shell_volumes = (4 / 3) * np.pi * (edges[1:]**3 - edges[:-1]**3)
+        norm = (self._n_pairs or 0) * self._inverse_volume_sum * shell_volumes
+        with np.errstate(invalid='ignore', divide='ignore'):
+            g_r = np.where(norm > 0, self._counts / norm, 0.0)
+        return self.bin_centers, g_r
+
+    def rebin(self, factor):
+        """ New accumulator with every `factor` neighboring bins merged """
+        histogram = super(RDFAccumulator, self).rebin(factor)
+        histogram._n_pairs = self._n_pairs
+        histogram._inverse_volume_sum = self._inverse_volume_sum
+        return histogram
+
+    def merge(self, other):
+        """ New accumulator holding the counts and volumes of both """
+        self._check_compatible(other)
+        if None not in (self._n_pairs, other._n_pairs) and \
+                self._n_pairs != other._n_pairs:
+            raise ValueError("Cannot merge RDFs over different pair sets")
+        return RDFAccumulator(bin_range=self.bin_range, n_bins=self.n_bins,
+                counts=self._counts + other._counts,
+                n_samples=self._n_samples + other._n_samples,
+                n_pairs=self._n_pairs if self._n_pairs is not None
+                    else other._n_pairs,
+                inverse_volume_sum=self._inverse_volume_sum +
+                    other._inverse_volume_sum)
+
+
+def _pack(histograms, prefix):
+    """ Flatten an OrderedDict of accumulators into named arrays """
+    histograms = list(histograms.items())
+    arrays = {prefix + '_types': np.array([list(key) for key, _ in histograms],
+                dtype=str),
+            prefix + '_n_bins': np.array([h.n_bins for _, h in histograms],
+                dtype=np.int64),
+            prefix + '_n_samples': np.array([h.n_samples for _, h in histograms],
+                dtype=np.int64)}
+    if histograms:
+        arrays[prefix + '_edges'] = np.concatenate([h.bins for _, h in histograms])
+        arrays[prefix + '_counts'] = np.concatenate([h.counts for _, h in histograms])
+    else:
+        arrays[prefix + '_edges'] = np.zeros(0)
+        arrays[prefix + '_counts'] = np.zeros(0, dtype=np.int64)
+    if prefix == 'rdf':
+        arrays['rdf_n_pairs'] = np.array([h.n_pairs or 0 for _, h in histograms],
+                dtype=np.int64)
+        arrays['rdf_inverse_volume_sum'] = np.array(
+                [h.inverse_volume_sum for _, h in histograms])
+    return arrays
+
+def _unpack(data, prefix):
+    """ OrderedDict of accumulators from arrays written by _pack, None
+    if the section was not saved """
+    if prefix + '_types' not in data:
+        return None
+    histograms = OrderedDict()
+    edge_start = 0
+    count_start = 0
+    for index, key in enumerate(data[prefix + '_types']):
+        n_bins = int(data[prefix + '_n_bins'][index])
+        edges = data[prefix + '_edges'][edge_start:edge_start + n_bins + 1]
+        counts = data[prefix + '_counts'][count_start:count_start + n_bins]
+        kwargs = dict(bin_range=(edges[0], edges[-1]), n_bins=n_bins,
+                counts=counts, n_samples=data[prefix + '_n_samples'][index])
+        if prefix == 'rdf':
+            histograms[tuple(str(name) for name in key)] = RDFAccumulator(
+                    n_pairs=int(data['rdf_n_pairs'][index]),
+                    inverse_volume_sum=data['rdf_inverse_volume_sum'][index],
+                    **kwargs)
+        else:
+            histograms[tuple(str(name) for name in key)] = \
+                    HistogramAccumulator(**kwargs)
+        edge_start += n_bins + 1
+        count_start += n_bins
+    return histograms
+
+def save_distributions(filename, bond_histograms=None, angle_histograms=None,
+        rdf_histograms=None, source_hash='', dihedral_histograms=None):
+    """ Write bond, angle and RDF accumulators to a single .npz
+
+    Parameters
+    ---------
+    filename : str
+    bond_histograms : OrderedDict
+        (atomtype_i, atomtype_j) : HistogramAccumulator
+    angle_histograms : OrderedDict
+        (atomtype_i, atomtype_j, atomtype_k) : HistogramAccumulator
+    rdf_histograms : OrderedDict
+        (atomtype_i, atomtype_j) : RDFAccumulator
+    source_hash : str
+        Identifies the trajectory the distributions came from
+    dihedral_histograms : OrderedDict
+        (atomtype_i, atomtype_j, atomtype_k, atomtype_l) : HistogramAccumulator
+
+    """
+    arrays = {'source_hash': np.array(source_hash)}
+    for prefix, histograms in (('bond', bond_histograms), 
+            ('angle', angle_histograms), ('dihedral', dihedral_histograms),
+            ('rdf', rdf_histograms)):
+        if histograms is not None:
+            arrays.update(_pack(histograms, prefix))
+    np.savez_compressed(filename, **arrays)
+
+def load_distributions(filename):
+    """ Read accumulators written by save_distributions
+
+    Returns
+    -------
+    bond_histograms : OrderedDict
+    angle_histograms : OrderedDict
+    rdf_histograms : OrderedDict
+    source_hash : str
+    dihedral_histograms : OrderedDict
+
+    Notes
+    -----
+    A section that was saved without any types loads as an empty
+    OrderedDict, a section that was not saved at all as None
+
+    """
+    with np.load(filename) as data:
+        return (_unpack(data, 'bond'), _unpack(data, 'angle'),
+                _unpack(data, 'rdf'), str(data['source_hash']),
+                _unpack(data, 'dihedral'))
@@ -0,0 +1,300 @@
+import io
+
+import numpy as np
+import mdtraj
+from lxml import etree
+
+from cg_mapping.cell_list import wrap_coordinates
+
+
+def angles_from_bonds(n_beads, bonds):
+    """ Every i-j-k angle between two bonds sharing bead j
+
+    Parameters
+    ---------
+    n_beads : int
+    bonds : np.ndarray (n_bonds, 2)
+
+    Returns
+    -------
+    angles : np.ndarray (n_angles, 3)
+        Bead indices i, j, k, grouped by central bead j
+
+    Notes
+    -----
+    Both bond directions are sorted by central bead; each bond is then
+    paired with the later bonds of the same bead by index arithmetic
+    """
+    bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+    centers = np.concatenate([bonds[:, 0], bonds[:, 1]])
+    neighbors = np.concatenate([bonds[:, 1], bonds[:, 0]])
+    order = np.lexsort((neighbors, centers))
+    centers, neighbors = centers[order], neighbors[order]
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(centers,
+        minlength=n_beads))))
+
+    # Number of later bonds around the same bead
+    positions = np.arange(len(centers))
+    n_later = indptr[centers + 1] - 1 - positions
+    first = np.repeat(positions, n_later)
+    second = first + 1 + np.arange(len(first)) - np.repeat(
+            np.cumsum(n_later) - n_later, n_later)
+    return np.column_stack([neighbors[first], centers[first],
+        neighbors[second]])
+
+def bonded_types(names, groups, type_table=None):
+    """ Type of every bond or angle from its bead types
+
+    Parameters
+    ---------
+    names : np.ndarray (n_beads,)
+        Bead type of every bead
+    groups : np.ndarray (n_groups, 2) or (n_groups, 3)
+        Bead indices of each bond or angle
+    type_table : dict, optional
+        (beadtype, ...) : type name, overriding the default
+        'beadtype-beadtype' names. Either direction may be given
+
+    Returns
+    -------
+    types : list of str
+        Unique type names
+    typeid : np.ndarray (n_groups,)
+        Index into types of each group
+
+    Notes
+    -----
+    Bead types are encoded as integers, so each group's type is one
+    integer key, read in whichever direction is smaller. Names are only
+    built for the unique keys
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    beadtypes, codes = np.unique(np.asarray(names, dtype=str),
+            return_inverse=True)
+    n_types = len(beadtypes)
+    if len(groups) == 0:
+        return [], np.zeros(0, dtype=np.int64)
+    group_codes = codes.reshape(-1)[groups]
+    powers = n_types ** np.arange(groups.shape[1] - 1, -1, -1, dtype=np.int64)
+    keys = np.minimum(group_codes.dot(powers), group_codes[:, ::-1].dot(powers))
+    unique_keys, typeid = np.unique(keys, return_inverse=True)
+
+    type_table = type_table or {}
+    types = []
+    for key in unique_keys:
+        group_types = tuple(str(beadtypes[(key // power) % n_types])
+                for power in powers)
+        name = type_table.get(group_types,
+                type_table.get(group_types[::-1], "-".join(group_types)))
+        types.append(name)
+    # Several keys may share a name through the table
+    types, remap = np.unique(types, return_inverse=True)
+    return list(types), remap.reshape(-1)[typeid.reshape(-1)]
+
+def hoomd_positions(xyz, box_lengths):
+    """ Coordinates wrapped into a box centered on the origin, as HOOMD expects """
+    box_lengths = np.asarray(box_lengths)
+    return wrap_coordinates(np.asarray(xyz), box_lengths) - box_lengths / 2
+
+def _rows(types, values, fmt):
+    """ Text block of one row per element, optionally led by a type name """
+    buffer = io.StringIO()
+    if types is None:
+        np.savetxt(buffer, values, fmt=fmt)
+    else:
+        np.savetxt(buffer, np.column_stack([types, values]), fmt='%s')
+    return "\n" + buffer.getvalue()
+
+def _typed_arrays(system, typed=None, type_table=None, angles=True):
+    """ Bead types, masses and typed bonds and angles to write
+
+    Returns
+    -------
+    dict
+        names, masses, bonds, bond_types, bond_typeid, angles,
+        angle_types, angle_typeid, and with a typed topology the
+        pair_coeffs, bond_coeffs and angle_coeffs tables
+    """
+    if typed is None:
+        arrays = {'names': system.names, 'masses': system.masses,
+                'bonds': system.bonds}
+        arrays['bond_types'], arrays['bond_typeid'] = bonded_types(
+                system.names, system.bonds, type_table=type_table)
+        if angles:
+            arrays['angles'] = angles_from_bonds(system.n_beads, system.bonds)
+            arrays['angle_types'], arrays['angle_typeid'] = bonded_types(
+                    system.names, arrays['angles'], type_table=type_table)
+    else:
+        if typed.n_beads != system.n_beads:
+            raise ValueError("Typed topology has {} beads, system has {}".format(
+                typed.n_beads, system.n_beads))
+        arrays = {'names': typed.atom_types, 'masses': typed.masses,
+                'bonds': typed.bonds, 'angles': typed.angles,
+                'pair_coeffs': typed.pair_coeffs()}
+        (arrays['bond_types'], arrays['bond_typeid'],
+                arrays['bond_coeffs']) = typed.bond_types()
+        (arrays['angle_types'], arrays['angle_typeid'],
+                arrays['angle_coeffs']) = typed.angle_types()
+    if not angles:
+        arrays['angles'] = np.zeros((0, 3), dtype=np.int64)
+        arrays['angle_types'], arrays['angle_typeid'] = [], np.zeros(0,
+                dtype=np.int64)
+        arrays.pop('angle_coeffs', None)
+    return arrays
+
+def _coeff_rows(coeffs):
+    """ Text block of one 'type value value' row per coefficient entry """
+    return "\n" + "".join("{} {!r} {!r}\n".format(name, float(a), float(b))
+            for name, (a, b) in coeffs.items())
+
+def write_hoomdxml(filename, system, type_table=None, angles=True,
+        typed=None):
+    """ Write a CGSystem as HOOMD XML
+
+    Parameters
+    ---------
+    filename : str
+    system : CGSystem
+    type_table : dict, optional
+        Bond and angle type names, see bonded_types
+    angles : boolean
+        Also write the angles between bonded beads
+    typed : forcefield.TypedTopology, optional
+        Force field types and parameters of the system's beads. Types,
+        masses, bonds and angles are taken from it, and pair_coeffs
+        (epsilon sigma), bond_coeffs (k r0) and angle_coeffs (k theta0)
+        blocks are written in the force field's units
+
+    Notes
+    -----
+    Lengths are in nm and masses in amu, positions are wrapped into
+    a box centered on the origin. Replaces the mbuild, parmed and
+    foyer round trip for writing CG systems
+    """
+    n_beads = system.n_beads
+    arrays = _typed_arrays(system, typed=typed, type_table=type_table,
+            angles=angles)
+    root = etree.Element('hoomd_xml', version='1.6')
+    configuration = etree.SubElement(root, 'configuration', time_step='0',
+            dimensions='3', natoms=str(n_beads))
+    lx, ly, lz = system.box_lengths
+    etree.SubElement(configuration, 'box', lx=repr(float(lx)),
+            ly=repr(float(ly)), lz=repr(float(lz)), xy='0', xz='0', yz='0')
+
+    blocks = [('position', n_beads, _rows(None, hoomd_positions(system.xyz,
+                system.box_lengths), '%.6f')),
+              ('type', n_beads, _rows(None, arrays['names'], '%s')),
+              ('mass', n_beads, _rows(None, arrays['masses'], '%.4f')),
+              ('body', n_beads, _rows(None, system.rigid_ids, '%d')),
+              ('bond', len(arrays['bonds']), _rows(np.asarray(
+                  arrays['bond_types'])[arrays['bond_typeid']],
+                  arrays['bonds'], None))]
+    if angles:
+        blocks.append(('angle', len(arrays['angles']), _rows(np.asarray(
+            arrays['angle_types'])[arrays['angle_typeid']], arrays['angles'],
+            None)))
+    for tag, num, text in blocks:
+        element = etree.SubElement(configuration, tag, num=str(num))
+        element.text = text if num > 0 else "\n"
+    for tag in ('pair_coeffs', 'bond_coeffs', 'angle_coeffs'):
+        if tag in arrays:
+            etree.SubElement(configuration, tag).text = _coeff_rows(arrays[tag])
+    etree.ElementTree(root).write(filename, pretty_print=True,
+            xml_declaration=True, encoding='UTF-8')
+
+def _gsd_frame(gsd_hoomd):
+    """ Empty frame, gsd.hoomd.Frame or Snapshot in older gsd """
+    if hasattr(gsd_hoomd, 'Frame'):
+        return gsd_hoomd.Frame()
+    return gsd_hoomd.Snapshot()
+
+def _frames(trajectory):
+    """ (xyz, box_lengths) of every frame of a trajectory or its chunks """
+    if isinstance(trajectory, mdtraj.Trajectory):
+        trajectory = [trajectory]
+    for chunk in trajectory:
+        for xyz, box_lengths in zip(chunk.xyz, chunk.unitcell_lengths):
+            yield xyz, box_lengths
+
+def write_gsd(filename, system, trajectory=None, type_table=None,
+        angles=True, typed=None):
+    """ Write a CGSystem, or a whole CG trajectory, as GSD
+
+    Parameters
+    ---------
+    filename : str
+    system : CGSystem
+        Topology and masses, and the only frame without a trajectory
+    trajectory : mdtraj Trajectory or iterable of them, optional
+        CG frames with the system's beads, e.g. the chunks yielded by
+        convert_traj_chunks, each written with its own box
+    type_table : dict, optional
+        Bond and angle type names, see bonded_types
+    angles : boolean
+    typed : forcefield.TypedTopology, optional
+        Force field types, masses and bonded types of the system's beads.
+        GSD has no place for the coefficients themselves
+
+    Returns
+    -------
+    n_frames : int
+        Frames written
+
+    Notes
+    -----
+    Needs the gsd package. Bead types, masses, bodies, bonds and angles
+    are only stored in the first frame; later frames hold positions and
+    the box, and GSD readers take the rest from frame 0.
+    Chunks are written as they arrive, so a streamed trajectory is never
+    held in memory
+    """
+    try:
+        import gsd.hoomd
+    except ImportError:
+        raise ImportError("write_gsd needs the gsd package, "
+                "or use write_hoomdxml")
+
+    if trajectory is None:
+        frames = [(system.xyz, system.box_lengths)]
+    else:
+        frames = _frames(trajectory)
+    mode = 'w' if hasattr(gsd.hoomd, 'Frame') else 'wb'
+    n_frames = 0
+    with gsd.hoomd.open(name=filename, mode=mode) as f:
+        for xyz, box_lengths in frames:
+            frame = _gsd_frame(gsd.hoomd)
+            frame.configuration.step = n_frames
+            frame.configuration.box = list(box_lengths) + [0, 0, 0]
+            frame.particles.N = system.n_beads
+            frame.particles.position = hoomd_positions(xyz,
+                    box_lengths).astype(np.float32)
+            if n_frames == 0:
+                _gsd_topology(frame, system, type_table=type_table,
+                        angles=angles, typed=typed)
+                first_frame = frame
+            else:
+                # Counts are always written, the groups come from frame 0
+                frame.bonds.N = first_frame.bonds.N
+                frame.angles.N = first_frame.angles.N
+            f.append(frame)
+            n_frames += 1
+    return n_frames
+
+def _gsd_topology(frame, system, type_table=None, angles=True, typed=None):
+    """ Fill in the particle types, masses, bodies, bonds and angles """
+    arrays = _typed_arrays(system, typed=typed, type_table=type_table,
+            angles=angles)
+    beadtypes, typeid = np.unique(arrays['names'], return_inverse=True)
+    frame.particles.types = list(beadtypes)
+    frame.particles.typeid = typeid.reshape(-1).astype(np.uint32)
+    frame.particles.mass = arrays['masses'].astype(np.float32)
+    frame.particles.body = system.rigid_ids.astype(np.int32)
+    frame.bonds.N = len(arrays['bonds'])
+    frame.bonds.types = arrays['bond_types']
+    frame.bonds.typeid = arrays['bond_typeid'].astype(np.uint32)
+    frame.bonds.group = arrays['bonds'].astype(np.uint32)
+    if angles:
+        frame.angles.N = len(arrays['angles'])
+        frame.angles.types = arrays['angle_types']
+        frame.angles.typeid = arrays['angle_typeid'].astype(np.uint32)
+        frame.angles.group = arrays['angles'].astype(np.uint32)
@@ -0,0 +1,156 @@
+import os
+import hashlib
+import pickle
+from collections import OrderedDict
+
+import numpy as np
+from scipy import sparse
+
+import cg_mapping.mapping_functions as mapping_functions
+from cg_mapping.bead_table import BeadTable
+from cg_mapping.mapping_operator import MappingOperator
+from cg_mapping.molecule_mapping import MoleculeMapping
+
+
+def mapping_hash(mapfiles=None, topol=None, water_bead_mapping=4):
+    """ Hash of the mapping files and the atomistic topology
+
+    Parameters
+    ---------
+    mapfiles : dict
+        maps residue names to mapping files
+    topol : mdtraj Topology
+        Atomistic topology
+    water_bead_mapping : int
+
+    Returns
+    -------
+    key : str
+        Hex digest, changes if any mapping file or the topology changes
+
+    """
+    sha = hashlib.sha1()
+    for resname in sorted(mapfiles):
+        sha.update(resname.encode())
+        with open(mapfiles[resname], 'rb') as f:
+            sha.update(f.read())
+    sha.update(str(water_bead_mapping).encode())
+    sha.update("\x00".join(residue.name for residue in topol.residues).encode())
+    sha.update(np.array([residue.n_atoms for residue in topol.residues],
+                        dtype=np.int64).tobytes())
+    sha.update("\x00".join("{} {}".format(atom.name,
+        atom.element.symbol if atom.element else '')
+        for atom in topol.atoms).encode())
+    sha.update(np.array([(atom_i.index, atom_j.index)
+                         for atom_i, atom_j in topol.bonds],
+                        dtype=np.int64).tobytes())
+    return sha.hexdigest()
+
+def save_compiled_mapping(filename=None, bead_table=None,
+        mapping_operator=None, key='', CG_topology=None):
+    """ Write a bead table, CG topology and mapping operator to a single .npz
+
+    The CG topology is pickled into a byte array, so loading it restores
+    the Topology without adding every chain, residue, atom and bond again
+    """
+    matrix = mapping_operator.matrix
+    if CG_topology is None:
+        CG_topology = mapping_functions.topology_from_bead_table(bead_table)
+    topology_bytes = np.frombuffer(pickle.dumps(CG_topology, 
+        protocol=pickle.HIGHEST_PROTOCOL), dtype=np.uint8)
+    np.savez(filename, key=np.array(key), topology=topology_bytes,
+             indptr=bead_table.indptr, indices=bead_table.indices,
+             beadtype_codes=bead_table.beadtype_codes,
+             beadtypes=bead_table.beadtypes,
+             resname_codes=bead_table.resname_codes,
+             resnames=bead_table.resnames, beadindex=bead_table.beadindex,
+             bonds=bead_table.bonds,
+             operator_data=matrix.data, operator_indices=matrix.indices,
+             operator_indptr=matrix.indptr,
+             operator_shape=np.array(matrix.shape),
+             operator_mapped=mapping_operator.mapped)
+
+def load_compiled_mapping(filename=None):
+    """ Read a bead table, CG topology and mapping operator from a .npz
+
+    Returns
+    -------
+    bead_table : BeadTable
+    CG_topology : mdtraj Topology
+    mapping_operator : MappingOperator
+    key : str
+
+    Notes
+    -----
+    Files written before the topology was stored rebuild it from the
+    bead table
+    """
+    with np.load(filename) as data:
+        bead_table = BeadTable(indptr=data['indptr'], indices=data['indices'],
+                beadtype_codes=data['beadtype_codes'],
+                beadtypes=data['beadtypes'],
+                resname_codes=data['resname_codes'], resnames=data['resnames'],
+                beadindex=data['beadindex'], bonds=data['bonds'])
+        matrix = sparse.csr_matrix((data['operator_data'],
+            data['operator_indices'], data['operator_indptr']),
+            shape=tuple(data['operator_shape']))
+        mapping_operator = MappingOperator(matrix=matrix,
+                mapped=data['operator_mapped'])
+        key = str(data['key'])
+        if 'topology' in data:
+            CG_topology = pickle.loads(data['topology'].tobytes())
+        else:
+            CG_topology = mapping_functions.topology_from_bead_table(bead_table)
+    return bead_table, CG_topology, mapping_operator, key
+
+def load_or_build(topol=None, mapfiles=None, water_bead_mapping=4,
+        cache_dir='.'):
+    """ Load a compiled mapping from the cache, building it on a miss
+
+    Parameters
+    ---------
+    topol : mdtraj Topology
+        Atomistic topology
+    mapfiles : dict
+        maps residue names to mapping files (.map, .xml or .npz)
+    water_bead_mapping : int
+    cache_dir : str
+        Directory holding cg_mapping_<hash>.npz files
+
+    Returns
+    -------
+    bead_table : BeadTable
+    CG_topology : mdtraj Topology
+    mapping_operator : MappingOperator
+
+    Notes
+    -----
+    The cache file is named after mapping_hash, so editing a mapping
+    file or changing the topology misses the cache and rebuilds
+
+    """
+    key = mapping_hash(mapfiles=mapfiles, topol=topol,
+            water_bead_mapping=water_bead_mapping)
+    filename = os.path.join(cache_dir, 'cg_mapping_{}.npz'.format(key))
+    if os.path.isfile(filename):
+        bead_table, CG_topology, mapping_operator, cached_key = \
+                load_compiled_mapping(filename)
+        if cached_key == key:
+            print("Loaded compiled mapping from {}".format(filename))
+            return bead_table, CG_topology, mapping_operator
+
+    all_CG_mappings = OrderedDict((resname, MoleculeMapping.load(mapfile))
+            for resname, mapfile in mapfiles.items())
+    bead_table, CG_topology = mapping_functions.build_CG_topology(topol=topol,
+            all_CG_mappings=all_CG_mappings,
+            water_bead_mapping=water_bead_mapping)
+    mapping_operator = MappingOperator.from_bead_table(bead_table=bead_table,
+            topol=topol)
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    save_compiled_mapping(filename=filename, bead_table=bead_table,
+            mapping_operator=mapping_operator, key=key, 
+            CG_topology=CG_topology)
+    print("Wrote compiled mapping to {}".format(filename))
+    return bead_table, CG_topology, mapping_operator
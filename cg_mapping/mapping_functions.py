@@ -3,6 +3,7 @@ import os
 import pdb
 import warnings
 import itertools
+import pickle
 from multiprocessing import Pool
 from collections import OrderedDict
 from optparse import OptionParser
@@ -13,6 +14,11 @@ import mdtraj
 
 import cg_mapping
 from cg_mapping.CG_bead import CG_bead
+from cg_mapping.bead_table import BeadTable
+from cg_mapping.mapping_operator import MappingOperator
+from cg_mapping.molecule_mapping import MoleculeMapping
+from cg_mapping.cell_list import (CellList, minimum_image, wrap_coordinates,
+                                  orthorhombic_box)
 
 def load_mapping(mapfile=None):
     """ Load a forward mapping
@@ -20,12 +26,13 @@ def load_mapping(mapfile=None):
     Parameters
     ----------
     mapfile : str
-        Path to mapping file
+        Path to mapping file, .map, .xml or .npz
 
     Returns
     -------
     mapping_dict : OrderedDict()
         OrderedDict (CG bead index : [beadtype, list of atom indices])
+    bonding_info : list of (str, str)
     
     Notes
     -----
@@ -35,61 +42,184 @@ def load_mapping(mapfile=None):
     col2: atom indices
 
     xml files are arranged by mapping > molecule > beads + bonds
+
+    npz files are written by MoleculeMapping.save. Use
+    MoleculeMapping.load directly to skip the dictionaries
         """
-    extension = mapfile[-4:]
-    if 'map' in extension:
-        return _load_map_file(mapfile=mapfile)
-    elif 'xml' in extension:
-        return _load_xml_file(mapfile=mapfile)
-    else:
-        sys.exit("Invalid mappingfile")
-
-def _load_map_file(mapfile=None):
-    """ Load from a .map file """
-    mapping_dict = OrderedDict()
-    bonding_info = []
-    with open(mapfile,'r') as f:
-        for line in f:
-            if line.rstrip():
-                if 'bond' in line.split(":")[0]:
-                    atom_i = line.split(":")[1].split()[0].rstrip()
-                    atom_j = line.split(":")[1].split()[1].rstrip()
-                    bonding_info.append((atom_i, atom_j))
-
-                else:
-                    atom_indices = [int(i) for i in line.split(":")[2].strip().split()]
-                    mapping_dict.update({line.split(":")[0].rstrip():
-                            [line.split(":")[1].rstrip(), atom_indices]})
-
-    return mapping_dict, bonding_info
-
-def _load_xml_file(mapfile=None):
-    """ load from a .xml file """
-    mapping_dict = OrderedDict()
-    bonding_info = []
-    tree = etree.parse(mapfile)
-    root = tree.getroot()
-    molecule = root.find("Molecule")
-
-    beads = molecule.find("Beads")
-    for bead in beads.iterchildren():
-        if 'Bead' in bead.tag:
-            mapping_dict.update({bead.attrib['index'].strip():
-                                [bead.attrib['beadtype'], 
-                               [int(i) for i in bead.attrib['map'].strip().split()]]})
-        else:
-            sys.exit("Unidentified tag {}".format(bead.tag))
-    
-    bonds = molecule.find("Bonds")
-    for bond in bonds.iterchildren():
-        if "Bond" in bond.tag:
-            bonding_info.append((bond.attrib['bead1'], bond.attrib['bead2']))
-        else:
-            sys.exit("Unidentified tag {}".format(bond.tag))
+    return MoleculeMapping.load(filename=mapfile).to_dict()
+
+def compile_residue_mapping(molecule_mapping=None, bonding_info=None):
+    """ Compile a molecule mapping into local-offset arrays
+
+    Parameters
+    ---------
+    molecule_mapping : OrderedDict
+        CG bead index : [beadtype, list of local atom indices]
+    bonding_info : list of (str, str)
+        Bonded CG bead indices
+
+    Returns
+    -------
+    compiled : dict
+        'beadtypes' : np.ndarray (n_beads,), ordered by bead index
+        'indptr' : np.ndarray (n_beads+1,), bead i owns
+            indices[indptr[i]:indptr[i+1]]
+        'indices' : np.ndarray, local atom indices within the residue
+        'bonds' : np.ndarray (n_bonds, 2), local bead indices
+
+    Notes
+    -----
+    molecule_mapping may also be a MoleculeMapping, whose arrays are
+    used as they are and bonding_info is ignored
+
+    """
+    if isinstance(molecule_mapping, MoleculeMapping):
+        return molecule_mapping.compiled()
+    return MoleculeMapping.from_dict(molecule_mapping, bonding_info).compiled()
+
+def _topology_from_arrays(bead_names, bead_residues, residue_names, bonds):
+    """ Build a CG mdtraj Topology, one chain per residue
 
-    return mapping_dict, bonding_info
+    Parameters
+    ---------
+    bead_names : np.ndarray (n_beads,)
+    bead_residues : np.ndarray (n_beads,)
+        CG residue index of every bead, nondecreasing
+    residue_names : np.ndarray (n_residues,)
+    bonds : np.ndarray (n_bonds, 2)
+        Bonded bead indices
+
+    """
+    CG_topology = mdtraj.Topology()
+    residues = [CG_topology.add_residue(str(name), CG_topology.add_chain()) 
+                    for name in residue_names]
+    atoms = [CG_topology.add_atom(str(name), None, residues[residue]) 
+                for name, residue in zip(bead_names, bead_residues)]
+    for (index_i, index_j) in bonds:
+        CG_topology.add_bond(atoms[index_i], atoms[index_j])
+    return CG_topology
+
+def topology_from_bead_table(bead_table):
+    """ Rebuild the CG mdtraj Topology described by a BeadTable
+
+    Every residue starts at a bead with in-residue index 0
+    """
+    starts = np.flatnonzero(bead_table.beadindex == 0)
+    bead_residues = np.cumsum(bead_table.beadindex == 0) - 1
+    return _topology_from_arrays(bead_table.beadtype, bead_residues,
+            bead_table.resname[starts], bead_table.bonds.astype(np.int64))
+
+def build_CG_topology(topol=None, all_CG_mappings=None, water_bead_mapping=4,
+        all_bonding_info=None):
+    """ Create CG topology and bead table with vectorized index arithmetic
+
+    Parameters
+    ---------
+    topol : mdtraj Topology
+    all_CG_mappings : dict
+        maps residue names to respective CG 
+        mapping dictionaries(CG index, [beadtype, atom indices]),
+        or to MoleculeMapping objects
+    water_bead_mapping : int
+        specifies how many water molecules get mapped to a water CG bead
+    all_bonding_info : dict, optional
+        maps residue names to bonding info arrays 
+        np.ndarray (n, 2), not needed for MoleculeMapping values
+
+    Returns
+    -------
+    bead_table : BeadTable
+        CSR atom indices (empty for water beads), bead type and residue
+        codes, in-residue bead indices and CG bonds
+    CG_topology : mdtraj topology
+
+    Notes
+    -----
+    Each residue type's mapping is compiled once; the atom indices of every 
+    residue of that type then come from one fancy-indexing step.
+    Beads are ordered as in create_CG_topology
+
+    """
+    # One pass over the residues for names, water flags and atom ranges
+    residue_info = [(residue.name, residue.is_water, residue.n_atoms, 
+                     residue.atom(0).index, residue.atom(-1).index) 
+                        for residue in topol.residues]
+    residue_names = np.array([info[0] for info in residue_info], dtype=object)
+    is_water = np.array([info[1] for info in residue_info], dtype=bool)
+    residue_n_atoms = np.array([info[2] for info in residue_info], dtype=np.int64)
+    residue_bounds = np.array([info[3:] for info in residue_info], dtype=np.int64)
+    residue_start = np.cumsum(residue_n_atoms) - residue_n_atoms
+
+    # Atoms of each residue, ordered as in the residue
+    if np.array_equal(residue_bounds[:, 0], residue_start) and \
+            np.array_equal(residue_bounds[:, 1], residue_start + residue_n_atoms - 1):
+        # Usual layout, each residue is a contiguous block of atoms
+        atom_order = np.arange(topol.n_atoms)
+    else:
+        atom_residue = np.fromiter((atom.residue.index for atom in topol.atoms),
+                                   dtype=np.int64, count=topol.n_atoms)
+        atom_order = np.argsort(atom_residue, kind='stable')
+    residue_names[is_water] = 'HOH'
+
+    all_bonding_info = all_bonding_info or {}
+    compiled = {name: compile_residue_mapping(all_CG_mappings[name],
+                                              all_bonding_info.get(name))
+                    for name in np.unique(residue_names[~is_water])}
+
+    # Every water_bead_mapping-th water residue gets a CG water bead
+    residue_n_beads = np.zeros(topol.n_residues, dtype=np.int64)
+    water_rank = np.cumsum(is_water)
+    residue_n_beads[is_water & (water_rank % water_bead_mapping == 0)] = 1
+    for name, mapping in compiled.items():
+        residue_n_beads[(residue_names == name) & ~is_water] = \
+                len(mapping['beadtypes'])
+    bead_start = np.cumsum(residue_n_beads) - residue_n_beads
+    n_beads = residue_n_beads.sum()
+
+    # Residues that yield beads become CG residues, in order
+    CG_residues = np.flatnonzero(residue_n_beads)
+    bead_residues = np.repeat(np.arange(len(CG_residues)), 
+                              residue_n_beads[CG_residues])
+    bead_resname = residue_names[CG_residues][bead_residues]
+    beadindex = np.arange(n_beads) - bead_start[CG_residues][bead_residues]
+    beadtype = np.full(n_beads, 'W', dtype=object)
+    bead_n_atoms = np.zeros(n_beads, dtype=np.int64)
+    all_bonds = []
+    for name, mapping in compiled.items():
+        residues = np.flatnonzero((residue_names == name) & ~is_water)
+        if np.any(mapping['indices'] >= residue_n_atoms[residues].min()):
+            raise ValueError("Mapping for {} refers to atoms beyond the "
+                             "residue".format(name))
+        beads = bead_start[residues][:, np.newaxis] + \
+                np.arange(len(mapping['beadtypes']))
+        beadtype[beads] = mapping['beadtypes']
+        bead_n_atoms[beads] = np.diff(mapping['indptr'])
+        all_bonds.append((bead_start[residues][:, np.newaxis, np.newaxis] +
+                          mapping['bonds']).reshape(-1, 2))
+
+    indptr = np.concatenate(([0], np.cumsum(bead_n_atoms)))
+    indices = np.zeros(indptr[-1], dtype=np.int64)
+    for name, mapping in compiled.items():
+        residues = np.flatnonzero((residue_names == name) & ~is_water)
+        global_atoms = atom_order[residue_start[residues][:, np.newaxis] +
+                                  mapping['indices']]
+        positions = indptr[bead_start[residues]][:, np.newaxis] + \
+                np.arange(len(mapping['indices']))
+        indices[positions] = global_atoms
+
+    bonds = np.concatenate(all_bonds) if all_bonds else \
+            np.zeros((0, 2), dtype=np.int64)
+    # Bonds in residue order, as the residues are laid out
+    bonds = bonds[np.argsort(bead_residues[bonds[:, 0]], kind='stable')]
+    beadtype = beadtype.astype(str)
+    bead_resname = bead_resname.astype(str)
+
+    CG_topology = _topology_from_arrays(beadtype, bead_residues,
+                                        residue_names[CG_residues], bonds)
+    bead_table = BeadTable.from_arrays(beadtype=beadtype, resname=bead_resname,
+            beadindex=beadindex, indptr=indptr, indices=indices, bonds=bonds)
+    return bead_table, CG_topology
 
-   
 def create_CG_topology(topol=None, all_CG_mappings=None, water_bead_mapping=4,
         all_bonding_info=None):
     """ Create CG topology from given topology and mapping
@@ -109,136 +239,438 @@ def create_CG_topology(topol=None, all_CG_mappings=None, water_bead_mapping=4,
 
     Returns
     -------
-    CG_topology_map : tuple of CG_bead()
+    CG_topology_map : BeadTable
+        Behaves like a list of CG_bead()
     CG_topology : mdtraj topology
         Need to fill in more details for topology creation
 
+    Notes
+    -----
+    Same as build_CG_topology
+
     """
-    CG_topology_map = []
-    CG_topology = mdtraj.Topology()
-    water_counter = 0
-    # Loop over all residues
-    for residue in topol.residues:
-        if not residue.is_water:
-            # Obtain the correct molecule mapping based on the residue
-            molecule_mapping = all_CG_mappings[residue.name]
-            temp_residue = CG_topology.add_residue(residue.name, CG_topology.add_chain())
-            temp_CG_indices = []
-            temp_CG_atoms = []
-            temp_CG_beads = [None]*len(molecule_mapping.keys())
-            CG_atoms = []
-
-            # For each CG bead, construct CG bead object, relating it to the
-            # global atom indices
-            # This first requires getting the local atom indices for that residue
-            for key in molecule_mapping.keys():
-                temp_CG_atoms = [residue.atom(index) for index in molecule_mapping[key][1]]
-                new_bead = CG_bead(beadindex=0,
-                                   beadtype=molecule_mapping[key][0],
-                                   resname=residue.name,
-                                   atom_indices=[atom.index for atom in temp_CG_atoms])
-                temp_CG_beads[int(key)] = new_bead
-
-            #for index, atom in enumerate(residue.atoms):
-            #    temp_CG_indices.append(str(index))
-            #    temp_CG_atoms.append(atom)
-            #    for key in molecule_mapping.keys():
-            #        if set(molecule_mapping[key][1]) == set(temp_CG_indices):
-            #            new_bead = CG_bead(beadindex=0, 
-            #                               beadtype=molecule_mapping[key][0],
-            #                               resname=residue.name,
-            #                               atom_indices=[atom.index for atom in temp_CG_atoms])
-            #            temp_CG_indices = []
-            #            temp_CG_atoms = []
-            #            temp_CG_beads[int(key)] = new_bead
-
-            #        else:
-            #            pass
-
-
-            # Add beads to topology by adding atoms
-            for index, bead in enumerate(temp_CG_beads):
-                bead.beadindex = index
-                CG_topology_map.append(bead)
-                new_CG_atom = CG_topology.add_atom(bead.beadtype, None, temp_residue)
-                CG_atoms.append(new_CG_atom)
-
-            # Add bonds to topolgoy 
-            bonding_info = all_bonding_info[residue.name]
-            for (index_i, index_j) in bonding_info:
-                CG_topology.add_bond(CG_atoms[int(index_i)], CG_atoms[int(index_j)])
+    return build_CG_topology(topol=topol, all_CG_mappings=all_CG_mappings,
+            water_bead_mapping=water_bead_mapping,
+            all_bonding_info=all_bonding_info)
 
-        else:
-            water_counter +=1
-            if water_counter % water_bead_mapping == 0:
-                temp_residue = CG_topology.add_residue("HOH", CG_topology.add_chain())
-                new_bead = CG_bead(beadindex=0, beadtype="W",
-                        resname='HOH')
-                CG_topology_map.append(new_bead)
-                CG_topology.add_atom("W", None, temp_residue)
+def _water_bead_indices(CG_topology_map):
+    """ Indices of the water beads in a BeadTable or list of CG_bead() """
+    if isinstance(CG_topology_map, BeadTable):
+        return np.flatnonzero(CG_topology_map.is_water)
+    return np.array([index for index, bead in enumerate(CG_topology_map) 
+                        if 'HOH' in bead.resname], dtype=int)
+
+def bead_masses(bead_table=None, topol=None, water_bead_mapping=4):
+    """ Mass of every CG bead, summed over its atoms
+
+    Parameters
+    ---------
+    bead_table : BeadTable
+    topol : mdtraj Topology
+        Atomistic topology
+    water_bead_mapping : int
+
+    Returns
+    -------
+    masses : np.ndarray (n_beads,)
+        Water beads, which have no fixed atoms, weigh water_bead_mapping
+        water molecules
+    """
+    atom_masses = np.array([atom.element.mass for atom in topol.atoms])
+    rows = np.repeat(np.arange(len(bead_table)), bead_table.n_atoms_per_bead)
+    masses = np.bincount(rows, weights=atom_masses[bead_table.indices.astype(np.int64)],
+            minlength=len(bead_table))
+    water = bead_table.is_water
+    if np.any(water):
+        water_residue = next(residue for residue in topol.residues 
+                if residue.is_water)
+        masses[water] = water_bead_mapping * sum(atom.element.mass 
+                for atom in water_residue.atoms)
+    return masses
+
+def _cluster_coms(water_xyz, labels, n_clusters, masses=None):
+    """ Mass-weighted center of every water cluster
+
+    Parameters
+    ----------
+    water_xyz : np.ndarray (n_waters, 3)
+    labels : np.ndarray (n_waters,)
+        Cluster index of each water
+    n_clusters : int
+    masses : np.ndarray (n_waters,), optional
+        Equal masses if not provided
+
+    Returns
+    -------
+    coms : np.ndarray (n_clusters, 3)
+
+    """
+    if masses is None:
+        masses = np.ones(len(water_xyz))
+    total_mass = np.bincount(labels, weights=masses, minlength=n_clusters)
+    coms = np.column_stack([np.bincount(labels, weights=masses*water_xyz[:, dim],
+                                        minlength=n_clusters) for dim in range(3)])
+    return coms / total_mass[:, np.newaxis]
+
+def _cluster_waters(water_xyz, n_cg_water, masses=None):
+    """ Cluster water oxygens via k-means and return the cluster centers of mass """
+    from sklearn import cluster
+    k_means = cluster.KMeans(n_clusters=n_cg_water)
+    k_means.fit(water_xyz)
+    return _cluster_coms(water_xyz, k_means.labels_, n_cg_water, masses=masses)
+
+def _water_oxygens(topol, water_bead_mapping):
+    """ Water oxygen indices, their masses and the number of CG waters """
+    waters = topol.select('water and name O')
+    masses = np.array([topol.atom(index).element.mass for index in waters])
+    n_cg_water = int(np.floor(len(waters) / water_bead_mapping))
+    return waters, masses, n_cg_water
 
+def _map_waters_warm_start(traj, waters, n_cg_water, masses=None, max_iter=20,
+        centroids=None, verbose=False):
+    """ Map waters frame by frame, seeding k-means from the previous frame
 
+    Parameters
+    ----------
+    traj : mdtraj Trajectory
+    waters : np.ndarray
+        Atom indices of the water oxygens
+    n_cg_water : int
+    masses : np.ndarray, optional
+        Masses of the water oxygens
+    max_iter : int
+        Maximum k-means iterations for every frame after the first
+    centroids : np.ndarray (n_cg_water, 3), optional
+        Final centroids of the previous chunk, seeding the first frame
+    verbose : boolean
+        Print the k-means iterations of every frame
+
+    Returns
+    -------
+    all_frame_coms : np.ndarray (n_frames, n_cg_water, 3)
+    n_iters : np.ndarray (n_frames,)
+        Number of k-means iterations each frame took
+    centroids : np.ndarray (n_cg_water, 3)
+        Centroids of the last frame, to pass on to the next chunk
+
+    Notes
+    -----
+    Without centroids the first frame is clustered cold, as in
+    _cluster_waters. Each later frame starts from the previous frame's
+    centroids with a single initialization, so cluster k stays CG water
+    bead k throughout the trajectory, across chunks too
+    """
+    from sklearn import cluster
+    all_frame_coms = np.zeros((traj.n_frames, n_cg_water, 3))
+    n_iters = np.zeros(traj.n_frames, dtype=int)
+    for frame_index in range(traj.n_frames):
+        aa_water_xyz = traj.xyz[frame_index, waters, :].astype(np.float64)
+        if centroids is None:
+            k_means = cluster.KMeans(n_clusters=n_cg_water)
+        else:
+            k_means = cluster.KMeans(n_clusters=n_cg_water, init=centroids,
+                    n_init=1, max_iter=max_iter)
+        k_means.fit(aa_water_xyz)
+        centroids = k_means.cluster_centers_
+        n_iters[frame_index] = k_means.n_iter_
+        all_frame_coms[frame_index] = _cluster_coms(aa_water_xyz, 
+                k_means.labels_, n_cg_water, masses=masses)
+        if verbose:
+            print("Frame {}: {} k-means iterations".format(frame_index, 
+                n_iters[frame_index]))
+    return all_frame_coms, n_iters, centroids
+
+# Volume of one water molecule in the bulk liquid (nm^3)
+_WATER_VOLUME = 0.0299
+
+def _assign_periodic(water_xyz, centroids, box_lengths, cell_size):
+    """ Nearest centroid (minimum image) of every water via a cell list
+
+    Only centroids in adjacent cells are considered. Waters whose best
+    candidate is farther than a cell length, where a closer centroid could
+    sit outside the adjacent cells, are assigned by a full search
+    """
+    cells = CellList(xyz=centroids, box_lengths=box_lengths, cell_size=cell_size)
+    best_distance = np.full(len(water_xyz), np.inf)
+    labels = np.full(len(water_xyz), -1, dtype=int)
+    for water_indices, centroid_indices in cells.neighbor_pairs(water_xyz):
+        dx = minimum_image(water_xyz[water_indices] - centroids[centroid_indices],
+                           box_lengths)
+        distance = np.sum(dx**2, axis=1)
+        # Candidates come grouped by water, so take the closest per segment
+        segments = np.flatnonzero(np.diff(water_indices)) + 1
+        segments = np.concatenate(([0], segments))
+        segment_min = np.minimum.reduceat(distance, segments)
+        lengths = np.diff(np.append(segments, len(distance)))
+        is_min = np.flatnonzero(distance == np.repeat(segment_min, lengths))
+        first = is_min[np.searchsorted(is_min, segments)]
+        water_indices = water_indices[first]
+        closer = segment_min < best_distance[water_indices]
+        best_distance[water_indices[closer]] = segment_min[closer]
+        labels[water_indices[closer]] = centroid_indices[first][closer]
+
+    unresolved = np.flatnonzero(best_distance > np.min(cells.cell_lengths)**2)
+    for block in np.array_split(unresolved, max(1, len(unresolved) // 1000)):
+        dx = minimum_image(water_xyz[block, np.newaxis, :] - centroids, 
+                           box_lengths)
+        labels[block] = np.argmin(np.sum(dx**2, axis=2), axis=1)
+    return labels
+
+def _periodic_cluster_coms(water_xyz, labels, centroids, box_lengths, masses=None):
+    """ Minimum-image centers of mass of each cluster about its centroid
+
+    Empty clusters keep their centroid
+    """
+    if masses is None:
+        masses = np.ones(len(water_xyz))
+    n_clusters = len(centroids)
+    dx = minimum_image(water_xyz - centroids[labels], box_lengths)
+    with np.errstate(invalid='ignore'):
+        shift = _cluster_coms(dx, labels, n_clusters, masses=masses)
+    shift[np.isnan(shift)] = 0
+    return wrap_coordinates(centroids + shift, box_lengths)
+
+def _map_waters_cell_list(traj, waters, n_cg_water, masses=None, max_iter=20,
+        tol=1e-4, cell_factor=1.5, centroids=None, verbose=False):
+    """ Map waters with periodic, cell-list accelerated k-means
 
+    Parameters
+    ----------
+    traj : mdtraj Trajectory
+        Must have an orthorhombic unit cell
+    waters : np.ndarray
+        Atom indices of the water oxygens
+    n_cg_water : int
+    masses : np.ndarray, optional
+        Masses of the water oxygens
+    max_iter : int
+        Maximum Lloyd iterations per frame
+    tol : float
+        Stop once no centroid moves more than this (nm)
+    cell_factor : float
+        Cell size in units of the CG water spacing in bulk water
+    centroids : np.ndarray (n_cg_water, 3), optional
+        Final centroids of the previous chunk, seeding the first frame
+    verbose : boolean
+        Print the iterations of every frame
 
+    Returns
+    -------
+    all_frame_coms : np.ndarray (n_frames, n_cg_water, 3)
+    n_iters : np.ndarray (n_frames,)
+    centroids : np.ndarray (n_cg_water, 3)
+        Centroids of the last frame, to pass on to the next chunk
 
-    return CG_topology_map, CG_topology
+    Notes
+    -----
+    Distances and centers of mass use the minimum image convention, so
+    clusters straddling the box edge are handled correctly.
+    Assignment only compares each water to the centroids in neighboring
+    cells, costing O(n_waters) per iteration instead of 
+    O(n_waters * n_cg_water). Like 'warm_start', each frame is seeded from
+    the previous frame's centroids
+    """
+    all_frame_coms = np.zeros((traj.n_frames, n_cg_water, 3))
+    n_iters = np.zeros(traj.n_frames, dtype=int)
+    # Spacing between CG waters in bulk water, rather than the whole box,
+    # since the waters may only fill part of it (e.g. around a bilayer)
+    cell_size = cell_factor * (len(waters) / n_cg_water * _WATER_VOLUME)**(1/3)
+    for frame_index in range(traj.n_frames):
+        box_lengths = orthorhombic_box(traj.unitcell_vectors[frame_index])
+        aa_water_xyz = wrap_coordinates(
+                traj.xyz[frame_index, waters, :].astype(np.float64), box_lengths)
+        if centroids is None:
+            # Evenly strided oxygens as the initial centroids
+            stride = len(waters) // n_cg_water
+            centroids = aa_water_xyz[::stride][:n_cg_water].copy()
+        centroids = wrap_coordinates(centroids, box_lengths)
+
+        for iteration in range(max_iter):
+            labels = _assign_periodic(aa_water_xyz, centroids, box_lengths, 
+                    cell_size)
+            new_centroids = _periodic_cluster_coms(aa_water_xyz, labels,
+                    centroids, box_lengths, masses=masses)
+            moved = np.max(np.linalg.norm(minimum_image(
+                    new_centroids - centroids, box_lengths), axis=1))
+            centroids = new_centroids
+            if moved < tol:
+                break
+        n_iters[frame_index] = iteration + 1
+        all_frame_coms[frame_index] = centroids
+        if verbose:
+            print("Frame {}: {} cell-list iterations".format(frame_index,
+                n_iters[frame_index]))
+    return all_frame_coms, n_iters, centroids
+
+# Per-process state of the water-mapping pool, set by _init_water_worker
+_water_worker = {}
+
+def _init_water_worker(shm_name, shape, dtype, masses, n_cg_water):
+    """ Attach a pool worker to the shared water oxygen coordinates
+
+    The water oxygen masses are sent once per worker here, so the tasks
+    themselves are only frame indices
+    """
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _water_worker.update({'shm': shm,
+            'xyz': np.ndarray(shape, dtype=dtype, buffer=shm.buf),
+            'masses': masses, 'n_cg_water': n_cg_water})
 
-def _map_waters(traj, frame_index, water_bead_mapping):
+def _map_waters(frame_index):
     """ Worker function to parallelize mapping waters via kmeans
 
     Parameters
     ----------
-    traj : mdtraj trajectory
-        full atomstic trajectory
     frame index : int
         parallelizing calculation frame by frame
+
+    Returns
+    -------
+    frame_index : int
+    coms : np.ndarray (n_cg_water, 3)
+
+    Notes
+    -----
+    Coordinates are read from the shared buffer attached in
+    _init_water_worker rather than pickled into each task
     
     """
-    from sklearn import cluster
-    frame = traj[frame_index]
-    # Get atom indices of all water oxygens
-    waters = frame.topology.select('water and name O')
+    aa_water_xyz = _water_worker['xyz'][frame_index]
+    coms = _cluster_waters(aa_water_xyz, _water_worker['n_cg_water'],
+            masses=_water_worker['masses'])
+    return frame_index, coms
 
-    # Get coordinates and number of all water oxygens
-    n_aa_water = len(waters)
-    aa_water_xyz = frame.atom_slice(waters).xyz[0,:,:]
+def _map_waters_parallel(traj, waters, n_cg_water, masses=None, n_workers=None,
+        chunksize=None, verbose=False):
+    """ Map waters frame by frame in a process pool over shared coordinates
 
-    # Number of CG water molecules based on mapping scheme
-    n_cg_water = int(np.floor(n_aa_water /  water_bead_mapping))
-    # Water clusters are a list (n_cg_water) of empty lists
-    water_clusters = [[] for i in range(n_cg_water)]
+    Parameters
+    ----------
+    traj : mdtraj Trajectory
+    waters : np.ndarray
+        Atom indices of the water oxygens
+    n_cg_water : int
+    masses : np.ndarray, optional
+        Masses of the water oxygens
+    n_workers : int, optional
+        Number of worker processes, defaults to the number of cpus
+    chunksize : int, optional
+        Number of frames submitted to a worker at a time
+    verbose : boolean
+        Report the bytes pickled between processes per frame
 
-    # Perform the k-means clustering based on the AA water xyz
-    k_means = cluster.KMeans(n_clusters=n_cg_water)
-    k_means.fit(aa_water_xyz)
+    Returns
+    -------
+    all_frame_coms : np.ndarray (n_frames, n_cg_water, 3)
 
-    # Each cluster index says which cluster an atom belongs to
-    for atom_index, cluster_index in enumerate(k_means.labels_):
-        # Sort each water atom into the corresponding cluster
-        # The item being added should be an atom index
-        
-        water_clusters[cluster_index].append(waters[atom_index])
+    Notes
+    -----
+    Only the water oxygen coordinates are copied, once, into shared
+    memory, which the workers map without copying.
+    The reported IPC bytes are an estimate, not measured pipe traffic:
+    the pickled initializer arguments once per worker, plus the pickled
+    frame index and result of every frame. Batching by chunksize and the
+    pool's own framing are not counted, nor is the shared memory itself
+    """
+    from multiprocessing import shared_memory, cpu_count
+    n_workers = n_workers or cpu_count()
+    if chunksize is None:
+        chunksize = max(1, int(np.ceil(traj.n_frames / (4 * n_workers))))
+    all_frame_coms = np.zeros((traj.n_frames, n_cg_water, 3))
+
+    water_xyz = traj.xyz[:, waters, :]
+    shm = shared_memory.SharedMemory(create=True, size=water_xyz.nbytes)
+    try:
+        shared_xyz = np.ndarray(water_xyz.shape, dtype=water_xyz.dtype,
+                buffer=shm.buf)
+        shared_xyz[:] = water_xyz
+        initargs = (shm.name, water_xyz.shape, water_xyz.dtype, masses,
+                    n_cg_water)
+        ipc_bytes = n_workers * len(pickle.dumps(initargs)) if verbose else 0
+        with Pool(processes=n_workers, initializer=_init_water_worker,
+                initargs=initargs) as p:
+            for result in p.imap_unordered(_map_waters, range(traj.n_frames),
+                    chunksize=chunksize):
+                if verbose:
+                    ipc_bytes += len(pickle.dumps(result[0])) + \
+                            len(pickle.dumps(result))
+                all_frame_coms[result[0]] = result[1]
+        del shared_xyz
+    finally:
+        shm.close()
+        shm.unlink()
+    if verbose:
+        print("IPC bytes per frame: {:.0f} (pickled coordinates alone were {} "
+                "bytes)".format(ipc_bytes / traj.n_frames, water_xyz.nbytes))
+    return all_frame_coms
+ 
+def _map_waters_serial(traj, waters, n_cg_water, masses=None):
+    """ Map waters frame by frame in this process
 
+    Parameters
+    ----------
+    traj : mdtraj Trajectory
+    waters : np.ndarray
+        Atom indices of the water oxygens
+    n_cg_water : int
+    masses : np.ndarray, optional
+        Masses of the water oxygens
 
-    single_frame_coms = []
-    # For each cluster, compute enter of mass
-    for cg_index, water_cluster in enumerate(water_clusters):
-        com = mdtraj.compute_center_of_mass(frame.atom_slice(water_cluster))
-        single_frame_coms.append((frame_index, com))
-        #CG_xyz[frame_index, cg_index + water_start,:] = com
-    return single_frame_coms
- 
-def convert_xyz(traj=None, CG_topology_map=None, water_bead_mapping=4,parallel=True):
+    Returns
+    -------
+    all_frame_coms : np.ndarray (n_frames, n_cg_water, 3)
+
+    Notes
+    -----
+    Same clustering as _map_waters_parallel without a process pool, for
+    machines where multiprocessing is unavailable or restricted. The
+    oxygen coordinates are sliced out of traj.xyz once
+    """
+    water_xyz = traj.xyz[:, waters, :]
+    all_frame_coms = np.zeros((traj.n_frames, n_cg_water, 3))
+    for frame_index in range(traj.n_frames):
+        all_frame_coms[frame_index] = _cluster_waters(water_xyz[frame_index],
+                n_cg_water, masses=masses)
+    return all_frame_coms
+
+def convert_xyz(traj=None, CG_topology_map=None, water_bead_mapping=4,parallel=True,
+        mapping_operator=None, n_workers=None, chunksize=None, water_method='kmeans',
+        water_state=None, verbose=False):
     """Take atomistic trajectory and convert to CG trajectory
 
     Parameters
     ---------
     traj : mdtraj Trajectory
         Atomistic trajectory
-    CG_topology : list
+    CG_topology_map : BeadTable or list
         list of CGbead()
     parallel : boolean
-        True if using parallelized, false if using serial
+        True if using parallelized, false if using serial (no
+        process pool)
+    mapping_operator : MappingOperator, optional
+        Compiled mapping for the non-water beads, built from 
+        CG_topology_map if not provided. Pass one in to reuse it 
+        across calls on the same system
+    n_workers : int, optional
+        Number of processes for the parallel water mapping, 
+        defaults to the number of cpus
+    chunksize : int, optional
+        Number of frames submitted to a water-mapping worker at a time
+    water_method : str
+        'kmeans' clusters every frame independently,
+        'warm_start' seeds each frame from the previous frame's centroids,
+        keeping CG water identities continuous (always runs serially),
+        'cell_list' runs periodic k-means with minimum-image centers of mass
+        and cell-list assignment, also warm-started (orthorhombic boxes only)
+    water_state : dict, optional
+        Carries the warm-started centroids between calls on consecutive
+        chunks: 'centroids' seeds the first frame and is replaced by the
+        last frame's centroids, and the iterations of every frame are 
+        appended to 'n_iters'
+    verbose : boolean
+        Print the iterations of every warm-started frame, or the
+        estimated bytes pickled per frame by the parallel k-means
 
     Returns
     ------
@@ -250,21 +682,16 @@ def convert_xyz(traj=None, CG_topology_map=None, water_bead_mapping=4,parallel=T
     # For each bead, get the atom indices
     # Then slice the trajectory and compute hte center of mass for that particular bead
     entire_start = time.time()
-    CG_xyz = np.ndarray(shape=(traj.n_frames, len(CG_topology_map),3))
-    water_indices = []
     print("Converting non-water atoms into beads over all frames")
     start = time.time()
-    for index, bead in enumerate(CG_topology_map):
-        if 'HOH' not in bead.resname:
-            # Handle non-water residuse with center of mass calculation over all frames
-            atom_indices = bead.atom_indices 
-            # Two ways to compute center of mass, both are pretty fast
-            bead_coordinates = mdtraj.compute_center_of_mass(traj.atom_slice(atom_indices))
-            CG_xyz[:, index, :] = bead_coordinates
-        else:
-            # Handle waters by initially setting the bead coordinates to zero
-            # Remember which coarse grain indices correspond to water
-            water_indices.append(index)
+    if mapping_operator is None:
+        mapping_operator = MappingOperator.from_topology_map(
+                CG_topology_map=CG_topology_map, topol=traj.topology)
+    # Non-water beads for all frames come from one sparse-dense product,
+    # water beads are left at zero and filled in below
+    CG_xyz = mapping_operator.apply_traj(traj)
+    # Remember which coarse grain indices correspond to water
+    water_indices = _water_bead_indices(CG_topology_map)
 
     end = time.time()
     print("Converting took: {}".format(end-start))
@@ -276,74 +703,133 @@ def convert_xyz(traj=None, CG_topology_map=None, water_bead_mapping=4,parallel=T
         # Perform kmeans, frame-by-frame, over all water residues
         # Workers will return centers of masses of clusters, frame index, and cg index
         # Master will assign to CG_xyz
-        if parallel:
-            all_frame_coms = []
-            with Pool() as p:
-                all_frame_coms = p.starmap(_map_waters, 
-                                        zip(itertools.repeat(traj), 
-                                        range(traj.n_frames),
-                                        itertools.repeat(water_bead_mapping)))
+        if water_method == 'warm_start':
+            waters, masses, n_cg_water = _water_oxygens(traj.topology, 
+                    water_bead_mapping)
+            all_frame_coms, n_iters, centroids = _map_waters_warm_start(traj,
+                    waters, n_cg_water, masses=masses,
+                    centroids=(water_state or {}).get('centroids'),
+                    verbose=verbose)
+            if water_state is not None:
+                water_state['centroids'] = centroids
+                water_state.setdefault('n_iters', []).extend(n_iters)
+            CG_xyz[:, water_indices, :] = all_frame_coms
+            end = time.time()
+            print("Warm-started k-means and converting took: {}".format(end-start))
+            print("Mean k-means iterations per frame: {} (max {})".format(
+                np.mean(n_iters), np.max(n_iters)))
+
+        elif water_method == 'cell_list':
+            waters, masses, n_cg_water = _water_oxygens(traj.topology, 
+                    water_bead_mapping)
+            all_frame_coms, n_iters, centroids = _map_waters_cell_list(traj,
+                    waters, n_cg_water, masses=masses,
+                    centroids=(water_state or {}).get('centroids'),
+                    verbose=verbose)
+            if water_state is not None:
+                water_state['centroids'] = centroids
+                water_state.setdefault('n_iters', []).extend(n_iters)
+            CG_xyz[:, water_indices, :] = all_frame_coms
+            end = time.time()
+            print("Cell-list clustering and converting took: {}".format(end-start))
+            print("Mean cell-list iterations per frame: {} (max {})".format(
+                np.mean(n_iters), np.max(n_iters)))
+
+        elif parallel:
+            waters, masses, n_cg_water = _water_oxygens(traj.topology, 
+                    water_bead_mapping)
+            all_frame_coms = _map_waters_parallel(traj, waters, n_cg_water,
+                    masses=masses, n_workers=n_workers, chunksize=chunksize,
+                    verbose=verbose)
 
             end = time.time()
             print("K-means and converting took: {}".format(end-start))
 
             print("Writing to CG-xyz")
             start = time.time()
-            for snapshot in all_frame_coms:
-                for element, water_index in zip(snapshot, water_indices):
-                    CG_xyz[element[0], water_index , : ] = element[1]
+            CG_xyz[:, water_indices, :] = all_frame_coms
             end =  time.time()
             print("Writing took: {}".format(end-start))
 
             return CG_xyz
         
         else:
-            from sklearn import cluster
-            for frame_index, frame in enumerate(traj):
-                # Get atom indices of all water oxygens
-                waters = traj.topology.select('water and name O')
-
-                # Get coordinates and number of all water oxygens
-                n_aa_water = len(waters)
-                aa_water_xyz = traj.atom_slice(waters).xyz[frame_index,:,:]
-
-                # Number of CG water molecules based on mapping scheme
-                n_cg_water = int(n_aa_water /  water_bead_mapping)
-                # Water clusters are a list (n_cg_water) of empty lists
-                water_clusters = [[] for i in range(n_cg_water)]
-
-                # Perform the k-means clustering based on the AA water xyz
-                start = time.time()
-                print("Clustering for frame {}".format(frame_index))
-                k_means = cluster.KMeans(n_clusters=n_cg_water)
-                k_means.fit(aa_water_xyz)
-                end = time.time()
-                print("Clustering one frame took: {}".format(end-start))
-
-                # Each cluster index says which cluster an atom belongs to
-                print("Assigning water atoms to water clusters for frame {}".format(frame_index))
-                start = time.time()
-                for atom_index, cluster_index in enumerate(k_means.labels_):
-                    # Sort each water atom into the corresponding cluster
-                    # The item being added should be an atom index
-                    water_clusters[cluster_index].append(waters[atom_index])
-                end = time.time()
-                print("Assigning took: {}".format(end-start))
-
-
-                # For each cluster, compute enter of mass
-                print("Computing cluster centers for frame {}".format(frame_index))
-                start = time.time()
-                for cg_index, water_cluster in enumerate(water_clusters):
-                    com = mdtraj.compute_center_of_mass(traj.atom_slice(water_cluster)[frame_index])
-                    CG_xyz[frame_index, cg_index + water_start,:] = com
-                end = time.time()
-                print("Computing took: {}".format(end-start))
+            waters, masses, n_cg_water = _water_oxygens(traj.topology, 
+                    water_bead_mapping)
+            all_frame_coms = _map_waters_serial(traj, waters, n_cg_water,
+                    masses=masses)
+            CG_xyz[:, water_indices, :] = all_frame_coms
+            end = time.time()
+            print("K-means and converting took: {}".format(end-start))
 
     entire_end = time.time()
     print("XYZ conversion took: {}".format(entire_end - entire_start))
     return CG_xyz
 
+def convert_traj_chunks(trajfile=None, top=None, CG_topology_map=None,
+        CG_topology=None, chunk=100, water_bead_mapping=4, parallel=True, 
+        mapping_operator=None, water_method='kmeans', water_state=None,
+        n_workers=None, chunksize=None, verbose=False):
+    """ Stream an atomistic trajectory from disk and convert it chunk by chunk
+
+    Parameters
+    ---------
+    trajfile : str
+        Path to atomistic trajectory
+    top : str or mdtraj Topology
+        Atomistic topology, as for mdtraj.iterload
+    CG_topology_map : list
+        list of CGbead()
+    CG_topology : mdtraj Topology
+        CG topology from create_CG_topology
+    chunk : int
+        Number of frames loaded and converted at a time
+    parallel : boolean
+        True if using parallelized, false if using serial
+    mapping_operator : MappingOperator, optional
+        Compiled mapping for the non-water beads, built from the 
+        first chunk if not provided
+    water_method : str
+        Water mapping strategy, see convert_xyz
+    water_state : dict, optional
+        Passed to every convert_xyz call, holding the centroids carried
+        across chunks and the iterations of every frame ('n_iters')
+        once the generator is exhausted
+    n_workers : int, optional
+        Number of processes for the parallel water mapping
+    chunksize : int, optional
+        Number of frames submitted to a water-mapping worker at a time
+    verbose : boolean
+        See convert_xyz
+
+    Yields
+    ------
+    CG_chunk : mdtraj Trajectory
+        CG trajectory of (at most) chunk frames
+
+    Notes
+    -----
+    Only one chunk of the atomistic and CG trajectories is held in memory
+    at a time, so peak memory is set by chunk, not the trajectory length.
+    With 'warm_start' or 'cell_list' each chunk starts from the previous
+    chunk's final centroids, so CG water identities carry across chunks
+
+    """
+    if water_state is None:
+        water_state = {}
+    for traj in mdtraj.iterload(trajfile, top=top, chunk=chunk):
+        if mapping_operator is None:
+            mapping_operator = MappingOperator.from_topology_map(
+                    CG_topology_map=CG_topology_map, topol=traj.topology)
+        CG_xyz = convert_xyz(traj=traj, CG_topology_map=CG_topology_map,
+                water_bead_mapping=water_bead_mapping, parallel=parallel,
+                mapping_operator=mapping_operator, water_method=water_method,
+                water_state=water_state, n_workers=n_workers, 
+                chunksize=chunksize, verbose=verbose)
+        yield mdtraj.Trajectory(CG_xyz, CG_topology, time=traj.time,
+                unitcell_lengths=traj.unitcell_lengths,
+                unitcell_angles=traj.unitcell_angles)
+
 def compute_avg_box(traj):
     """ Compute average box lengths"""
 
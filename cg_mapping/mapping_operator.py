@@ -0,0 +1,154 @@
+import numpy as np
+from scipy import sparse
+
+from cg_mapping.bead_table import BeadTable
+
+
+class MappingOperator(object):
+    """ Mass-weighted linear operator mapping atoms onto CG beads
+
+    Parameters
+    ---------
+    matrix : scipy.sparse.csr_matrix (n_beads, n_atoms)
+        Row i holds the normalized masses of the atoms in bead i
+    mapped : np.ndarray (n_beads,), dtype=bool
+        True for beads with a fixed set of atoms (everything except water)
+
+    Notes
+    -----
+    Rows for beads without atom indices (waters) are empty, so applying
+    the operator leaves zeros at those positions.
+    Build with `MappingOperator.from_topology_map`
+
+    """
+
+    def __init__(self, matrix=None, mapped=None):
+        self._matrix = sparse.csr_matrix(matrix)
+        if mapped is None:
+            mapped = np.diff(self._matrix.indptr) > 0
+        self._mapped = np.asarray(mapped, dtype=bool)
+
+    @classmethod
+    def from_topology_map(cls, CG_topology_map=None, topol=None):
+        """ Compile an operator from a CG topology map
+
+        Parameters
+        ---------
+        CG_topology_map : BeadTable or list of CG_bead()
+        topol : mdtraj Topology
+            Atomistic topology, used for the atomic masses
+
+        Returns
+        -------
+        MappingOperator
+
+        """
+        if isinstance(CG_topology_map, BeadTable):
+            return cls.from_bead_table(bead_table=CG_topology_map, topol=topol)
+        masses = np.array([atom.element.mass for atom in topol.atoms])
+        indptr = [0]
+        indices = []
+        mapped = np.zeros(len(CG_topology_map), dtype=bool)
+        for index, bead in enumerate(CG_topology_map):
+            if bead.atom_indices is not None and 'HOH' not in bead.resname:
+                indices.extend(bead.atom_indices)
+                mapped[index] = True
+            indptr.append(len(indices))
+        return cls._from_csr(indptr, indices, masses, mapped, topol.n_atoms)
+
+    @classmethod
+    def from_bead_table(cls, bead_table=None, topol=None):
+        """ Compile an operator straight from the arrays of a BeadTable
+
+        Parameters
+        ---------
+        bead_table : BeadTable
+        topol : mdtraj Topology
+            Atomistic topology, used for the atomic masses
+
+        Returns
+        -------
+        MappingOperator
+
+        """
+        masses = np.array([atom.element.mass for atom in topol.atoms])
+        indptr = bead_table.indptr.astype(np.int64)
+        # Water beads get empty rows
+        keep = np.repeat(~bead_table.is_water, bead_table.n_atoms_per_bead)
+        indices = bead_table.indices[keep]
+        indptr[1:] = np.cumsum(np.where(bead_table.is_water, 0,
+                                        bead_table.n_atoms_per_bead))
+        mapped = np.diff(indptr) > 0
+        return cls._from_csr(indptr, indices, masses, mapped, topol.n_atoms)
+
+    @classmethod
+    def _from_csr(cls, indptr, indices, masses, mapped, n_atoms):
+        """ Mass-weighted matrix from CSR atom indices per bead """
+        indptr = np.asarray(indptr, dtype=np.int64)
+        indices = np.asarray(indices, dtype=np.int64)
+        n_beads = len(indptr) - 1
+
+        # Normalize the masses within each bead so rows sum to one
+        data = masses[indices]
+        rows = np.repeat(np.arange(n_beads), np.diff(indptr))
+        bead_masses = np.bincount(rows, weights=data, minlength=n_beads)
+        data = data / bead_masses[rows]
+
+        matrix = sparse.csr_matrix((data, indices, indptr),
+                shape=(n_beads, n_atoms))
+        return cls(matrix=matrix, mapped=mapped)
+
+    @property
+    def matrix(self):
+        return self._matrix
+
+    @property
+    def mapped(self):
+        return self._mapped
+
+    @property
+    def n_beads(self):
+        return self._matrix.shape[0]
+
+    @property
+    def n_atoms(self):
+        return self._matrix.shape[1]
+
+    def apply(self, xyz):
+        """ Map a block of atomistic frames onto CG beads
+
+        Parameters
+        ---------
+        xyz : np.ndarray (n_frames, n_atoms, 3) or (n_atoms, 3)
+
+        Returns
+        -------
+        CG_xyz : np.ndarray (n_frames, n_beads, 3) or (n_beads, 3)
+
+        Notes
+        -----
+        All frames are mapped with a single sparse-dense product by
+        laying the frames out as columns, (n_atoms, n_frames*3)
+
+        """
+        xyz = np.asarray(xyz)
+        if xyz.ndim == 2:
+            return self.apply(xyz[np.newaxis])[0]
+        n_frames = xyz.shape[0]
+        columns = xyz.transpose(1, 0, 2).reshape(self.n_atoms, n_frames * 3)
+        CG_columns = self._matrix.dot(columns)
+        return CG_columns.reshape(self.n_beads, n_frames, 3).transpose(1, 0, 2)
+
+    def apply_traj(self, traj):
+        """ Map every frame of an atomistic trajectory
+
+        Parameters
+        ---------
+        traj : mdtraj Trajectory
+
+        Returns
+        -------
+        CG_xyz : np.ndarray (n_frames, n_beads, 3)
+
+        """
+        return self.apply(traj.xyz)
@@ -1,23 +1,16 @@
-from lxml import etree
-import pdb
+import argparse
 
-inputFile = "C16FFA.map"
-outputFile = "C16FFA.xml"
-root = etree.Element('Mapping')
-mapping = etree.SubElement(root,"Molecule", name=outputFile[:-4])
-beadtypes = etree.SubElement(mapping, 'Beads')
-bonds = etree.SubElement(mapping, 'Bonds')
-for line in open(inputFile, 'r').readlines():
-    if 'bond' not in line:
-        [index, beadtype, indices] = line.split(':')
-        new_element = etree.SubElement(beadtypes, "Bead", index=index.strip(),
-                                       beadtype=beadtype.strip(), map=indices.strip())
-    else: 
-        [first, second] = line.split(':')[1].split()
-        new_element = etree.SubElement(bonds, "Bond", bead1=first.strip(), 
-                                       bead2=second.strip())
+from cg_mapping.molecule_mapping import MoleculeMapping
 
-bonds.set('n_bonds', str(len(bonds.getchildren())))
-beadtypes.set('n_beads', str(len(beadtypes.getchildren())))
-tree =  etree.ElementTree(root)
-tree.write(outputFile, pretty_print=True)
+# Convert between .map, .xml and .npz mapping files, formats are chosen
+# by the extensions, e.g.
+#   python convert_map_to_xml.py C16FFA.map C16FFA.xml
+#   python convert_map_to_xml.py DSPC.xml DSPC.npz
+parser = argparse.ArgumentParser()
+parser.add_argument("inputFile", nargs='?', default="C16FFA.map")
+parser.add_argument("outputFile", nargs='?', default="C16FFA.xml")
+args = parser.parse_args()
+
+mapping = MoleculeMapping.load(args.inputFile)
+mapping.save(args.outputFile)
+print("Wrote {} to {}".format(mapping, args.outputFile))
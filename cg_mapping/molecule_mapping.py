@@ -0,0 +1,270 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+from lxml import etree
+
+
+class MoleculeMapping(object):
+    """ Forward mapping of one molecule as validated arrays
+
+    Parameters
+    ---------
+    name : str
+        Molecule name
+    beadtypes : np.ndarray (n_beads,)
+        Bead type of every CG bead, ordered by bead index
+    indptr : np.ndarray (n_beads+1,)
+        Bead i owns indices[indptr[i]:indptr[i+1]]
+    indices : np.ndarray
+        Atom indices within the molecule
+    bonds : np.ndarray (n_bonds, 2), optional
+        Bonded bead indices
+
+    Notes
+    -----
+    Read with `MoleculeMapping.load`, which dispatches on the extension
+    (.map, .xml or .npz), and write any of the three with `save`.
+    .npz files skip parsing altogether, the arrays are read as saved
+
+    """
+
+    def __init__(self, name='', beadtypes=None, indptr=None, indices=None,
+            bonds=None):
+        self._name = str(name)
+        self._beadtypes = np.asarray(beadtypes, dtype=str).reshape(-1)
+        self._indptr = np.asarray(indptr, dtype=np.int64).reshape(-1)
+        self._indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        if bonds is None:
+            bonds = np.zeros((0, 2), dtype=np.int64)
+        self._bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+        self._validate()
+
+    def _validate(self):
+        n_beads = len(self._beadtypes)
+        if len(self._indptr) != n_beads + 1 or self._indptr[0] != 0 or \
+                self._indptr[-1] != len(self._indices):
+            raise ValueError("Mapping {}: indptr does not match {} beads and "
+                    "{} atom indices".format(self._name, n_beads,
+                        len(self._indices)))
+        if np.any(np.diff(self._indptr) < 1):
+            raise ValueError("Mapping {}: beads {} map no atoms".format(
+                self._name, np.flatnonzero(np.diff(self._indptr) < 1)))
+        if np.any(self._indices < 0):
+            raise ValueError("Mapping {}: negative atom indices".format(
+                self._name))
+        if np.any((self._bonds < 0) | (self._bonds >= n_beads)):
+            raise ValueError("Mapping {}: bonds refer to beads beyond the "
+                    "{} beads".format(self._name, n_beads))
+        if np.any(self._bonds[:, 0] == self._bonds[:, 1]):
+            raise ValueError("Mapping {}: bead bonded to itself".format(
+                self._name))
+
+    @classmethod
+    def from_dict(cls, mapping_dict=None, bonding_info=None, name=''):
+        """ Build from load_mapping's (mapping_dict, bonding_info)
+
+        Parameters
+        ---------
+        mapping_dict : OrderedDict
+            CG bead index : [beadtype, list of atom indices]
+        bonding_info : list of (str, str)
+            Bonded CG bead indices
+        name : str
+        """
+        return cls._from_beads([(index, beadtype, atoms) for index,
+            (beadtype, atoms) in mapping_dict.items()], bonding_info, name=name)
+
+    @classmethod
+    def _from_beads(cls, beads, bonds, name=''):
+        """ Build from (index, beadtype, atom indices) tuples in any order
+        and (bead_i, bead_j) pairs, indices as ints or strings """
+        try:
+            order = [int(bead[0]) for bead in beads]
+        except ValueError:
+            raise ValueError("Mapping {}: CG bead indices must be "
+                    "integers".format(name))
+        if sorted(order) != list(range(len(beads))):
+            raise ValueError("CG bead indices must run from 0 to {}".format(
+                len(beads)-1))
+        beads = [beads[i] for i in np.argsort(order)]
+        counts = [len(bead[2]) for bead in beads]
+        try:
+            indices = np.array([index for bead in beads for index in bead[2]],
+                    dtype=np.int64)
+            bonds = np.array(bonds or [], dtype=np.int64)
+        except ValueError:
+            raise ValueError("Mapping {}: atom and bead indices must be "
+                    "integers".format(name))
+        return cls(name=name, beadtypes=[bead[1].strip() for bead in beads],
+                indptr=np.concatenate(([0], np.cumsum(counts))),
+                indices=indices, bonds=bonds)
+
+    @classmethod
+    def load(cls, filename=None):
+        """ Load a .map, .xml or .npz mapping file
+
+        Parameters
+        ---------
+        filename : str
+        """
+        extension = os.path.splitext(filename)[1].lower()
+        if extension == '.map':
+            return cls.from_map(filename)
+        elif extension == '.xml':
+            return cls.from_xml(filename)
+        elif extension == '.npz':
+            return cls.from_npz(filename)
+        raise ValueError("Invalid mapping file {}, expected .map, .xml or "
+                ".npz".format(filename))
+
+    @classmethod
+    def from_map(cls, filename=None):
+        """ Parse a ':' delimited .map file
+
+        Bead lines are 'index : beadtype : atom indices', bond lines are
+        'bond : bead_i bead_j'. Each line is split once
+        """
+        beads = []
+        bonds = []
+        with open(filename, 'r') as f:
+            for line_number, line in enumerate(f, 1):
+                fields = line.split(':')
+                if len(fields) == 3:
+                    beads.append((fields[0], fields[1], fields[2].split()))
+                elif len(fields) == 2 and 'bond' in fields[0] and \
+                        len(fields[1].split()) == 2:
+                    bonds.append(fields[1].split())
+                elif line.strip():
+                    raise ValueError("{}:{}: cannot parse '{}'".format(
+                        filename, line_number, line.rstrip()))
+        return cls._from_beads(beads, bonds,
+                name=os.path.splitext(os.path.basename(filename))[0])
+
+    @classmethod
+    def from_xml(cls, filename=None):
+        """ Parse a Mapping > Molecule > Beads + Bonds .xml file """
+        root = etree.parse(filename).getroot()
+        molecule = root.find("Molecule")
+        if molecule is None:
+            raise ValueError("No Molecule element in {}".format(filename))
+        beads_element = molecule.find("Beads")
+        if beads_element is None:
+            raise ValueError("No Beads element in {}".format(filename))
+        beads = []
+        bonds = []
+        for bead in beads_element.iterchildren(tag=etree.Element):
+            if bead.tag != 'Bead':
+                raise ValueError("Unidentified tag {} in {}".format(bead.tag,
+                    filename))
+            for attribute in ('index', 'beadtype', 'map'):
+                if bead.get(attribute) is None:
+                    raise ValueError("{}:{}: Bead without a {} "
+                        "attribute".format(filename, bead.sourceline, 
+                            attribute))
+            beads.append((bead.get('index'), bead.get('beadtype'),
+                bead.get('map').split()))
+        bonds_element = molecule.find("Bonds")
+        for bond in (bonds_element.iterchildren(tag=etree.Element)
+                if bonds_element is not None else []):
+            if bond.tag != 'Bond':
+                raise ValueError("Unidentified tag {} in {}".format(bond.tag,
+                    filename))
+            if bond.get('bead1') is None or bond.get('bead2') is None:
+                raise ValueError("{}:{}: Bond without bead1 and bead2 "
+                    "attributes".format(filename, bond.sourceline))
+            bonds.append((bond.get('bead1'), bond.get('bead2')))
+        return cls._from_beads(beads, bonds, name=molecule.get('name', ''))
+
+    @classmethod
+    def from_npz(cls, filename=None):
+        """ Read a mapping written by save() """
+        with np.load(filename) as data:
+            missing = [key for key in ('name', 'beadtypes', 'indptr', 
+                'indices', 'bonds') if key not in data.files]
+            if missing:
+                raise ValueError("{} is missing {}".format(filename, 
+                    ", ".join(missing)))
+            return cls(name=str(data['name']), beadtypes=data['beadtypes'],
+                    indptr=data['indptr'], indices=data['indices'],
+                    bonds=data['bonds'])
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def beadtypes(self):
+        return self._beadtypes
+
+    @property
+    def indptr(self):
+        return self._indptr
+
+    @property
+    def indices(self):
+        return self._indices
+
+    @property
+    def bonds(self):
+        return self._bonds
+
+    @property
+    def n_beads(self):
+        return len(self._beadtypes)
+
+    def compiled(self):
+        """ Local-offset arrays, as from compile_residue_mapping """
+        return {'beadtypes': self._beadtypes, 'indptr': self._indptr,
+                'indices': self._indices, 'bonds': self._bonds}
+
+    def to_dict(self):
+        """ (mapping_dict, bonding_info), as from load_mapping """
+        mapping_dict = OrderedDict((str(i), [str(beadtype),
+            self._indices[self._indptr[i]:self._indptr[i+1]].tolist()])
+            for i, beadtype in enumerate(self._beadtypes))
+        bonding_info = [(str(i), str(j)) for i, j in self._bonds]
+        return mapping_dict, bonding_info
+
+    def save(self, filename=None):
+        """ Write to .map, .xml or .npz, chosen by the extension """
+        extension = os.path.splitext(filename)[1].lower()
+        if extension == '.map':
+            self._write_map(filename)
+        elif extension == '.xml':
+            self._write_xml(filename)
+        elif extension == '.npz':
+            np.savez(filename, name=np.array(self._name),
+                    beadtypes=self._beadtypes, indptr=self._indptr,
+                    indices=self._indices, bonds=self._bonds)
+        else:
+            raise ValueError("Invalid mapping file {}, expected .map, .xml "
+                    "or .npz".format(filename))
+
+    def _write_map(self, filename):
+        with open(filename, 'w') as f:
+            for i, beadtype in enumerate(self._beadtypes):
+                f.write("{} : {} : {}\n".format(i, beadtype, " ".join(
+                    str(index) for index in
+                    self._indices[self._indptr[i]:self._indptr[i+1]])))
+            for i, j in self._bonds:
+                f.write("bond : {} {}\n".format(i, j))
+
+    def _write_xml(self, filename):
+        root = etree.Element('Mapping')
+        molecule = etree.SubElement(root, "Molecule", name=self._name)
+        beads = etree.SubElement(molecule, 'Beads', n_beads=str(self.n_beads))
+        bonds = etree.SubElement(molecule, 'Bonds',
+                n_bonds=str(len(self._bonds)))
+        for i, beadtype in enumerate(self._beadtypes):
+            etree.SubElement(beads, "Bead", index=str(i),
+                    beadtype=str(beadtype), map=" ".join(str(index) for index in
+                        self._indices[self._indptr[i]:self._indptr[i+1]]))
+        for i, j in self._bonds:
+            etree.SubElement(bonds, "Bond", bead1=str(i), bead2=str(j))
+        etree.ElementTree(root).write(filename, pretty_print=True)
+
+    def __str__(self):
+        return "<MoleculeMapping {} with {} beads, {} bonds>".format(
+            self._name, self.n_beads, len(self._bonds))
+
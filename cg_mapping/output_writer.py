@@ -0,0 +1,154 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import mdtraj
+from mdtraj.utils import in_units_of
+
+
+def _write_xtc(f, traj):
+    f.write(xyz=traj.xyz, time=traj.time, box=traj.unitcell_vectors)
+
+def _write_trr(f, traj):
+    f.write(xyz=traj.xyz, time=traj.time, box=traj.unitcell_vectors)
+
+def _write_dcd(f, traj):
+    f.write(xyz=in_units_of(traj.xyz, 'nanometers', f.distance_unit),
+            cell_lengths=in_units_of(traj.unitcell_lengths, 'nanometers',
+                f.distance_unit),
+            cell_angles=traj.unitcell_angles)
+
+def _write_h5(f, traj):
+    if f.topology is None:
+        f.topology = traj.topology
+    f.write(coordinates=traj.xyz, time=traj.time,
+            cell_lengths=traj.unitcell_lengths,
+            cell_angles=traj.unitcell_angles)
+
+# Trajectory formats that can be appended to chunk by chunk
+TRAJECTORY_WRITERS = {'xtc': (mdtraj.formats.XTCTrajectoryFile, _write_xtc),
+                      'trr': (mdtraj.formats.TRRTrajectoryFile, _write_trr),
+                      'dcd': (mdtraj.formats.DCDTrajectoryFile, _write_dcd),
+                      'h5': (mdtraj.formats.HDF5TrajectoryFile, _write_h5)}
+
+
+class OutputWriter(object):
+    """ Writes a CG trajectory to several formats in one pass
+
+    Parameters
+    ---------
+    output : str
+        Filename stem, each format is written to '{output}.{format}'
+    trajectory_formats : list of str
+        Formats that get every frame, any of TRAJECTORY_WRITERS
+    structure_formats : list of str
+        Formats that get a single frame, anything mdtraj can save
+    structure_frame : int
+        Index of the frame written to the structure formats, counted
+        over all chunks, -1 for the last frame
+    n_threads : int, optional
+        Writer threads, defaults to one per format
+
+    Notes
+    -----
+    Feed frames with write_chunk, in order, then write_structures.
+    Each chunk is handed to every trajectory file at once, one thread
+    per file, so only one chunk is ever held. The structure frame is
+    sliced once and shared by all structure writers.
+    Use as a context manager to close the trajectory files
+
+    """
+
+    def __init__(self, output, trajectory_formats=('xtc',),
+            structure_formats=('gro', 'pdb'), structure_frame=-1,
+            n_threads=None):
+        self._output = output
+        for fmt in trajectory_formats:
+            if fmt not in TRAJECTORY_WRITERS:
+                raise ValueError("Cannot stream '{}' trajectories, choose from "
+                        "{}".format(fmt, sorted(TRAJECTORY_WRITERS)))
+        if set(trajectory_formats) & set(structure_formats):
+            raise ValueError("A format cannot be both trajectory and structure")
+        if structure_frame < -1:
+            raise ValueError("structure_frame must be -1 or a frame index")
+        self._trajectory_formats = list(trajectory_formats)
+        self._structure_formats = list(structure_formats)
+        self._structure_frame = structure_frame
+        n_formats = len(self._trajectory_formats) + len(self._structure_formats)
+        self._pool = ThreadPoolExecutor(max_workers=n_threads or max(1, n_formats))
+        self._files = [TRAJECTORY_WRITERS[fmt][0](self._filename(fmt), 'w')
+                for fmt in self._trajectory_formats]
+        self._frame = None
+        self._n_frames = 0
+
+    @property
+    def output(self):
+        return self._output
+
+    @property
+    def n_frames(self):
+        return self._n_frames
+
+    @property
+    def frame(self):
+        """ Structure frame as a single-frame trajectory, once it was seen """
+        return self._frame
+
+    def _filename(self, fmt):
+        return '{}.{}'.format(self._output, fmt)
+
+    def write_chunk(self, traj):
+        """ Append a chunk of frames to every trajectory format
+
+        Parameters
+        ---------
+        traj : mdtraj Trajectory
+        """
+        futures = [self._pool.submit(TRAJECTORY_WRITERS[fmt][1], f, traj)
+                for fmt, f in zip(self._trajectory_formats, self._files)]
+        index = self._structure_frame - self._n_frames
+        if self._structure_frame == -1:
+            self._frame = traj[-1]
+        elif 0 <= index < traj.n_frames:
+            self._frame = traj[index]
+        self._n_frames += traj.n_frames
+        for future in futures:
+            future.result()
+
+    def write_structures(self, frame=None):
+        """ Save the structure frame to every structure format
+
+        Parameters
+        ---------
+        frame : mdtraj Trajectory, optional
+            Single frame to write instead of the one kept by write_chunk
+
+        Returns
+        -------
+        filenames : list of str
+        """
+        if frame is None:
+            frame = self._frame
+        if frame is None:
+            raise ValueError("Frame {} was never written, {} frames seen".format(
+                self._structure_frame, self._n_frames))
+        filenames = [self._filename(fmt) for fmt in self._structure_formats]
+        for future in [self._pool.submit(frame.save, filename)
+                for filename in filenames]:
+            future.result()
+        return filenames
+
+    def close(self):
+        for f in self._files:
+            f.close()
+        self._files = []
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __str__(self):
+        return "<OutputWriter to {} ({}), {} frames>".format(self._output,
+            ", ".join(self._trajectory_formats + self._structure_formats),
+            self._n_frames)
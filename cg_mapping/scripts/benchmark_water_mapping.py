@@ -0,0 +1,63 @@
+import time
+from optparse import OptionParser
+
+import numpy as np
+import mdtraj
+
+import cg_mapping.mapping_functions as mapping_functions
+from cg_mapping.cell_list import minimum_image, orthorhombic_box
+
+""" Compare the k-means and cell-list water mapping strategies,
+timing each and reporting the periodic clustering inertia
+(mean squared minimum-image distance from a water oxygen 
+to its closest CG water bead) """
+
+def periodic_inertia(traj, waters, all_frame_coms):
+    inertia = []
+    for frame_index in range(traj.n_frames):
+        box_lengths = orthorhombic_box(traj.unitcell_vectors[frame_index])
+        aa_water_xyz = traj.xyz[frame_index, waters, :].astype(np.float64)
+        closest = []
+        for water in aa_water_xyz:
+            dx = minimum_image(all_frame_coms[frame_index] - water, box_lengths)
+            closest.append(np.min(np.sum(dx**2, axis=1)))
+        inertia.append(np.mean(closest))
+    return np.mean(inertia)
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-f", action="store", type="string", dest = "trajfile", default=None)
+    parser.add_option("-c", action="store", type="string", dest = "topfile", default='md_pureDSPC.pdb')
+    parser.add_option("-n", action="store", type="int", dest = "n_frames", default=5)
+    parser.add_option("-w", action="store", type="int", dest = "water_bead_mapping", default=4)
+    (options, args) = parser.parse_args()
+
+    if options.trajfile:
+        traj = mdtraj.load(options.trajfile, top=options.topfile)
+    else:
+        traj = mdtraj.load(options.topfile)
+    traj = traj[:options.n_frames]
+
+    waters, masses, n_cg_water = mapping_functions._water_oxygens(traj.topology,
+            options.water_bead_mapping)
+    if n_cg_water == 0:
+        print("No waters to map in {}".format(options.topfile))
+    else:
+        print("{} frames, {} waters, {} CG waters".format(traj.n_frames,
+            len(waters), n_cg_water))
+        start = time.time()
+        kmeans_coms = mapping_functions._map_waters_parallel(traj, waters, 
+                n_cg_water, masses=masses, verbose=True)
+        kmeans_time = time.time() - start
+
+        start = time.time()
+        cell_list_coms, n_iters, _ = mapping_functions._map_waters_cell_list(
+                traj, waters, n_cg_water, masses=masses, verbose=True)
+        cell_list_time = time.time() - start
+        print("Mean cell-list iterations per frame: {}".format(np.mean(n_iters)))
+
+        print("{:<12}{:>12}{:>12}".format("method", "time (s)", "inertia"))
+        print("{:<12}{:>12.3f}{:>12.5f}".format("kmeans", kmeans_time,
+            periodic_inertia(traj, waters, kmeans_coms)))
+        print("{:<12}{:>12.3f}{:>12.5f}".format("cell_list", cell_list_time,
+            periodic_inertia(traj, waters, cell_list_coms)))
@@ -6,9 +6,14 @@ from collections import OrderedDict
 from optparse import OptionParser
 
 import mdtraj
-import mbuild as mb
 
 import cg_mapping.mapping_functions as mapping_functions
+import cg_mapping.mapping_cache as mapping_cache
+import cg_mapping.hoomd_io as hoomd_io
+from cg_mapping.output_writer import OutputWriter
+from cg_mapping.cg_system import CGSystem
+from cg_mapping.molecule_mapping import MoleculeMapping
+import cg_mapping.forcefield as forcefield
 
 PATH_TO_MAPPINGS='/raid6/homes/ahy3nz/Programs/cg_mapping/cg_mapping/charmm_mappings/'
 HOOMD_FF="/raid6/homes/ahy3nz/Programs/setup/FF/CG/msibi_ff.xml"
@@ -18,14 +23,50 @@ if __name__ == "__main__":
     parser.add_option("-f", action="store", type="string", dest = "trajfile", default='last20.xtc')
     parser.add_option("-c", action="store", type="string", dest = "topfile", default='md_pureDSPC.pdb')
     parser.add_option("-o", action="store", type="string", dest = "output", default='cg-traj')
+    parser.add_option("--chunk", action="store", type="int", dest = "chunk", default=None,
+            help="Stream the trajectory this many frames at a time")
+    parser.add_option("--cache", action="store", type="string", dest = "cache", default=None,
+            help="Directory to cache the compiled mapping in")
+    parser.add_option("--replicate", action="store", type="int", nargs=3, 
+            dest = "replicate", default=(2, 2, 2),
+            help="Number of copies of the final frame along x, y and z")
+    parser.add_option("--traj-formats", action="store", type="string", 
+            dest = "traj_formats", default='xtc',
+            help="Comma-separated formats that get every CG frame")
+    parser.add_option("--structure-formats", action="store", type="string", 
+            dest = "structure_formats", default='gro,h5,xyz,pdb',
+            help="Comma-separated formats that get a single CG frame")
+    parser.add_option("--structure-frame", action="store", type="int", 
+            dest = "structure_frame", default=-1,
+            help="Frame written to the structure formats and HOOMD files")
+    parser.add_option("--forcefield", action="store", type="string", 
+            dest = "forcefield", default=HOOMD_FF,
+            help="Force field XML used to type the HOOMD files")
+    parser.add_option("--water-method", action="store", type="choice",
+            choices=['kmeans', 'warm_start', 'cell_list'],
+            dest = "water_method", default='kmeans',
+            help="Water mapping: kmeans, warm_start or cell_list")
+    parser.add_option("--workers", action="store", type="int", 
+            dest = "workers", default=None,
+            help="Processes for the parallel k-means, defaults to the number of cpus")
+    parser.add_option("--chunksize", action="store", type="int", 
+            dest = "chunksize", default=None,
+            help="Frames submitted to a k-means worker at a time")
+    parser.add_option("-v", "--verbose", action="store_true", 
+            dest = "verbose", default=False,
+            help="Report iterations per warm-started frame, or estimated "
+            "IPC bytes per frame of the parallel k-means")
     (options, args) = parser.parse_args()
     
     
     #trajfile = "last20.xtc"
     
     #pdbfile = "md_DSPC-34_alc16-33_acd16-33_1-27b.gro"
-    traj = mdtraj.load(options.trajfile, top=options.topfile)
-    topol = traj.topology
+    if options.chunk:
+        topol = mdtraj.load_topology(options.topfile)
+    else:
+        traj = mdtraj.load(options.trajfile, top=options.topfile)
+        topol = traj.topology
     start=time.time()
     # Read in the mapping files, could be made more pythonic
     DSPCmapfile = os.path.join(PATH_TO_MAPPINGS,'DSPC.xml')#'mappings/DSPC.map'
@@ -33,93 +74,111 @@ if __name__ == "__main__":
     #watermapfile = os.path.join(PATH_TO_MAPPINGS,'water.map')
     #alc16mapfile = os.path.join(PATH_TO_MAPPINGS,'C16OH.map')
     #acd16mapfile = os.path.join(PATH_TO_MAPPINGS,'C16FFA.map')
-    # Huge dictionary of dictionaries, keys are molecule names
-    # Values are the molecule's mapping dictionary
-    # could be made more pythonic
-    all_CG_mappings = OrderedDict()
-    all_bonding_info = OrderedDict()
-    
-    molecule_mapping, molecule_bonding = mapping_functions.load_mapping(mapfile=DSPCmapfile)
-    all_CG_mappings.update({'DSPC': molecule_mapping})
-    all_bonding_info.update({'DSPC': molecule_bonding})
+    # Keys are molecule (residue) names, values are the molecule's mapping file
+    mapfiles = OrderedDict([('DSPC', DSPCmapfile), ('ffa1', c16ffamapfile)])
 
-    molecule_mapping, molecule_bonding = mapping_functions.load_mapping(mapfile=c16ffamapfile)
-    all_CG_mappings.update({'ffa1': molecule_mapping})
-    all_bonding_info.update({'ffa1': molecule_bonding})
+    if options.cache:
+        CG_topology_map, CG_topology, mapping_operator = mapping_cache.load_or_build(
+                topol=topol, mapfiles=mapfiles, cache_dir=options.cache)
+    else:
+        # Keys are molecule names, values are the molecule's mapping arrays
+        all_CG_mappings = OrderedDict((resname, MoleculeMapping.load(mapfile))
+                for resname, mapfile in mapfiles.items())
+    
+        CG_topology_map, CG_topology = mapping_functions.create_CG_topology(topol=topol, 
+                                all_CG_mappings=all_CG_mappings)
+        mapping_operator = None
 
-    
-    CG_topology_map, CG_topology = mapping_functions.create_CG_topology(topol=topol, 
-                            all_CG_mappings=all_CG_mappings, 
-                            all_bonding_info=all_bonding_info)
-    CG_xyz = mapping_functions.convert_xyz(traj=traj, CG_topology_map=CG_topology_map)
-    
-    CG_traj = mdtraj.Trajectory(CG_xyz, CG_topology, time=traj.time, 
-            unitcell_lengths=traj.unitcell_lengths, unitcell_angles = traj.unitcell_angles)
-    
-    
-    avg_box_lengths = mapping_functions.compute_avg_box(traj)
-    print("Avg box length: {}".format(avg_box_lengths))
-    
-    CG_traj.save('{}.xtc'.format(options.output))
-    CG_traj[-1].save('{}.gro'.format(options.output))
-    CG_traj[-1].save('{}.h5'.format(options.output))
-    CG_traj[-1].save('{}.xyz'.format(options.output))
-    CG_traj[-1].save('{}.pdb'.format(options.output))
-    
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        mb_compound = mb.Compound()
-        mb_compound.from_trajectory(CG_traj, frame=-1, coords_only=False)
-        original_box = mb.Box(lengths=[length for length in mb_compound.periodicity])
-    
-        # Because we are resizing the box based on the average box over the trajectory,
-        # we need to scale the coordinates appropriately, since they are taken only
-        # from the final frame.
-        scaling_ratio = [new/old for old, new in zip(original_box.lengths, avg_box_lengths)]
-        print("scaling_ratio: {}".format(scaling_ratio))
-        for particle in mb_compound.particles():
-            for i, frame in enumerate(particle.xyz):
-                particle.xyz[i] = [factor*coord for factor, coord in zip(scaling_ratio, particle.xyz[i])]
-    
-        # Tile this using grid 3d pattern
-        cube = mb.Grid3DPattern(2,2,2)
-        # Define a new box based on average box lengths from AA traj, scaled by 8
-        new_box = mb.Box(lengths=[2*length for length in avg_box_lengths])
-        # Scale pattern lengths based on the new box lengths
-        cube.scale([length for length in new_box.lengths])
-        replicated = cube.apply(mb_compound)
-        mirrored_image = mb.Compound()
-        for item in replicated:
-            mirrored_image.add(item)
-    
-        # Particle renaming due to mbuild coarsegrained format
-        for particle in mb_compound.particles():
-            particle.name = "_"+ particle.name.strip()
-        for particle in mirrored_image.particles():
-            particle.name = "_"+ particle.name.strip()
-    
-        from foyer import Forcefield
-        from mbuild.formats.hoomdxml import write_hoomdxml
-        ff = Forcefield(forcefield_files=HOOMD_FF)
-        kwargs  = {}
-        kwargs['rigid_bodies'] = [p.rigid_id for p in mb_compound.particles()]
-        structure = mb_compound.to_parmed(box=original_box)
-        structure = ff.apply(structure, assert_dihedral_params=False)
-        write_hoomdxml(structure, '{}.hoomdxml'.format(options.output), 
-                ref_energy = 0.239, ref_distance = 10, **kwargs)
-
-        ff = Forcefield(forcefield_files=HOOMD_FF)
-        kwargs  = {}
-        kwargs['rigid_bodies'] = [p.rigid_id for p in mirrored_image.particles()]
-        structure = mirrored_image.to_parmed(box=new_box)
-        structure = ff.apply(structure, assert_dihedral_params=False)
-        write_hoomdxml(structure, '{}_2x2x2.hoomdxml'.format(options.output), 
-                ref_energy = 0.239, ref_distance = 10, **kwargs)
+    traj_formats = [fmt for fmt in options.traj_formats.split(',') if fmt]
+    structure_formats = [fmt for fmt in options.structure_formats.split(',') if fmt]
+    writer = OutputWriter(options.output, trajectory_formats=traj_formats,
+            structure_formats=structure_formats, 
+            structure_frame=options.structure_frame)
+    with writer:
+        if options.chunk:
+            # Write each CG chunk as it is mapped, keeping only 
+            # the structure frame and a running box sum in memory
+            box_sum = 0
+            n_frames = 0
+            for CG_chunk in mapping_functions.convert_traj_chunks(
+                    trajfile=options.trajfile, top=topol,
+                    CG_topology_map=CG_topology_map, CG_topology=CG_topology,
+                    chunk=options.chunk, mapping_operator=mapping_operator,
+                    water_method=options.water_method, n_workers=options.workers,
+                    chunksize=options.chunksize, verbose=options.verbose):
+                writer.write_chunk(CG_chunk)
+                box_sum += CG_chunk.unitcell_lengths.sum(axis=0)
+                n_frames += CG_chunk.n_frames
+            avg_box_lengths = box_sum / n_frames
+        else:
+            CG_xyz = mapping_functions.convert_xyz(traj=traj, CG_topology_map=CG_topology_map,
+                    mapping_operator=mapping_operator, 
+                    water_method=options.water_method, n_workers=options.workers,
+                    chunksize=options.chunksize, verbose=options.verbose)
+        
+            CG_traj = mdtraj.Trajectory(CG_xyz, CG_topology, time=traj.time, 
+                    unitcell_lengths=traj.unitcell_lengths, unitcell_angles = traj.unitcell_angles)
         
+        
+            avg_box_lengths = mapping_functions.compute_avg_box(traj)
+            writer.write_chunk(CG_traj)
+        print("Avg box length: {}".format(avg_box_lengths))
+        
+        # One copy of the structure frame, shared by every structure format
+        CG_frame = writer.frame
+        writer.write_structures()
+    
+    # Because we are resizing the box based on the average box over the trajectory,
+    # we need to scale the coordinates appropriately, since they are taken only
+    # from the structure frame.
+    system = CGSystem.from_trajectory(CG_frame, frame=0, 
+            box_lengths=avg_box_lengths, 
+            masses=mapping_functions.bead_masses(bead_table=CG_topology_map,
+                topol=topol))
+    print("scaling_ratio: {}".format(avg_box_lengths / CG_frame.unitcell_lengths[0]))
+    # Tile the rescaled frame, whole arrays at a time
+    replicated = system.replicate(options.replicate)
+    print(replicated)
+    replicated_name = '{}_{}x{}x{}'.format(options.output, *options.replicate)
 
-        #mb_compound.save('{}.hoomdxml'.format(options.output), ref_energy = 0.239, ref_distance = 10, forcefield_files=HOOMD_FF, overwrite=True, box=original_box)
-        #mirrored_image.save('{}_2x2x2.hoomdxml'.format(options.output), ref_energy = 0.239, ref_distance = 10, forcefield_files=HOOMD_FF, overwrite=True, box=new_box)
-    
+    # Type and parameterize one molecule of each residue name, then stamp
+    # the templates onto every molecule and every copy
+    if os.path.isfile(options.forcefield):
+        if options.cache:
+            templates = forcefield.load_or_build_templates(system=system,
+                    forcefield_file=options.forcefield, mapfiles=mapfiles,
+                    cache_dir=options.cache)
+        else:
+            templates = forcefield.build_templates(system=system,
+                    forcefield=forcefield.ForceField.from_xml(options.forcefield))
+        typed = forcefield.stamp_templates(templates=templates, system=system)
+        typed_replicated = typed.replicate(replicated.n_beads // system.n_beads)
+        print(typed)
+    else:
+        print("No force field at {}, writing untyped HOOMD files".format(
+            options.forcefield))
+        typed, typed_replicated = None, None
+
+    # HOOMD input straight from the arrays, no mbuild/parmed/foyer round trip
+    hoomd_io.write_hoomdxml('{}.hoomdxml'.format(options.output), system,
+            typed=typed)
+    hoomd_io.write_hoomdxml('{}.hoomdxml'.format(replicated_name), replicated,
+            typed=typed_replicated)
+    hoomd_io.write_gsd('{}.gsd'.format(options.output), system, typed=typed)
+    hoomd_io.write_gsd('{}.gsd'.format(replicated_name), replicated,
+            typed=typed_replicated)
+    if not options.chunk:
+        CG_frames = CG_traj
+    elif traj_formats:
+        # Read the CG trajectory back a chunk at a time
+        CG_frames = mdtraj.iterload('{}.{}'.format(options.output, traj_formats[0]),
+                top=CG_topology, chunk=options.chunk)
+    else:
+        CG_frames = None
+    if CG_frames is not None:
+        n_frames = hoomd_io.write_gsd('{}-traj.gsd'.format(options.output), 
+                system, trajectory=CG_frames, typed=typed)
+        print("Wrote {} frames to {}-traj.gsd".format(n_frames, options.output))
         
     end=time.time()
     print(end-start)
@@ -1,4 +1,5 @@
 from cg_mapping import *
+import cg_mapping.cg_utils as cg_utils
 import numpy as np
 import pandas as pd
 import mdtraj
@@ -16,14 +17,64 @@ beadtypes=['_CH3', '_CH2']
 #beadtypes=['P4', 'P3', 'Nda', 'Na', 'C2', 'C1', 'Qa', 'Q0']
 
 parser = argparse.ArgumentParser()
-parser.add_argument("-f", dest="trajectory", help="Trajectory")
+parser.add_argument("-f", dest="trajectory", nargs='+',
+        help="Trajectory, or one trajectory per replica")
 parser.add_argument("-c", dest="topology", help="File with structure/topology info")
 parser.add_argument("-o", dest="output", help="Output for rdf filenames")
+parser.add_argument("--chunk", dest="chunk", type=int, default=None,
+        help="Stream the trajectory in chunks of this many frames")
+parser.add_argument("--bond-range", dest="bond_range", type=float, nargs=2,
+        default=None, help="Bond length histogram range (nm), required with "
+        "--chunk or replicas unless --data-ranges is given")
+parser.add_argument("--angle-range", dest="angle_range", type=float, nargs=2,
+        default=None, help="Angle histogram range (rad), required with "
+        "--chunk or replicas unless --data-ranges is given")
+parser.add_argument("--data-ranges", dest="data_ranges", action="store_true",
+        help="Bin each bond and angle type over its own min to max, as "
+        "in memory, which reads a streamed trajectory twice")
+parser.add_argument("--bins", dest="bins", type=int, default=None,
+        help="Number of bond, angle and dihedral histogram bins, default 50. "
+        "Loaded distributions are rebinned, which needs a divisor of their "
+        "saved bin count")
+parser.add_argument("--workers", dest="workers", type=int, default=None,
+        help="Processes used for the RDFs and replicas, defaults to the "
+        "number of cpus")
+parser.add_argument("--save-distributions", dest="save_distributions",
+        default=None, help="Write all distributions to this .npz")
+parser.add_argument("--load-distributions", dest="load_distributions",
+        default=None, help="Refit distributions saved with --save-distributions "
+        "instead of reading a trajectory")
+parser.add_argument("-T", dest="temperature", type=float, default=305,
+        help="Temperature (K)")
 args = parser.parse_args()
 #traj = mdtraj.load("bonded_cg-traj.xtc", top="bonded_cg-traj.pdb")
-traj = mdtraj.load(args.trajectory, top=args.topology)
-
-system_state = cg_utils.State(k_b=8.314e-3, T=305, traj=traj)
+if args.load_distributions:
+    system_state = cg_utils.State.from_distributions(args.load_distributions,
+            k_b=8.314e-3, T=args.temperature)
+    if args.bins:
+        system_state.rebin_distributions(args.bins)
+elif len(args.trajectory) > 1:
+    # Replicas are histogrammed in parallel and merged, then fit once
+    system_state = cg_utils.ReplicaState(k_b=8.314e-3, T=args.temperature,
+            trajfiles=args.trajectory, top=args.topology, 
+            chunk=args.chunk or 1000)
+    system_state.accumulate_distributions(bond_range=args.bond_range,
+            angle_range=args.angle_range, n_bins=args.bins or 50,
+            n_workers=args.workers, data_ranges=args.data_ranges)
+elif args.chunk:
+    # Constant memory, histograms are accumulated chunk by chunk
+    system_state = cg_utils.State(k_b=8.314e-3, T=args.temperature, 
+            trajfile=args.trajectory[0], top=args.topology, chunk=args.chunk)
+    system_state.accumulate_distributions(bond_range=args.bond_range,
+            angle_range=args.angle_range, n_bins=args.bins or 50,
+            data_ranges=args.data_ranges)
+else:
+    traj = mdtraj.load(args.trajectory[0], top=args.topology)
+    system_state = cg_utils.State(k_b=8.314e-3, T=args.temperature, traj=traj)
+    if args.bins or args.bond_range or args.angle_range:
+        # Same binning as the streamed path, from the loaded frames
+        system_state.accumulate_distributions(bond_range=args.bond_range,
+                angle_range=args.angle_range, n_bins=args.bins or 50)
 print("*"*20)
 print(system_state)
 print("*"*20)
@@ -31,16 +82,18 @@ print("*"*20)
 print("*"*20)
 print("Bonding parameters")
 print("*"*20)
-all_bonding_parameters = pd.DataFrame(columns=['#bond', 'force_constant','x0'])
+all_bonding_parameters = pd.DataFrame(columns=['#bond', 'force_constant','x0',
+    'r_squared'])
 
-for x,y in itertools.combinations_with_replacement(beadtypes, 2):
+# Every bonded type pair in one pass over the topology and trajectory
+for (x,y), bond_parameters in system_state.compute_all_bond_parameters().items():
     print("---{}-{}---".format(x,y))
-    bond_parameters = system_state.compute_bond_parameters(x, y)
     print(bond_parameters)
     if bond_parameters:
         all_bonding_parameters.loc[len(all_bonding_parameters)] = \
             ['{}-{}'.format(x,y),
-            bond_parameters['force_constant'], bond_parameters['x0']]
+            bond_parameters['force_constant'], bond_parameters['x0'],
+            bond_parameters['r_squared']]
 print(all_bonding_parameters)
 all_bonding_parameters.to_csv('bond_parameters.dat', sep='\t', index=False)
 
@@ -48,22 +101,76 @@ print("*"*20)
 print("Angle parameters")
 print("*"*20)
 
-all_angle_parameters = pd.DataFrame(columns=['#angle','force_constant', 'x0'])
-for x,z in itertools.combinations_with_replacement(beadtypes, 2):
-        for y in beadtypes: 
-            print("{}-{}-{}: ".format(x,y,z))
-            angle_parameters = system_state.compute_angle_parameters( x, y, z, plot=True)
-            print(angle_parameters)
-            if angle_parameters:
-                all_angle_parameters.loc[len(all_angle_parameters)] = \
-                  ['{}-{}-{}'.format(x,y,z),
-                  angle_parameters['force_constant'], angle_parameters['x0']]
+all_angle_parameters = pd.DataFrame(columns=['#angle','force_constant', 'x0',
+    'r_squared'])
+# Every angle type triple from one precomputed angle index
+for (x,y,z), angle_parameters in system_state.compute_all_angle_parameters(plot=True).items():
+    print("{}-{}-{}: ".format(x,y,z))
+    print(angle_parameters)
+    if angle_parameters:
+        all_angle_parameters.loc[len(all_angle_parameters)] = \
+          ['{}-{}-{}'.format(x,y,z),
+          angle_parameters['force_constant'], angle_parameters['x0'],
+          angle_parameters['r_squared']]
 
 print(all_angle_parameters)
 all_angle_parameters.to_csv('angle_parameters.dat', sep='\t', index=False)
+
+print("*"*20)
+print("Dihedral parameters")
+print("*"*20)
+
+all_dihedral_parameters = pd.DataFrame(columns=['#dihedral', 'multiplicity',
+    'force_constant', 'phase', 'r_squared'])
+# Every dihedral type from one precomputed dihedral index
+for (w,x,y,z), dihedral_parameters in \
+        system_state.compute_all_dihedral_parameters().items():
+    print("{}-{}-{}-{}: ".format(w,x,y,z))
+    print(dihedral_parameters)
+    for multiplicity, force_constant, phase in zip(
+            dihedral_parameters['multiplicities'],
+            dihedral_parameters['force_constants'],
+            dihedral_parameters['phases']):
+        all_dihedral_parameters.loc[len(all_dihedral_parameters)] = \
+            ['{}-{}-{}-{}'.format(w,x,y,z), multiplicity, force_constant,
+            phase, dihedral_parameters['r_squared']]
+
+print(all_dihedral_parameters)
+all_dihedral_parameters.to_csv('dihedral_parameters.dat', sep='\t', index=False)
+if isinstance(system_state, cg_utils.ReplicaState):
+    print("*"*20)
+    print("Replica spread")
+    print("*"*20)
+    replica_spread = pd.DataFrame(columns=['#type', 'force_constant_mean',
+        'force_constant_std'])
+    for kind, all_spread in system_state.compute_replica_spread().items():
+        for types, type_spread in all_spread.items():
+            if kind == 'dihedrals':
+                # One row per multiplicity
+                for multiplicity, (mean, std) in enumerate(zip(
+                        type_spread['force_constants_mean'],
+                        type_spread['force_constants_std']), 1):
+                    replica_spread.loc[len(replica_spread)] = \
+                        ['{}:{}'.format('-'.join(types), multiplicity), mean, std]
+            else:
+                replica_spread.loc[len(replica_spread)] = \
+                    ['-'.join(types), type_spread['force_constant_mean'],
+                    type_spread['force_constant_std']]
+    print(replica_spread)
+    replica_spread.to_csv('replica_spread.dat', sep='\t', index=False)
+
 print("*"*20)
 print("Generating RDFs")
 print("*"*20)
-for x,y in itertools.combinations_with_replacement(beadtypes, 2):
-    print("---{}-{}---".format(x,y))
-    system_state.compute_rdf(x,y,"{}-{}-{}".format(x,y, args.output))
+if args.load_distributions:
+    system_state.write_rdfs(args.output)
+else:
+    # All type pairs share one pass over the trajectory, files are written at the end
+    type_pairs = list(itertools.combinations_with_replacement(beadtypes, 2))
+    for x,y in type_pairs:
+        print("---{}-{}---".format(x,y))
+    system_state.compute_all_rdfs(type_pairs, output=args.output,
+            n_workers=args.workers)
+
+if args.save_distributions:
+    system_state.save_distributions(args.save_distributions)